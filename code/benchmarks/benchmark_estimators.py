@@ -0,0 +1,245 @@
+"""
+This module benchmarks the estimation methods and the bootstrap at growing numbers of rows.
+
+Every measurement runs in a freshly spawned process, so its peak resident memory is not
+affected by earlier measurements. The data of n rows is drawn with replacement from the
+transformed project data, or generated by synthetic_data, with a fixed seed. For each
+estimator and size the benchmark records wall time, CPU time, peak RSS, and the stage
+breakdown of the `profiling` module: count, wall, CPU and self seconds of every stage, such
+as the propensity and outcome model fits and predictions and the estimator's own work.
+
+Results are written as JSON, together with the machine, Python and package versions and
+the git commit, so runs can be compared over time. Everything runs offline.
+
+Usage:
+    python benchmark_estimators.py --sizes 4000 40000 400000 4000000 --output bench.json
+    python benchmark_estimators.py --estimators ipw matching bci:ipw --bootstrap-replicates 10
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas
+import sklearn
+
+ESTIMATION_METHODS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                      'estimation_methods')
+sys.path.append(os.path.abspath(ESTIMATION_METHODS_DIR))
+sys.path.append(os.path.abspath(os.path.join(ESTIMATION_METHODS_DIR, '..')))
+
+# pylint: disable=wrong-import-position
+import doubly_robust
+import inverse_probability_weighting
+import profiling
+import propensity_score_matching
+import s_learner
+import t_learner
+import utils
+from feature_transformer import FeatureTransformer
+from synthetic_data import SyntheticCohortGenerator
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+                         'processed_data.csv')
+
+ESTIMATORS = {
+    's_learner': (s_learner, 'calculate_measures_s_learner'),
+    't_learner': (t_learner, 'calculate_measures_t_learner'),
+    'ipw': (inverse_probability_weighting, 'calculate_measures_ipw'),
+    'matching': (propensity_score_matching, 'calculate_measures_matching'),
+    'doubly_robust': (doubly_robust, 'calculate_measures_doubly_robust'),
+}
+
+DEFAULT_SIZES = (4_000, 40_000)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_data(n_rows, seed=0, data_path=DATA_PATH, source='resample'):
+    """
+    Draw n_rows rows with replacement from the transformed project data, or generate a
+    synthetic cohort with the same schema.
+    Parameters:
+    n_rows (int): Number of rows.
+    seed (int): Seed of the draw.
+    data_path (str): Path of the processed CSV file.
+    source (str): 'resample' or 'synthetic'.
+    Returns:
+    tuple: Contiguous feature matrix, treatment and outcome arrays.
+    """
+    if source == 'synthetic':
+        cohort, _ = SyntheticCohortGenerator(data_path, seed=seed).generate(n_rows)
+        x = FeatureTransformer().fit_transform(cohort.drop(columns=['Adult', 'Target']),
+                                               as_frame=False)
+        return x, cohort['Adult'].to_numpy(), cohort['Target'].to_numpy()
+
+    x, t, y = utils.read_and_transform_data(data_path)
+    rows = np.random.default_rng(seed).integers(0, len(y), size=n_rows)
+    x = np.ascontiguousarray(np.asarray(x, dtype=float)[rows])
+    return x, np.asarray(t)[rows], np.asarray(y)[rows]
+
+
+def _measure(task, n_rows, seed, bootstrap_replicates, data_source, queue):
+    """
+    Run one measurement in a spawned process and put its record on `queue`.
+    """
+    try:
+        start = time.perf_counter()
+        x, t, y = make_data(n_rows, seed, source=data_source)
+        data_seconds = time.perf_counter() - start
+        baseline_rss_mb = _peak_rss_mb()
+
+        is_bootstrap = task.startswith('bci:')
+        module, function_name = ESTIMATORS[task[4:] if is_bootstrap else task]
+
+        # Only the measured call is profiled, not the data preparation
+        profiling.reset()
+        profiling.enable()
+        calculate_measures = getattr(module, function_name)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if is_bootstrap:
+            utils.bci(x, t, y, calculate_measures, num_bootstrap=bootstrap_replicates, seed=seed)
+        else:
+            calculate_measures(x, t, y)
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        profiling.disable()
+
+        record = {
+            'task': task,
+            'n_rows': n_rows,
+            'n_features': x.shape[1],
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'data_seconds': data_seconds,
+            'baseline_rss_mb': baseline_rss_mb,
+            'peak_rss_mb': _peak_rss_mb(),
+            'stages': profiling.summary(),
+        }
+        if is_bootstrap:
+            record['bootstrap_replicates'] = bootstrap_replicates
+            record['seconds_per_replicate'] = wall_seconds / bootstrap_replicates
+        queue.put(record)
+    except Exception as error:  # pylint: disable=broad-except
+        queue.put({'task': task, 'n_rows': n_rows, 'error': repr(error)})
+
+
+def _environment():
+    """
+    Describe the machine and the versions the benchmark ran with.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': commit,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pandas.__version__,
+        'scikit-learn': sklearn.__version__,
+    }
+
+
+def _receive_record(process, queue, poll_seconds=1.0):
+    """
+    Wait for the record of a measurement process, draining the queue before the process is
+    joined: a child putting a large record blocks until it is read, so joining first could
+    wait forever. Returns None if the process exits without reporting.
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except queue_module.Empty:
+            if not process.is_alive():
+                break
+    # A record put just before exiting may still be in flight
+    try:
+        return queue.get(timeout=poll_seconds)
+    except queue_module.Empty:
+        return None
+
+
+def run_benchmarks(tasks, sizes, seed=0, bootstrap_replicates=5, data_source='resample'):
+    """
+    Measure every task at every size, each in a fresh process.
+    Parameters:
+    tasks (list of str): Estimator names, or 'bci:<estimator>' for the bootstrap.
+    sizes (list of int): Numbers of rows.
+    seed (int): Seed of the data draw and the bootstrap.
+    bootstrap_replicates (int): Replicates per bootstrap measurement.
+    data_source (str): 'resample' to draw rows of the project data, 'synthetic' to generate them.
+    Returns:
+    list of dict: One record per task and size.
+    """
+    context = multiprocessing.get_context('spawn')
+    records = []
+    for n_rows in sizes:
+        for task in tasks:
+            queue = context.Queue()
+            process = context.Process(target=_measure,
+                                      args=(task, n_rows, seed, bootstrap_replicates,
+                                            data_source, queue))
+            process.start()
+            record = _receive_record(process, queue)
+            process.join()
+            if record is None:
+                # The process died without reporting, e.g. killed when out of memory
+                record = {'task': task, 'n_rows': n_rows,
+                          'error': f'process exited with code {process.exitcode}'}
+            elif process.exitcode != 0 and 'error' not in record:
+                record['error'] = f'process exited with code {process.exitcode} after reporting'
+            records.append(record)
+
+            if 'error' in record:
+                print(f"{task} n={n_rows}: failed with {record['error']}")
+            else:
+                print(f"{task} n={n_rows}: {record['wall_seconds']:.2f}s wall, "
+                      f"{record['peak_rss_mb']:.0f} MB peak RSS")
+    return records
+
+
+if __name__ == '__main__':
+    default_tasks = list(ESTIMATORS) + [f'bci:{name}' for name in ESTIMATORS]
+
+    parser = argparse.ArgumentParser(description='Benchmark the estimation methods.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='numbers of rows, e.g. 4000 40000 400000 4000000')
+    parser.add_argument('--estimators', nargs='+', default=default_tasks, choices=default_tasks,
+                        help="estimators to time, 'bci:<estimator>' for its bootstrap")
+    parser.add_argument('--bootstrap-replicates', type=int, default=5,
+                        help='replicates per bootstrap measurement')
+    parser.add_argument('--data-source', default='resample', choices=['resample', 'synthetic'],
+                        help='draw rows of the project data or generate a synthetic cohort')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data and the bootstrap')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='path of the JSON results')
+    args = parser.parse_args()
+
+    benchmark_records = run_benchmarks(args.estimators, args.sizes, seed=args.seed,
+                                       bootstrap_replicates=args.bootstrap_replicates,
+                                       data_source=args.data_source)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': _environment(), 'seed': args.seed, 'data_source': args.data_source,
+                   'results': benchmark_records}, f, indent=2)
+    print(f'Results saved to {args.output}')
@@ -0,0 +1,129 @@
+"""
+This module compares the registered nuisance-model backends on the project data.
+
+For every backend in learners.LEARNERS, the propensity model (treatment from features) and
+the outcome model (target from features and treatment) are fitted on a stratified training
+split and scored on the held-out rows, recording fit and prediction time together with log
+loss, ROC AUC and Brier score. The doubly robust estimate with that backend for both models
+is also recorded, showing how much the effect estimates move with the faster backends.
+
+With --rows, rows are drawn with replacement, so duplicates fall on both sides of the
+split and the held-out scores are optimistic; timings remain comparable.
+
+Results are written as JSON with the machine and package versions, like
+benchmark_estimators.py.
+
+Usage:
+    python benchmark_learners.py --output learners.json
+    python benchmark_learners.py --learners gradient_boosting hist_gradient_boosting --rows 400000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from sklearn.metrics import brier_score_loss, log_loss, roc_auc_score
+from sklearn.model_selection import train_test_split
+
+# benchmark_estimators puts the estimation methods on sys.path
+from benchmark_estimators import DATA_PATH, make_data, _environment
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from doubly_robust import calculate_measures_doubly_robust
+from learners import LEARNERS, make_learner, resolve_learner
+from utils import read_and_transform_data
+
+
+def _score_model(spec, x_train, y_train, x_test, y_test):
+    """
+    Fit a model on the training rows and score its probabilities on the test rows.
+    """
+    model = make_learner(spec)
+
+    start = time.perf_counter()
+    model.fit(x_train, y_train)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    probabilities = model.predict_proba(x_test)[:, 1]
+    predict_seconds = time.perf_counter() - start
+
+    record = {
+        'fit_seconds': fit_seconds,
+        'predict_seconds': predict_seconds,
+        'log_loss': log_loss(y_test, probabilities),
+        'roc_auc': roc_auc_score(y_test, probabilities),
+        'brier': brier_score_loss(y_test, probabilities),
+    }
+    # Iterations run by boosting with early stopping and by the logistic regression solver
+    if hasattr(model, 'n_iter_'):
+        record['n_iter'] = int(np.max(model.n_iter_))
+    return record
+
+
+def benchmark_learners(x, t, y, learners, test_size=0.25, seed=0):
+    """
+    Compare backends on the propensity and outcome tasks and on the doubly robust estimate.
+    Parameters:
+    x (np.ndarray): Feature matrix.
+    t (np.ndarray): Treatment assignments.
+    y (np.ndarray): Outcome variable.
+    learners (list of str or dict): Learner specs to compare.
+    test_size (float): Fraction of the rows held out for scoring.
+    seed (int): Seed of the split.
+    Returns:
+    list of dict: One record per learner.
+    """
+    xt = np.column_stack([x, t])
+    train, test = train_test_split(np.arange(len(y)), test_size=test_size, random_state=seed,
+                                   stratify=t)
+
+    records = []
+    for spec in learners:
+        propensity = _score_model(spec, x[train], t[train], x[test], t[test])
+        outcome = _score_model(spec, xt[train], y[train], xt[test], y[test])
+
+        start = time.perf_counter()
+        ate, att, atc = calculate_measures_doubly_robust(x, t, y, propensity_learner=spec,
+                                                         outcome_learner=spec)
+        estimate_seconds = time.perf_counter() - start
+
+        record = {
+            'learner': resolve_learner(spec),
+            'propensity': propensity,
+            'outcome': outcome,
+            'doubly_robust': {'ate': float(ate), 'att': float(att), 'atc': float(atc),
+                              'seconds': estimate_seconds},
+        }
+        records.append(record)
+        print(f"{record['learner']['model']}: propensity AUC {propensity['roc_auc']:.3f} "
+              f"in {propensity['fit_seconds']:.2f}s, outcome AUC {outcome['roc_auc']:.3f} "
+              f"in {outcome['fit_seconds']:.2f}s, doubly robust ATE {ate:.4f} "
+              f"in {estimate_seconds:.2f}s")
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the nuisance-model backends.')
+    parser.add_argument('--learners', nargs='+', default=list(LEARNERS), choices=list(LEARNERS),
+                        help='backends to compare')
+    parser.add_argument('--data', default=DATA_PATH, help='path of the processed CSV file')
+    parser.add_argument('--rows', type=int, default=None,
+                        help='rows drawn with replacement from the data, default all rows as is')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the split and the draw')
+    parser.add_argument('--output', default='learner_results.json', help='path of the JSON results')
+    args = parser.parse_args()
+
+    if args.rows is None:
+        x_data, t_data, y_data = read_and_transform_data(args.data)
+        x_data, t_data, y_data = np.asarray(x_data, dtype=float), np.asarray(t_data), np.asarray(y_data)
+    else:
+        x_data, t_data, y_data = make_data(args.rows, args.seed, data_path=args.data)
+
+    learner_records = benchmark_learners(x_data, t_data, y_data, args.learners, seed=args.seed)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': _environment(), 'n_rows': len(y_data), 'seed': args.seed,
+                   'results': learner_records}, f, indent=2)
+    print(f'Results saved to {args.output}')
@@ -0,0 +1,278 @@
+"""
+This module estimates ATE, ATT and ATC by matching units on their covariates, the scaled
+one-hot design of `read_and_transform_data`, rather than on a propensity score.
+
+Distances are Mahalanobis distances under the covariance of the design, computed as
+Euclidean distances after whitening the design once: directions of (near) zero variance,
+such as one-hot columns implied by the others, are left out, so the covariance need not be
+invertible. With metric='euclidean' the scaled design is used as is.
+
+Each arm is indexed once and the index serves every query against it: the treated units
+are matched to the control index for the ATT and the control units to the treated index
+for the ATC. No distance matrix is formed. The indexes are:
+    - 'ball_tree' and 'kd_tree': sklearn trees returning the exact nearest neighbours;
+      ball trees cope better with the tens of dimensions of the design.
+    - 'hnsw': an approximate HNSW graph (optional hnswlib dependency), much faster on large
+      cohorts; `ef_search` trades speed for recall, exact as it approaches the pool size.
+    - 'brute': exact search comparing each batch of queries with the whole pool.
+
+Queries run in batches of `batch_size` rows on `n_jobs` threads, so memory beyond the
+whitened design and the matches is bounded by the batch size.
+
+Each unit is compared with the mean outcome of its `n_matches` nearest units of the other
+arm. With a caliper, matches further than the caliper (in distance units) are discarded,
+and units left without any match are not counted in the measures.
+
+Classes:
+    CovariateMatcher(metric='mahalanobis', index='ball_tree', n_jobs=1, batch_size=4096,
+                     ef_search=200, ef_construction=200, m=16, seed=0):
+        Whitening and per-arm nearest-neighbour indexes, fitted once and queried in batches.
+
+Functions:
+    calculate_measures_covariate_matching(x, t, y, n_matches=1, caliper=None,
+                                          metric='mahalanobis', index='ball_tree', n_jobs=1,
+                                          batch_size=4096, ef_search=200):
+        Calculate ATE, ATT, and ATC using covariate matching.
+
+Usage:
+    python covariate_matching.py --index hnsw --n-matches 3 --caliper 2.0 --n-jobs 8
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from profiling import profiled, stage
+from utils import read_and_transform_data, as_design_matrix, measures_from_effects, bci
+
+MATCHING_METRICS = ('mahalanobis', 'euclidean')
+MATCHING_INDEXES = ('ball_tree', 'kd_tree', 'hnsw', 'brute')
+
+# Eigenvalues below this fraction of the largest are treated as zero variance
+_RANK_TOLERANCE = 1e-10
+
+
+def _whitening(x):
+    """
+    Calculate the mean of the design and a matrix mapping centred rows to coordinates in
+    which Euclidean distances are Mahalanobis distances, without densifying a sparse design.
+    """
+    n = x.shape[0]
+    mean = np.asarray(x.mean(axis=0)).ravel()
+    if sp.issparse(x):
+        second_moment = np.asarray((x.T @ x).todense()) / n
+    else:
+        second_moment = x.T @ x / n
+    covariance = second_moment - np.outer(mean, mean)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    keep = eigenvalues > _RANK_TOLERANCE * max(eigenvalues.max(), 0.0)
+    return mean, eigenvectors[:, keep] / np.sqrt(eigenvalues[keep])
+
+
+class CovariateMatcher:
+    """
+    Nearest-neighbour indexes of the treated and control units on their covariates.
+    Parameters:
+    metric (str): 'mahalanobis' or 'euclidean'.
+    index (str): 'ball_tree', 'kd_tree', 'hnsw' or 'brute'.
+    n_jobs (int): Number of threads running query batches, -1 uses all cores.
+    batch_size (int): Number of query rows per batch.
+    ef_search (int): Candidate list size of HNSW queries; higher means higher recall.
+    ef_construction (int): Candidate list size when building the HNSW graph.
+    m (int): Number of links per node of the HNSW graph.
+    seed (int): Seed of the HNSW graph construction.
+
+    Attributes:
+    mean_ (np.ndarray), transform_ (np.ndarray): Centring and whitening of the design.
+    indexes_ (dict): Index of each arm, keyed by treatment value.
+    unit_indices_ (dict): Positions of the units of each arm in the fitted design.
+    """
+
+    def __init__(self, metric='mahalanobis', index='ball_tree', n_jobs=1, batch_size=4096,
+                 ef_search=200, ef_construction=200, m=16, seed=0):
+        if metric not in MATCHING_METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {MATCHING_METRICS}")
+        if index not in MATCHING_INDEXES:
+            raise ValueError(f"Unknown matching index '{index}', expected one of {MATCHING_INDEXES}")
+        self.metric = metric
+        self.index = index
+        self.n_jobs = (os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+        self.batch_size = batch_size
+        self.ef_search = ef_search
+        self.ef_construction = ef_construction
+        self.m = m
+        self.seed = seed
+
+    def _coordinates(self, x):
+        """
+        Map design rows to the space in which the indexes measure distances.
+        """
+        if self.metric == 'euclidean':
+            return x.toarray() if sp.issparse(x) else np.asarray(x)
+        return np.asarray(x @ self.transform_) - self.mean_ @ self.transform_
+
+    def _build_index(self, points):
+        if self.index != 'hnsw':
+            return NearestNeighbors(algorithm=self.index).fit(points)
+
+        # pylint: disable=import-outside-toplevel
+        import hnswlib
+
+        graph = hnswlib.Index(space='l2', dim=points.shape[1])
+        graph.init_index(max_elements=len(points), ef_construction=self.ef_construction,
+                         M=self.m, random_seed=self.seed)
+        graph.add_items(points, num_threads=self.n_jobs)
+        graph.set_ef(self.ef_search)
+        return graph
+
+    @profiled('covariate_index_fit')
+    def fit(self, x, t):
+        """
+        Whiten the design and index the units of each arm.
+        Parameters:
+        x (pd.DataFrame, np.ndarray or sp.csr_matrix): Scaled design matrix.
+        t (pd.Series or np.ndarray): Treatment indicator (1 for treated, 0 for control).
+        Returns:
+        CovariateMatcher: The fitted matcher.
+        """
+        x = as_design_matrix(x)
+        t = np.asarray(t)
+        if self.metric == 'mahalanobis':
+            self.mean_, self.transform_ = _whitening(x)
+
+        self.points_ = np.ascontiguousarray(self._coordinates(x), dtype=np.float64)
+        self.unit_indices_ = {arm: np.nonzero(t == arm)[0] for arm in (0, 1)}
+        self.indexes_ = {arm: self._build_index(self.points_[indices])
+                         for arm, indices in self.unit_indices_.items()}
+        return self
+
+    def _query(self, arm, points, n_neighbors):
+        index = self.indexes_[arm]
+        if self.index == 'hnsw':
+            # Queries of a batch run on the calling thread; batches are spread over threads
+            labels, squared_distances = index.knn_query(points, k=n_neighbors, num_threads=1)
+            return np.sqrt(np.maximum(squared_distances, 0.0)), labels.astype(np.int64)
+        return index.kneighbors(points, n_neighbors=n_neighbors)
+
+    def kneighbors(self, query_indices, arm, n_neighbors):
+        """
+        Find the nearest units of an arm for fitted units, in batches on several threads.
+        Parameters:
+        query_indices (np.ndarray): Positions of the query units in the fitted design.
+        arm (int): Treatment value of the units to match against.
+        n_neighbors (int): Number of neighbours per query unit.
+        Returns:
+        tuple: Distances, shape (m, n_neighbors), ascending, and positions of the
+            neighbours in the fitted design.
+        """
+        pool = self.unit_indices_[arm]
+        if n_neighbors > len(pool):
+            raise ValueError(f'Expected n_neighbors <= {len(pool)} units of arm {arm}, '
+                             f'got {n_neighbors}')
+
+        batches = [query_indices[start:start + self.batch_size]
+                   for start in range(0, len(query_indices), self.batch_size)]
+        with stage('covariate_neighbour_search', queries=len(query_indices), pool=len(pool),
+                   index=self.index):
+            if self.n_jobs == 1 or len(batches) == 1:
+                results = [self._query(arm, self.points_[batch], n_neighbors) for batch in batches]
+            else:
+                with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+                    results = list(executor.map(
+                        lambda batch: self._query(arm, self.points_[batch], n_neighbors), batches))
+
+        if not results:
+            return np.empty((0, n_neighbors)), np.empty((0, n_neighbors), dtype=np.int64)
+        distances = np.concatenate([batch_distances for batch_distances, _ in results])
+        neighbours = np.concatenate([batch_neighbours for _, batch_neighbours in results])
+        return distances, pool[neighbours]
+
+
+def _matched_effects(matcher, y, query_indices, arm, n_matches, caliper):
+    """
+    Compare every query unit with the mean outcome of its matches in `arm`.
+    Returns:
+    np.ndarray: y of each matched query unit minus the mean outcome of its matches within
+        the caliper; query units without such matches are left out.
+    """
+    distances, matched_indices = matcher.kneighbors(query_indices, arm, n_matches)
+    within = np.ones(distances.shape, dtype=bool) if caliper is None else distances <= caliper
+    n_within = within.sum(axis=1)
+    matched = n_within > 0
+
+    matched_outcomes = np.where(within, y[matched_indices], 0.0).sum(axis=1)
+    return y[query_indices[matched]] - matched_outcomes[matched] / n_within[matched]
+
+
+@profiled()
+def calculate_measures_covariate_matching(x, t, y, n_matches=1, caliper=None,
+                                          metric='mahalanobis', index='ball_tree', n_jobs=1,
+                                          batch_size=4096, ef_search=200):
+    """
+    Calculate Average Treatment Effect (ATE), Average Treatment Effect on the Treated (ATT),
+    and Average Treatment Effect on the Control (ATC) using covariate matching.
+    Parameters:
+    x (pd.DataFrame, np.ndarray or sp.csr_matrix): Scaled design matrix.
+    t (pd.Series or np.ndarray): Treatment indicator (1 for treated, 0 for control).
+    y (pd.Series or np.ndarray): Outcome variable.
+    n_matches (int): Number of nearest units of the other arm matched to each unit.
+    caliper (float or None): Largest distance of a match, None for no limit.
+    metric (str): 'mahalanobis' or 'euclidean'.
+    index (str): 'ball_tree', 'kd_tree', 'hnsw' or 'brute'.
+    n_jobs (int): Number of threads running query batches, -1 uses all cores.
+    batch_size (int): Number of query rows per batch.
+    ef_search (int): Candidate list size of HNSW queries, the recall knob of index='hnsw'.
+    Returns:
+    tuple: A tuple containing:
+        - ate (float): Average Treatment Effect.
+        - att (float): Average Treatment Effect on the Treated.
+        - atc (float): Average Treatment Effect on the Control.
+    """
+    y = np.asarray(y, dtype=float)
+    matcher = CovariateMatcher(metric=metric, index=index, n_jobs=n_jobs, batch_size=batch_size,
+                               ef_search=ef_search).fit(x, t)
+
+    # Both passes query the arm indexes built once above
+    att_effects = _matched_effects(matcher, y, matcher.unit_indices_[1], 0, n_matches, caliper)
+    atc_effects = -_matched_effects(matcher, y, matcher.unit_indices_[0], 1, n_matches, caliper)
+
+    return measures_from_effects(att_effects, atc_effects)
+
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+                         'processed_data.csv')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the effects by covariate matching.')
+    parser.add_argument('--data', default=DATA_PATH, help='path of the processed data')
+    parser.add_argument('--n-matches', type=int, default=1, help='matches per unit')
+    parser.add_argument('--caliper', type=float, default=None,
+                        help='largest distance of a match, in Mahalanobis units')
+    parser.add_argument('--metric', default='mahalanobis', choices=list(MATCHING_METRICS))
+    parser.add_argument('--index', default='ball_tree', choices=list(MATCHING_INDEXES))
+    parser.add_argument('--n-jobs', type=int, default=1, help='query threads, -1 for all cores')
+    parser.add_argument('--num-bootstrap', type=int, default=1000,
+                        help='bootstrap replicates, 0 to skip intervals')
+    args = parser.parse_args()
+
+    x_data, t_data, y_data = read_and_transform_data(args.data)
+    settings = {'n_matches': args.n_matches, 'caliper': args.caliper, 'metric': args.metric,
+                'index': args.index, 'n_jobs': args.n_jobs}
+
+    ate_data, att_data, atc_data = calculate_measures_covariate_matching(x_data, t_data, y_data,
+                                                                         **settings)
+    print(f'ATE (Covariate matching): {ate_data:.4f}')
+    print(f'ATT (Covariate matching): {att_data:.4f}')
+    print(f'ATC (Covariate matching): {atc_data:.4f}')
+
+    if args.num_bootstrap:
+        ate_ci, att_ci, atc_ci = bci(x_data, t_data, y_data, calculate_measures_covariate_matching,
+                                     num_bootstrap=args.num_bootstrap, **settings)[:3]
+        print(f'ATE 95% CI: {ate_ci}')
+        print(f'ATT 95% CI: {att_ci}')
+        print(f'ATC 95% CI: {atc_ci}')
@@ -2,8 +2,10 @@
 This module provides functions to perform doubly robust estimation for causal inference.
 
 Functions:
-    fit_outcome_models(x, t, y):
-        Fits outcome models for treated and control groups using Gradient Boosting Classifier.
+    fit_outcome_models(x, t, y, cache=None, sample_weight=None, learner=OUTCOME_LEARNER):
+        Fits outcome models for treated and control groups using Gradient Boosting Classifier
+        or another registered learner.
+        Defined in utils and shared with the T-learner.
 
         Parameters:
             x (pd.DataFrame or np.ndarray): Feature matrix.
@@ -11,10 +13,28 @@ Functions:
             y (pd.Series or np.ndarray): Outcome variable.
 
         Returns:
-            model_1 (GradientBoostingClassifier): Fitted model for the treated group.
-            model_0 (GradientBoostingClassifier): Fitted model for the control group.
+            model_1 (sklearn classifier): Fitted model for the treated group.
+            model_0 (sklearn classifier): Fitted model for the control group.
 
-    calculate_measures_doubly_robust(x, t, y):
+    cross_fit_nuisances(x, t, y, n_folds=5, n_jobs=1, seed=42, sample_weight=None,
+                        propensity_learner=PROPENSITY_LEARNER, outcome_learner=OUTCOME_LEARNER):
+        Fits the propensity and outcome models on K-1 folds and predicts the held-out fold,
+        running the folds concurrently in a process pool.
+
+        Returns:
+            e (np.ndarray): Out-of-fold propensity scores.
+            y_pred_1 (np.ndarray): Out-of-fold predictions of the treated outcome model.
+            y_pred_0 (np.ndarray): Out-of-fold predictions of the control outcome model.
+
+    doubly_robust_measures(t, y, e, y_pred_1, y_pred_0, sample_weight=None):
+        Calculates ATE, ATT and ATC from given nuisance predictions.
+
+    doubly_robust_influence_scores(t, y, e, y_pred_1, y_pred_0, sample_weight=None):
+        Calculates the influence score of every unit on the ATE, ATT and ATC.
+
+    calculate_measures_doubly_robust(x, t, y, cache=None, sample_weight=None, n_folds=None, n_jobs=1,
+                                     propensity_learner=PROPENSITY_LEARNER,
+                                     outcome_learner=OUTCOME_LEARNER, analytic=False, ci_level=95):
         Calculates the Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
         and Average Treatment effect on the Controls (ATC) using doubly robust estimation.
 
@@ -22,72 +42,235 @@ Functions:
             x (pd.DataFrame or np.ndarray): Feature matrix.
             t (pd.Series or np.ndarray): Treatment indicator (1 for treated, 0 for control).
             y (pd.Series or np.ndarray): Outcome variable.
+            cache (NuisanceCache or None): Cache of fitted nuisance models.
+            sample_weight (np.ndarray or None): Weights of the units.
+            n_folds (int or None): Number of cross-fitting folds, None to fit and predict
+                on the full data.
+            n_jobs (int): Number of worker processes fitting the folds, -1 uses all cores.
+            propensity_learner (str or dict): Learner spec of the propensity model.
+            outcome_learner (str or dict): Learner spec of the outcome models.
+            analytic (bool): Also return influence-function standard errors and CIs.
+            ci_level (float): Confidence interval level in analytic mode.
 
         Returns:
             ate (float): Average Treatment Effect.
             att (float): Average Treatment effect on the Treated.
             atc (float): Average Treatment effect on the Controls.
+            In analytic mode, the tuples (ate, att, atc), (ate_se, att_se, atc_se) and
+            (ate_ci, att_ci, atc_ci).
 """
 
-from sklearn.ensemble import GradientBoostingClassifier
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from utils import read_and_transform_data, calculate_propensity_scores, bci
+from sklearn.model_selection import StratifiedKFold
+
+from learners import PROPENSITY_LEARNER, OUTCOME_LEARNER
+from profiling import profiled, stage
+from utils import (read_and_transform_data, calculate_propensity_scores, fit_outcome_models, bci,
+                   fit_propensity_model, predict_propensity_scores, ratio_influence_scores,
+                   influence_intervals, as_design_matrix, take_rows)
+
+# Per-process state of the cross-fitting workers, populated once by _init_cross_fit_worker
+_CROSS_FIT_STATE = {}
+
+
+def _init_cross_fit_worker(x, t, y, sample_weight, propensity_learner, outcome_learner):
+    """
+    Store the data in the worker process, so it is sent once rather than with every fold.
+    """
+    _CROSS_FIT_STATE.update(x=x, t=t, y=y, sample_weight=sample_weight,
+                            propensity_learner=propensity_learner, outcome_learner=outcome_learner)
+
 
-def fit_outcome_models(x, t, y):
+@profiled('cross_fit_fold')
+def _fit_fold(train_indices, test_indices):
     """
-    Fits outcome models for treated and control groups using Gradient Boosting Classifier.
+    Fit the nuisance models on the training rows and predict the held-out rows.
+    """
+    state = _CROSS_FIT_STATE
+    x_train = take_rows(state['x'], train_indices)
+    t_train = np.take(state['t'], train_indices)
+    y_train = np.take(state['y'], train_indices)
+    w_train = None if state['sample_weight'] is None else np.take(state['sample_weight'], train_indices)
+
+    propensity_model = fit_propensity_model(x_train, t_train, sample_weight=w_train,
+                                            learner=state['propensity_learner'])
+    model_1, model_0 = fit_outcome_models(x_train, t_train, y_train, sample_weight=w_train,
+                                          learner=state['outcome_learner'])
+
+    x_test = take_rows(state['x'], test_indices)
+    return (predict_propensity_scores(propensity_model, x_test),
+            model_1.predict(x_test), model_0.predict(x_test))
+
+
+@profiled()
+def cross_fit_nuisances(x, t, y, n_folds=5, n_jobs=1, seed=42, sample_weight=None,
+                        propensity_learner=PROPENSITY_LEARNER, outcome_learner=OUTCOME_LEARNER):
+    """
+    Estimate the propensity scores and the outcome predictions out of fold.
+
+    The rows are split into `n_folds` folds stratified by treatment. For each fold, the
+    propensity and outcome models are fitted on the other folds and predict the rows of
+    the fold, so no row is predicted by a model that saw it. Folds are fitted concurrently
+    in `n_jobs` worker processes, each receiving the data once.
     Parameters:
-    x (numpy.ndarray or pandas.DataFrame): Feature matrix.
-    t (numpy.ndarray or pandas.Series): Treatment indicator (1 for treated, 0 for control).
-    y (numpy.ndarray or pandas.Series): Outcome variable.
+    x (pd.DataFrame or np.ndarray): Feature matrix.
+    t (pd.Series or np.ndarray): Treatment assignment vector (binary).
+    y (pd.Series or np.ndarray): Outcome vector.
+    n_folds (int): Number of folds, at least 2.
+    n_jobs (int): Number of worker processes, -1 uses all cores.
+    seed (int): Seed of the fold split.
+    sample_weight (np.ndarray or None): Weights of the units in the fits.
+    propensity_learner (str or dict): Learner spec of the propensity model (see learners.py).
+    outcome_learner (str or dict): Learner spec of the outcome models (see learners.py).
     Returns:
-    tuple: A tuple containing two fitted Gradient Boosting Classifier models:
-        - model_1: Fitted model for the treated group.
-        - model_0: Fitted model for the control group.
+    tuple: Out-of-fold propensity scores and treated and control outcome predictions.
     """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
+    x = as_design_matrix(x)
+    t = np.ascontiguousarray(t)
+    y = np.ascontiguousarray(y)
+    if sample_weight is not None:
+        sample_weight = np.ascontiguousarray(sample_weight, dtype=float)
 
-    x_1 = x[t == 1]
-    x_0 = x[t == 0]
-    y_1 = y[t == 1]
-    y_0 = y[t == 0]
+    folds = list(StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed).split(t, t))
+    train_indices, test_indices = zip(*folds)
 
-    model_1 = GradientBoostingClassifier(random_state=42)
-    model_1.fit(x_1, y_1)
+    if n_jobs == 1:
+        _init_cross_fit_worker(x, t, y, sample_weight, propensity_learner, outcome_learner)
+        try:
+            predictions = list(map(_fit_fold, train_indices, test_indices))
+        finally:
+            _CROSS_FIT_STATE.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, n_folds), initializer=_init_cross_fit_worker,
+                                 initargs=(x, t, y, sample_weight, propensity_learner,
+                                           outcome_learner)) as executor:
+            predictions = list(executor.map(_fit_fold, train_indices, test_indices))
 
-    model_0 = GradientBoostingClassifier(random_state=42)
-    model_0.fit(x_0, y_0)
+    e = np.empty(len(y), dtype=float)
+    y_pred_1 = np.empty(len(y), dtype=float)
+    y_pred_0 = np.empty(len(y), dtype=float)
+    for test, (e_fold, y_pred_1_fold, y_pred_0_fold) in zip(test_indices, predictions):
+        e[test] = e_fold
+        y_pred_1[test] = y_pred_1_fold
+        y_pred_0[test] = y_pred_0_fold
 
-    return model_1, model_0
+    return e, y_pred_1, y_pred_0
 
 
-def calculate_measures_doubly_robust(x, t, y):
+def doubly_robust_measures(t, y, e, y_pred_1, y_pred_0, sample_weight=None):
     """
-    Calculate the Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
-    and Average Treatment effect on the Controls (ATC) using a doubly robust estimator.
+    Calculate the ATE, ATT and ATC from propensity scores and outcome predictions.
     Parameters:
-    x (numpy.ndarray): Covariates/features matrix.
     t (numpy.ndarray): Treatment assignment vector (binary).
     y (numpy.ndarray): Outcome vector.
+    e (numpy.ndarray): Propensity scores.
+    y_pred_1 (numpy.ndarray): Predicted outcomes under treatment.
+    y_pred_0 (numpy.ndarray): Predicted outcomes under control.
+    sample_weight (numpy.ndarray or None): Weights of the units in the sums.
     Returns:
     tuple: A tuple containing the ATE, ATT, and ATC.
     """
+    w = np.ones(len(y)) if sample_weight is None else sample_weight
+    n = np.sum(w)
 
-    n = len(y)
+    g_1_score = y_pred_1 + (t / e) * (y - y_pred_1)
+    g_0_score = y_pred_0 + ((1 - t) / (1 - e)) * (y - y_pred_0)
 
-    e = calculate_propensity_scores(x, t)
-    model_1, model_0 = fit_outcome_models(x, t, y)
+    ate = np.sum(w * g_1_score) / n - np.sum(w * g_0_score) / n
+    att = np.sum(w * (t * y - ((t - e) * y_pred_0 / (1 - e)))) / np.sum(w * t)
+    atc = np.sum(w * ((1 - e) * t * y / e - ((t - e) * y_pred_1 / e) - ((1 - t) * y))) / np.sum(w * (1 - t))
 
-    y_pred_all_1 = model_1.predict(x)
-    y_pred_all_0 = model_0.predict(x)
+    return ate, att, atc
 
-    g_1_score = y_pred_all_1 + (t / e) * (y - y_pred_all_1)
-    g_0_score = y_pred_all_0 + ((1 - t) / (1 - e)) * (y - y_pred_all_0)
 
-    ate = np.sum(g_1_score) / n - np.sum(g_0_score) / n
-    att = np.sum(t * y - ((t - e) * y_pred_all_0 / (1 - e))) / np.sum(t)
-    atc = np.sum((1 - e) * t * y / e - ((t - e) * y_pred_all_1 / e) - ((1 - t) * y)) / np.sum(1 - t)
+def doubly_robust_influence_scores(t, y, e, y_pred_1, y_pred_0, sample_weight=None):
+    """
+    Calculate the influence score of every unit on the doubly robust ATE, ATT and ATC.
+    Each measure is a ratio of weighted sums of per-unit terms, so the scores follow from
+    the terms in one pass over the units.
+    Parameters:
+    t (numpy.ndarray): Treatment assignment vector (binary).
+    y (numpy.ndarray): Outcome vector.
+    e (numpy.ndarray): Propensity scores.
+    y_pred_1 (numpy.ndarray): Predicted outcomes under treatment.
+    y_pred_0 (numpy.ndarray): Predicted outcomes under control.
+    sample_weight (numpy.ndarray or None): Weights of the units in the sums.
+    Returns:
+    tuple: Influence scores of the ATE, ATT and ATC.
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
 
-    return ate, att, atc
+    g_scores = (y_pred_1 + (t / e) * (y - y_pred_1)) - (y_pred_0 + ((1 - t) / (1 - e)) * (y - y_pred_0))
+    _, ate_scores = ratio_influence_scores(g_scores, np.ones(len(y)), sample_weight)
+    _, att_scores = ratio_influence_scores(t * y - ((t - e) * y_pred_0 / (1 - e)), t, sample_weight)
+    _, atc_scores = ratio_influence_scores((1 - e) * t * y / e - ((t - e) * y_pred_1 / e) - ((1 - t) * y),
+                                           1 - t, sample_weight)
+
+    return ate_scores, att_scores, atc_scores
+
+
+@profiled()
+def calculate_measures_doubly_robust(x, t, y, cache=None, sample_weight=None, n_folds=None, n_jobs=1,
+                                     propensity_learner=PROPENSITY_LEARNER,
+                                     outcome_learner=OUTCOME_LEARNER, analytic=False, ci_level=95):
+    """
+    Calculate the Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
+    and Average Treatment effect on the Controls (ATC) using a doubly robust estimator.
+
+    With `n_folds`, the nuisance models are cross-fitted: their predictions come from
+    `cross_fit_nuisances`, and the same out-of-fold predictions give all three measures.
+    Parameters:
+    x (numpy.ndarray): Covariates/features matrix.
+    t (numpy.ndarray): Treatment assignment vector (binary).
+    y (numpy.ndarray): Outcome vector.
+    cache (NuisanceCache or None): Cache of fitted nuisance models, None to always refit.
+        Not used when cross-fitting, as every fold fits its own models.
+    sample_weight (numpy.ndarray or None): Weights of the units in the fits and the sums.
+    n_folds (int or None): Number of cross-fitting folds, None to fit and predict on all rows.
+    n_jobs (int): Number of worker processes fitting the folds, -1 uses all cores.
+    propensity_learner (str or dict): Learner spec of the propensity model (see learners.py).
+    outcome_learner (str or dict): Learner spec of the outcome models (see learners.py).
+    analytic (bool): Also return standard errors and confidence intervals computed from the
+        influence score of every unit, instead of bootstrapping. They are best justified
+        with cross-fitted nuisance models.
+    ci_level (float): Confidence interval level in analytic mode (e.g., 95 for 95% CI).
+    Returns:
+    tuple: A tuple containing the ATE, ATT, and ATC. In analytic mode, the tuples
+        (ate, att, atc), (ate_se, att_se, atc_se) and (ate_ci, att_ci, atc_ci).
+    """
+    x = as_design_matrix(x)
+    t = np.asarray(t)
+    y = np.asarray(y)
+
+    if n_folds is not None:
+        e, y_pred_all_1, y_pred_all_0 = cross_fit_nuisances(
+            x, t, y, n_folds=n_folds, n_jobs=n_jobs, sample_weight=sample_weight,
+            propensity_learner=propensity_learner, outcome_learner=outcome_learner)
+    else:
+        e = calculate_propensity_scores(x, t, cache=cache, sample_weight=sample_weight,
+                                        learner=propensity_learner)
+        model_1, model_0 = fit_outcome_models(x, t, y, cache=cache, sample_weight=sample_weight,
+                                              learner=outcome_learner)
+
+        with stage('outcome_predict', rows=x.shape[0]):
+            y_pred_all_1 = model_1.predict(x)
+            y_pred_all_0 = model_0.predict(x)
+
+    estimates = doubly_robust_measures(t, y, e, y_pred_all_1, y_pred_all_0, sample_weight=sample_weight)
+    if not analytic:
+        return estimates
+
+    scores = doubly_robust_influence_scores(t, y, e, y_pred_all_1, y_pred_all_0,
+                                            sample_weight=sample_weight)
+    standard_errors, intervals = influence_intervals(scores, estimates, ci_level, sample_weight)
+    return estimates, standard_errors, intervals
 
 DATA_PATH = '/Users/gurkeinan/semester6/Causal-Inference/Project/code/data/processed_data.csv'
 
@@ -0,0 +1,209 @@
+"""
+This module provides batch scoring of individual treatment effects with fitted learners.
+
+Classes:
+    EffectLearner(transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        Abstract base class of persistable learners predicting individual treatment
+        effects. Subclasses implement `fit` and `_predict_effect_chunk`.
+
+        Methods:
+            predict_effect(x): Predicts the effect of every row, in fixed-size chunks.
+            save(path): Pickles the fitted learner.
+            load(path): Loads a learner stored by `save`.
+
+    MicroBatcher(learner, max_batch_rows=DEFAULT_CHUNK_SIZE):
+        Collects many small scoring requests and scores them together.
+
+Usage:
+    learner = TLearner().fit(x, t, y)
+    learner.save('t_learner.pkl')
+    ...
+    learner = TLearner.load('t_learner.pkl')
+    effects = learner.predict_effect(x_new)
+    print(learner.scoring_stats_['rows_per_second'])
+"""
+
+import pickle
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+from profiling import profiled
+
+DEFAULT_CHUNK_SIZE = 65_536
+
+
+def _take_rows(x, start, stop):
+    """
+    Slice rows of a DataFrame, an array or a CSR matrix, without copying dense data.
+    """
+    if isinstance(x, pd.DataFrame):
+        return x.iloc[start:stop]
+    return x[start:stop]
+
+
+class EffectLearner(ABC):
+    """
+    Base class of learners predicting individual treatment effects.
+
+    Inputs are scored in chunks of `chunk_size` rows written into one preallocated output,
+    so memory beyond the output is bounded by the chunk size. When a fitted `transformer`
+    is given, raw feature rows are transformed chunk by chunk before scoring.
+
+    Parameters:
+    transformer (FeatureTransformer or None): Transformer applied to raw inputs of
+        `predict_effect`, None when inputs are already transformed.
+    chunk_size (int): Number of rows scored at a time.
+
+    Attributes:
+    scoring_stats_ (dict): Rows, seconds and rows per second of the last `predict_effect`
+        call, and the totals since the learner was created.
+    """
+
+    def __init__(self, transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.transformer = transformer
+        self.chunk_size = chunk_size
+        self.scoring_stats_ = {'rows': 0, 'seconds': 0.0, 'rows_per_second': np.nan,
+                               'total_rows': 0, 'total_seconds': 0.0}
+
+    @abstractmethod
+    def fit(self, x, t, y, cache=None, sample_weight=None):
+        """
+        Fit the learner's outcome models.
+        Parameters:
+        x (pd.DataFrame, np.ndarray or sp.csr_matrix): Feature matrix.
+        t (pd.Series or np.ndarray): Treatment indicator (1 for treated, 0 for control).
+        y (pd.Series or np.ndarray): Outcome variable.
+        cache (NuisanceCache or None): Cache of fitted models, None to always refit.
+        sample_weight (np.ndarray or None): Weights of the units in the fit.
+        Returns:
+        EffectLearner: The fitted learner.
+        """
+
+    @abstractmethod
+    def _predict_effect_chunk(self, x):
+        """
+        Predict the individual treatment effects of a chunk of transformed rows.
+        """
+
+    @profiled()
+    def predict_effect(self, x):
+        """
+        Predict the individual treatment effect of every row.
+        Parameters:
+        x (pd.DataFrame, np.ndarray or sp.csr_matrix): Features, raw if the learner has a
+            transformer.
+        Returns:
+        np.ndarray: Predicted effect of every row.
+        """
+        start_time = time.perf_counter()
+
+        n = x.shape[0]
+        effects = np.empty(n, dtype=np.float64)
+        for start in range(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            chunk = _take_rows(x, start, stop)
+            if self.transformer is not None:
+                chunk = self.transformer.transform(chunk)
+            effects[start:stop] = self._predict_effect_chunk(chunk)
+
+        seconds = time.perf_counter() - start_time
+        stats = self.scoring_stats_
+        stats['rows'] = n
+        stats['seconds'] = seconds
+        stats['rows_per_second'] = n / seconds if seconds > 0 else np.nan
+        stats['total_rows'] += n
+        stats['total_seconds'] += seconds
+
+        return effects
+
+    def save(self, path):
+        """
+        Pickle the fitted learner.
+        Parameters:
+        path (str): Destination file.
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a learner stored by `save`.
+        Parameters:
+        path (str): File written by `save`.
+        Returns:
+        EffectLearner: The fitted learner.
+        """
+        with open(path, 'rb') as f:
+            learner = pickle.load(f)
+        if not isinstance(learner, cls):
+            raise TypeError(f'{path} holds a {type(learner).__name__}, not a {cls.__name__}')
+        return learner
+
+
+class MicroBatcher:
+    """
+    Score many small requests in few `predict_effect` calls.
+
+    Each submitted request is queued and answered with a Future. Queued requests are
+    concatenated and scored together once they reach `max_batch_rows` rows, or when
+    `flush` is called.
+
+    Parameters:
+    learner (EffectLearner): Fitted learner.
+    max_batch_rows (int): Number of queued rows that triggers scoring.
+    """
+
+    def __init__(self, learner, max_batch_rows=DEFAULT_CHUNK_SIZE):
+        self.learner = learner
+        self.max_batch_rows = max_batch_rows
+        self._pending = []
+        self._pending_rows = 0
+
+    def submit(self, x):
+        """
+        Queue a request.
+        Parameters:
+        x (pd.DataFrame, np.ndarray or sp.csr_matrix): Rows to score.
+        Returns:
+        Future: Resolves to the predicted effects of the rows of `x`.
+        """
+        future = Future()
+        self._pending.append((x, future))
+        self._pending_rows += x.shape[0]
+        if self._pending_rows >= self.max_batch_rows:
+            self.flush()
+        return future
+
+    def flush(self):
+        """
+        Score all queued requests and resolve their futures.
+        """
+        if not self._pending:
+            return
+        requests, self._pending, self._pending_rows = self._pending, [], 0
+
+        inputs = [x for x, _ in requests]
+        if isinstance(inputs[0], pd.DataFrame):
+            batch = pd.concat(inputs, ignore_index=True)
+        elif sp.issparse(inputs[0]):
+            batch = sp.vstack(inputs, format='csr')
+        else:
+            batch = np.concatenate(inputs)
+
+        try:
+            effects = self.learner.predict_effect(batch)
+        except Exception as error:  # pylint: disable=broad-except
+            for _, future in requests:
+                future.set_exception(error)
+            return
+
+        offset = 0
+        for x, future in requests:
+            future.set_result(effects[offset:offset + x.shape[0]])
+            offset += x.shape[0]
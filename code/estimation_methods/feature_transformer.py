@@ -0,0 +1,281 @@
+"""
+This module provides a fitted, persistable version of the feature transformation
+of `utils.read_and_transform_data`.
+
+The transformer learns the scaling of the numerical columns and the categories of the
+categorical columns once, so new batches of students are transformed into the same
+column layout, whatever categories they contain.
+
+Classes:
+    FeatureTransformer(numerical_columns=NUMERICAL_COLUMNS, drop_columns=DROP_COLUMNS):
+        Scales numerical columns and one-hot encodes categorical columns,
+        dropping the first category of each.
+
+        Methods:
+            fit(x): Learns the scaling and the categories from a feature dataframe.
+            transform(x, as_frame=True, sparse=False): Transforms a feature dataframe into
+                the fitted layout, optionally as a SciPy CSR matrix.
+            fit_transform(x): Fits and transforms the same dataframe.
+            partition_statistics(x): Summarizes a part of the data for fit_from_statistics.
+            fit_from_statistics(statistics): Fits on the union of summarized parts.
+            save(path): Stores the fitted transformer as JSON.
+            load(path): Loads a transformer stored by `save`.
+
+Usage:
+    transformer = FeatureTransformer()
+    x, t, y = read_and_transform_data(DATA_PATH, transformer=transformer)
+    transformer.save('transformer.json')
+    ...
+    x_new, t_new, y_new = read_and_transform_data(NEW_DATA_PATH,
+                                                  transformer=FeatureTransformer.load('transformer.json'))
+"""
+
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+from sklearn.preprocessing import StandardScaler
+
+NUMERICAL_COLUMNS = ('Previous qualification (grade)', 'Admission grade',
+                     'Unemployment rate', 'Inflation rate', 'GDP')
+DROP_COLUMNS = ('Application mode_39',)
+
+
+class FeatureTransformer:
+    """
+    Scale numerical columns and one-hot encode categorical columns with a fixed layout.
+
+    The output has the numerical columns first, followed by one indicator per category
+    except the first (sorted) category of each categorical column, in input column order,
+    as `pd.get_dummies(..., drop_first=True)` does. Categories not seen during fit and
+    missing values get all-zero indicators, and missing numerical values are imputed with
+    the training mean.
+
+    Parameters:
+    numerical_columns (sequence of str): Columns to standardize; all other columns are
+        treated as categorical.
+    drop_columns (sequence of str): Output columns to omit.
+
+    Attributes:
+    feature_names_ (list of str): Names of the output columns.
+    column_index_ (dict): Position of every output column, e.g. to address columns of
+        the sparse output.
+    """
+
+    def __init__(self, numerical_columns=NUMERICAL_COLUMNS, drop_columns=DROP_COLUMNS):
+        self.numerical_columns = list(numerical_columns)
+        self.drop_columns = list(drop_columns)
+
+    def fit(self, x):
+        """
+        Learn the scaling and the categories of a feature dataframe.
+        Parameters:
+        x (pd.DataFrame): Features, without the treatment and target columns.
+        Returns:
+        FeatureTransformer: The fitted transformer.
+        """
+        scaler = StandardScaler().fit(x[self.numerical_columns])
+        self.mean_ = scaler.mean_.tolist()
+        self.scale_ = scaler.scale_.tolist()
+
+        self.categorical_columns_ = [col for col in x.columns if col not in self.numerical_columns]
+        self.categories_ = {}
+        for col in self.categorical_columns_:
+            categories = sorted(x[col].dropna().unique().tolist())
+            # The first category is the baseline; dropped output columns become baseline too
+            self.categories_[col] = [cat for cat in categories[1:]
+                                     if f'{col}_{cat}' not in self.drop_columns]
+
+        return self.set_state(self.get_state())
+
+    def partition_statistics(self, x):
+        """
+        Summarize a part of the data: count, mean and sum of squared deviations of every
+        numerical column, and the categories of every other column. Summaries of the parts
+        of a dataset combine into the fit of the whole in `fit_from_statistics`.
+        Parameters:
+        x (pd.DataFrame): Features, without the treatment and target columns.
+        Returns:
+        dict: JSON-serializable summary.
+        """
+        numerical = x[self.numerical_columns].to_numpy(dtype=np.float64)
+        counts = np.sum(~np.isnan(numerical), axis=0)
+        means = np.nansum(numerical, axis=0) / np.maximum(counts, 1)
+        squared_deviations = np.nansum((numerical - means) ** 2, axis=0)
+
+        return {
+            'count': counts.tolist(),
+            'mean': means.tolist(),
+            'squared_deviations': squared_deviations.tolist(),
+            'categories': {col: sorted(x[col].dropna().unique().tolist())
+                           for col in x.columns if col not in self.numerical_columns},
+        }
+
+    def fit_from_statistics(self, statistics):
+        """
+        Fit the transformer on the union of the parts summarized by `partition_statistics`,
+        as `fit` would on their concatenation, up to floating-point rounding.
+        Parameters:
+        statistics (list of dict): Summaries of the parts, with the same columns.
+        Returns:
+        FeatureTransformer: The fitted transformer.
+        """
+        counts = np.array([part['count'] for part in statistics], dtype=np.float64)
+        means = np.array([part['mean'] for part in statistics])
+        total = counts.sum(axis=0)
+        mean = (counts * means).sum(axis=0) / total
+        # Pooled sum of squared deviations (Chan et al.)
+        squared_deviations = (np.array([part['squared_deviations'] for part in statistics]).sum(axis=0)
+                              + (counts * (means - mean) ** 2).sum(axis=0))
+        scale = np.sqrt(squared_deviations / total)
+        self.mean_ = mean.tolist()
+        # Constant columns are left unscaled, as StandardScaler does
+        self.scale_ = np.where(scale == 0, 1.0, scale).tolist()
+
+        self.categorical_columns_ = list(statistics[0]['categories'])
+        self.categories_ = {}
+        for col in self.categorical_columns_:
+            categories = sorted(set().union(*(part['categories'][col] for part in statistics)))
+            self.categories_[col] = [cat for cat in categories[1:]
+                                     if f'{col}_{cat}' not in self.drop_columns]
+
+        return self.set_state(self.get_state())
+
+    def _build_indexes(self):
+        self._category_indexes = {col: pd.Index(cats) for col, cats in self.categories_.items()}
+
+    def transform(self, x, as_frame=True, sparse=False):
+        """
+        Transform a feature dataframe into the fitted column layout.
+        Parameters:
+        x (pd.DataFrame): Features with the columns seen during fit; extra columns are ignored.
+        as_frame (bool): Return a DataFrame with named columns, or a plain array.
+        sparse (bool): Return a SciPy CSR matrix, storing only the numerical values and
+            the set indicators; `as_frame` is then ignored.
+        Returns:
+        pd.DataFrame, np.ndarray or sp.csr_matrix: float64 matrix of shape
+            (len(x), len(feature_names_)).
+        """
+        if sparse:
+            return self._transform_sparse(x)
+
+        n = len(x)
+        out = np.zeros((n, len(self.feature_names_)), dtype=np.float64)
+
+        numerical = x[self.numerical_columns].to_numpy(dtype=np.float64)
+        numerical = (numerical - np.asarray(self.mean_)) / np.asarray(self.scale_)
+        out[:, :len(self.numerical_columns)] = np.nan_to_num(numerical, nan=0.0)
+
+        rows = np.arange(n)
+        offset = len(self.numerical_columns)
+        for col in self.categorical_columns_:
+            index = self._category_indexes[col]
+            # Position of each value among the encoded categories, -1 for the baseline,
+            # unseen and missing values
+            positions = index.get_indexer(x[col].to_numpy())
+            encoded = positions >= 0
+            out[rows[encoded], offset + positions[encoded]] = 1.0
+            offset += len(index)
+
+        if as_frame:
+            return pd.DataFrame(out, columns=self.feature_names_, index=x.index, copy=False)
+        return out
+
+    def _transform_sparse(self, x):
+        n = len(x)
+        n_numerical = len(self.numerical_columns)
+
+        numerical = x[self.numerical_columns].to_numpy(dtype=np.float64)
+        numerical = np.nan_to_num((numerical - np.asarray(self.mean_)) / np.asarray(self.scale_),
+                                  nan=0.0)
+        rows = [np.repeat(np.arange(n), n_numerical)]
+        cols = [np.tile(np.arange(n_numerical), n)]
+        values = [numerical.ravel()]
+
+        offset = n_numerical
+        for col in self.categorical_columns_:
+            index = self._category_indexes[col]
+            positions = index.get_indexer(x[col].to_numpy())
+            encoded = np.nonzero(positions >= 0)[0]
+            rows.append(encoded)
+            cols.append(offset + positions[encoded])
+            values.append(np.ones(len(encoded)))
+            offset += len(index)
+
+        return sp.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n, len(self.feature_names_)))
+
+    def fit_transform(self, x, as_frame=True, sparse=False):
+        """
+        Fit the transformer and transform the same dataframe.
+        """
+        return self.fit(x).transform(x, as_frame=as_frame, sparse=sparse)
+
+    def fingerprint(self):
+        """
+        Hash of the fitted state, identifying the output layout and scaling.
+        """
+        return hashlib.blake2b(json.dumps(self.get_state(), sort_keys=True).encode(),
+                               digest_size=8).hexdigest()
+
+    def get_state(self):
+        """
+        Fitted state of the transformer as a JSON-serializable dict.
+        """
+        return {
+            'numerical_columns': self.numerical_columns,
+            'drop_columns': self.drop_columns,
+            'mean': self.mean_,
+            'scale': self.scale_,
+            'categorical_columns': self.categorical_columns_,
+            'categories': self.categories_,
+        }
+
+    def save(self, path):
+        """
+        Store the fitted transformer as JSON.
+        Parameters:
+        path (str): Destination file.
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_state(), f, indent=2)
+
+    def set_state(self, state):
+        """
+        Restore the fitted state stored by `save`.
+        Parameters:
+        state (dict): Fitted state, as written by `save`.
+        Returns:
+        FeatureTransformer: The fitted transformer.
+        """
+        self.numerical_columns = state['numerical_columns']
+        self.drop_columns = state['drop_columns']
+        self.mean_ = state['mean']
+        self.scale_ = state['scale']
+        self.categorical_columns_ = state['categorical_columns']
+        self.categories_ = state['categories']
+        self.feature_names_ = self.numerical_columns + [
+            f'{col}_{cat}' for col in self.categorical_columns_ for cat in self.categories_[col]]
+        self.column_index_ = {name: i for i, name in enumerate(self.feature_names_)}
+        self._build_indexes()
+        return self
+
+    def is_fitted(self):
+        """
+        Whether the transformer has been fitted or loaded.
+        """
+        return hasattr(self, 'feature_names_')
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a transformer stored by `save`.
+        Parameters:
+        path (str): File written by `save`.
+        Returns:
+        FeatureTransformer: The fitted transformer.
+        """
+        with open(path, encoding='utf-8') as f:
+            return cls().set_state(json.load(f))
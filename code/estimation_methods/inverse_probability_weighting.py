@@ -2,18 +2,34 @@
 This module provides functions to estimate causal effects using Inverse Probability Weighting (IPW).
 
 Functions:
-    calculate_measures_IPW(X, t, y):
+    calculate_measures_ipw(x, t, y, cache=None, sample_weight=None,
+                           propensity_learner=PROPENSITY_LEARNER, analytic=False, ci_level=95):
         Calculates the Average Treatment Effect (ATE),
         Average Treatment effect on the Treated (ATT),
-        and Average Treatment effect on the Controls (ATC) using IPW.
+        and Average Treatment effect on the Controls (ATC) using IPW,
+        with influence-function standard errors and CIs in analytic mode.
 
         Parameters:
             X (array-like): Covariates/features.
             t (array-like): Treatment assignment (binary).
             y (array-like): Outcome variable.
+            cache (NuisanceCache or None): Cache of fitted propensity models.
+            sample_weight (array-like or None): Weights of the units.
+            propensity_learner (str or dict): Learner spec of the propensity model.
+            analytic (bool): Also return standard errors and confidence intervals.
+            ci_level (float): Confidence interval level in analytic mode.
 
         Returns:
-            tuple: A tuple containing ATE, ATT, and ATC.
+            tuple: A tuple containing ATE, ATT, and ATC; in analytic mode, the estimates,
+            their standard errors and their confidence intervals.
+
+    ipw_measures_batch(t, y, e, weights):
+        Calculates ATE, ATT and ATC under every row of a (B x n) weight matrix, holding
+        the propensity scores fixed.
+
+    bootstrap_ipw(x, t, y, num_bootstrap=1000, ci_level=95, seed=None, resampling='indices',
+                  cache=None, propensity_learner=PROPENSITY_LEARNER):
+        Bootstraps the weighting step with one propensity fit, returning what `bci` returns.
 
     read_and_transform_data(filepath):
         Reads and preprocesses the data from the given file path.
@@ -26,11 +42,65 @@ Functions:
             treatment assignment (t), and outcome variable (y).
 """
 
-from utils import read_and_transform_data, calculate_propensity_scores, bci
+import numpy as np
+
+from learners import PROPENSITY_LEARNER
+from profiling import profiled
+from utils import (read_and_transform_data, calculate_propensity_scores, bci, bootstrap_weights,
+                   bootstrap_intervals, ratio_influence_scores, influence_intervals)
+
+# Replicates whose weights are held in memory at a time by bootstrap_ipw
+BOOTSTRAP_BLOCK_SIZE = 256
 
 
+def _ipw_terms(t, y, e):
+    """
+    Per-unit terms of the weighted sums making up the IPW measures, one column per sum:
+    ATE = (s1 - s2) / s0, ATT = s3 / s4 - s5 / s6 and ATC = s7 / s8 - s9 / s10.
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    treated_odds = e / (1 - e)
+    control_odds = (1 - e) / e
+
+    return np.column_stack([
+        np.ones(len(y)),
+        y * t / e, y * (1 - t) / (1 - e),
+        y * t, t,
+        y * (1 - t) * treated_odds, (1 - t) * treated_odds,
+        y * t * control_odds, t * control_odds,
+        y * (1 - t), 1 - t,
+    ])
+
+
+def _measures_from_sums(sums):
+    """
+    ATE, ATT and ATC from the weighted sums of the IPW terms, one row per weighting.
+    """
+    ate = (sums[:, 1] - sums[:, 2]) / sums[:, 0]
+    att = sums[:, 3] / sums[:, 4] - sums[:, 5] / sums[:, 6]
+    atc = sums[:, 7] / sums[:, 8] - sums[:, 9] / sums[:, 10]
+    return np.column_stack([ate, att, atc])
+
 
-def calculate_measures_ipw(x, t, y):
+def ipw_measures_batch(t, y, e, weights):
+    """
+    Calculate the IPW ATE, ATT and ATC under many weightings of the units at once, holding
+    the propensity scores fixed. All weighted sums come from one matrix product.
+    Parameters:
+    t (array-like): Treatment assignment indicator (1 if treated, 0 if control).
+    y (array-like): Outcome variable.
+    e (np.ndarray): Propensity scores.
+    weights (np.ndarray): (B, n) matrix of unit weights, e.g. from utils.bootstrap_weights.
+    Returns:
+    np.ndarray: (B, 3) matrix of the ATE, ATT and ATC under every weighting.
+    """
+    return _measures_from_sums(np.atleast_2d(weights) @ _ipw_terms(t, y, e))
+
+
+@profiled()
+def calculate_measures_ipw(x, t, y, cache=None, sample_weight=None,
+                           propensity_learner=PROPENSITY_LEARNER, analytic=False, ci_level=95):
     """
     Calculate the Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
     and Average Treatment effect on the Controls (ATC) using Inverse Probability Weighting (IPW).
@@ -38,17 +108,73 @@ def calculate_measures_ipw(x, t, y):
     x (array-like): Covariates/features used to calculate propensity scores.
     t (array-like): Treatment assignment indicator (1 if treated, 0 if control).
     y (array-like): Outcome variable.
+    cache (NuisanceCache or None): Cache of fitted propensity models, None to always refit.
+    sample_weight (array-like or None): Weights of the units in the fit and the sums.
+    propensity_learner (str or dict): Learner spec of the propensity model (see learners.py).
+    analytic (bool): Also return standard errors and confidence intervals computed from the
+        influence score of every unit, instead of bootstrapping. The propensity scores are
+        treated as known.
+    ci_level (float): Confidence interval level in analytic mode (e.g., 95 for 95% CI).
+    Returns:
+    tuple: A tuple containing ATE, ATT, and ATC. In analytic mode, the tuples
+        (ate, att, atc), (ate_se, att_se, atc_se) and (ate_ci, att_ci, atc_ci).
+    """
+
+    e = calculate_propensity_scores(x, t, cache=cache, sample_weight=sample_weight,
+                                    learner=propensity_learner)
+    terms = _ipw_terms(t, y, e)
+    w = np.ones(len(terms)) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+    ate, att, atc = _measures_from_sums((w @ terms)[np.newaxis])[0]
+
+    if not analytic:
+        return ate, att, atc
+
+    # Every term is a ratio of weighted sums; each measure's score is the difference
+    # of the scores of its two terms
+    def scores(numerator, denominator):
+        return ratio_influence_scores(terms[:, numerator], terms[:, denominator], sample_weight)[1]
+
+    ate_scores = scores(1, 0) - scores(2, 0)
+    att_scores = scores(3, 4) - scores(5, 6)
+    atc_scores = scores(7, 8) - scores(9, 10)
+
+    standard_errors, intervals = influence_intervals((ate_scores, att_scores, atc_scores),
+                                                     (ate, att, atc), ci_level, sample_weight)
+    return (ate, att, atc), standard_errors, intervals
+
+
+@profiled()
+def bootstrap_ipw(x, t, y, num_bootstrap=1000, ci_level=95, seed=None, resampling='indices',
+                  cache=None, propensity_learner=PROPENSITY_LEARNER):
+    """
+    Bootstrap the IPW weighting step with the propensity model fitted once on the full data.
+    Replicates draw the same resamples as `bci` with the same seed, but only reweight the
+    units, so their cost is a few matrix products instead of a propensity fit each. The
+    intervals ignore the variability of the propensity model.
+    Parameters:
+    x (array-like): Covariates/features used to calculate propensity scores.
+    t (array-like): Treatment assignment indicator (1 if treated, 0 if control).
+    y (array-like): Outcome variable.
+    num_bootstrap (int): Number of bootstrap replicates.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI).
+    seed (int or None): Seed of the bootstrap random streams, as in `bci`.
+    resampling (str): Resampling scheme, as in `bci`.
+    cache (NuisanceCache or None): Cache of fitted propensity models.
+    propensity_learner (str or dict): Learner spec of the propensity model (see learners.py).
     Returns:
-    tuple: A tuple containing ATE, ATT, and ATC.
+    tuple: ate_ci, att_ci, atc_ci, bootstrap_ate, bootstrap_att, bootstrap_atc, as `bci` returns.
     """
+    e = calculate_propensity_scores(x, t, cache=cache, learner=propensity_learner)
+    terms = _ipw_terms(t, y, e)
 
-    n = len(y)
-    e = calculate_propensity_scores(x, t)
-    ate = sum(y * t / e) / n - sum(y * (1 - t) / (1 - e)) / n
-    att = sum(y * t) / sum(t) - sum(y * (1 - t) * e / (1 - e)) / sum((1 - t) * e / (1 - e))
-    atc = sum(y * t * (1 - e) / e) / sum(t * (1 - e) / e) - sum(y * (1 - t)) / sum(1 - t)
+    seed_sequences = np.random.SeedSequence(seed).spawn(num_bootstrap)
+    results = []
+    for start in range(0, num_bootstrap, BOOTSTRAP_BLOCK_SIZE):
+        weights = bootstrap_weights(seed_sequences[start:start + BOOTSTRAP_BLOCK_SIZE], len(terms),
+                                    resampling)
+        results.extend(map(tuple, _measures_from_sums(weights @ terms)))
 
-    return ate, att, atc
+    return bootstrap_intervals(results, ci_level)
 
 DATA_PATH = '/Users/gurkeinan/semester6/Causal-Inference/Project/code/data/processed_data.csv'
 
@@ -0,0 +1,105 @@
+"""
+This module provides the registry of classifiers used as nuisance models by the estimators.
+
+Every estimator takes a learner spec for each model it fits: the name of a registered
+backend, or a dict with a 'model' key naming the backend and any parameters overriding
+its defaults. The resolved spec also identifies the model in the nuisance cache.
+
+Backends:
+    gradient_boosting: Exact-split gradient boosting, the default outcome model.
+    hist_gradient_boosting: Histogram-based gradient boosting with early stopping;
+        much faster than exact splits on large data. Sparse designs are densified for it,
+        as it does not accept SciPy sparse input.
+    random_forest: Random forest, the default propensity model. It fits on one thread, as
+        estimators often run in process pools (bootstrap, cross-fitting, run_estimators);
+        outside a pool, {'model': 'random_forest', 'n_jobs': -1} grows trees on all cores.
+    logistic_regression: L2-regularized logistic regression.
+
+Functions:
+    resolve_learner(spec):
+        Returns the backend name and its full parameters as one config dict.
+
+    make_learner(spec):
+        Returns an unfitted classifier for a learner spec.
+
+Usage:
+    calculate_measures_doubly_robust(x, t, y, propensity_learner='logistic_regression',
+                                     outcome_learner={'model': 'hist_gradient_boosting',
+                                                      'max_iter': 500})
+"""
+
+from scipy import sparse
+from sklearn.ensemble import (GradientBoostingClassifier, HistGradientBoostingClassifier,
+                              RandomForestClassifier)
+from sklearn.linear_model import LogisticRegression
+
+
+def _dense(x):
+    return x.toarray() if sparse.issparse(x) else x
+
+
+class DenseInputHistGradientBoostingClassifier(HistGradientBoostingClassifier):
+    """
+    Histogram-based gradient boosting that densifies SciPy sparse inputs, so sparse
+    designs can flow through the estimators unchanged whatever the backend.
+    """
+
+    def fit(self, X, y, sample_weight=None):  # pylint: disable=invalid-name
+        return super().fit(_dense(X), y, sample_weight=sample_weight)
+
+    def predict(self, X):  # pylint: disable=invalid-name
+        return super().predict(_dense(X))
+
+    def predict_proba(self, X):  # pylint: disable=invalid-name
+        return super().predict_proba(_dense(X))
+
+    def decision_function(self, X):  # pylint: disable=invalid-name
+        return super().decision_function(_dense(X))
+
+
+LEARNERS = {
+    'gradient_boosting': (GradientBoostingClassifier, {'random_state': 42, 'learning_rate': 0.1}),
+    'hist_gradient_boosting': (DenseInputHistGradientBoostingClassifier,
+                               {'random_state': 42, 'learning_rate': 0.1, 'max_iter': 200,
+                                'early_stopping': True, 'validation_fraction': 0.1,
+                                'n_iter_no_change': 10}),
+    # One thread per fit, so process pools do not oversubscribe the cores; the fitted
+    # forest does not depend on n_jobs
+    'random_forest': (RandomForestClassifier, {'random_state': 42, 'n_jobs': 1}),
+    'logistic_regression': (LogisticRegression, {'max_iter': 1000}),
+}
+
+PROPENSITY_LEARNER = 'random_forest'
+OUTCOME_LEARNER = 'gradient_boosting'
+
+
+def resolve_learner(spec):
+    """
+    Resolve a learner spec into the backend name and its full parameters.
+    Parameters:
+    spec (str or dict): Name of a backend in LEARNERS, or a dict with a 'model' key naming
+        the backend and parameters overriding its defaults.
+    Returns:
+    dict: The backend name under 'model' and every parameter passed to the classifier.
+    """
+    if isinstance(spec, str):
+        spec = {'model': spec}
+    if spec.get('model') not in LEARNERS:
+        raise ValueError(f"Unknown learner {spec.get('model')!r}, expected one of {list(LEARNERS)}")
+
+    _, defaults = LEARNERS[spec['model']]
+    params = {**defaults, **{key: value for key, value in spec.items() if key != 'model'}}
+    return {'model': spec['model'], **dict(sorted(params.items()))}
+
+
+def make_learner(spec):
+    """
+    Create an unfitted classifier from a learner spec.
+    Parameters:
+    spec (str or dict): Learner spec, see resolve_learner.
+    Returns:
+    sklearn classifier: The unfitted classifier.
+    """
+    config = resolve_learner(spec)
+    learner_class, _ = LEARNERS[config.pop('model')]
+    return learner_class(**config)
@@ -0,0 +1,130 @@
+"""
+This module provides a cache of fitted nuisance models shared between estimators.
+
+The propensity model and the per-arm outcome models are fitted on the same data by several
+estimators (IPW, matching, doubly robust and the T-learner). The cache keys each fit by a
+fingerprint of the design matrix, the treatment vector, the outcome and the model config, so
+each nuisance model is fitted once per dataset.
+
+Classes:
+    NuisanceCache(max_entries=32, cache_dir=None):
+        In-memory LRU cache of fitted models and their predictions,
+        optionally backed by a directory of pickled entries.
+
+Functions:
+    fingerprint(*arrays, config=None):
+        Calculates a stable hash of the given arrays and model config.
+"""
+
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+
+def fingerprint(*arrays, config=None):
+    """
+    Calculate a stable hash of arrays and a model config. Arrays are hashed by their values
+    as `utils.as_design_matrix` converts them, so a DataFrame and the ndarray of its values
+    share a key, as do sparse matrices of any format; column names are not hashed.
+    Parameters:
+    *arrays (pd.DataFrame, pd.Series, np.ndarray or sp.spmatrix): Data the model is fitted on.
+    config (object): Any value with a deterministic repr describing the model.
+    Returns:
+    str: Hex digest identifying the inputs.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for array in arrays:
+        if sp.issparse(array):
+            # Canonical CSR, so equal matrices hash alike whatever their format
+            csr = sp.csr_matrix(array, dtype=float, copy=True)
+            csr.sum_duplicates()
+            digest.update(repr(('csr', csr.shape)).encode())
+            for values in (csr.data, csr.indices, csr.indptr):
+                digest.update(np.ascontiguousarray(values).tobytes())
+            continue
+        values = np.ascontiguousarray(np.asarray(array, dtype=float))
+        digest.update(repr(values.shape).encode())
+        digest.update(values.tobytes())
+    digest.update(repr(config).encode())
+    return digest.hexdigest()
+
+
+class NuisanceCache:
+    """
+    LRU cache of fitted nuisance models and predictions.
+    Parameters:
+    max_entries (int): Maximum number of entries kept in memory.
+    cache_dir (str or None): Directory where entries are also pickled, None to keep them
+        in memory only.
+    Attributes:
+    hits (int): Number of lookups answered from memory or disk.
+    misses (int): Number of lookups that required fitting.
+    """
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_or_fit(self, name, arrays, config, fit):
+        """
+        Return the cached result of `fit`, fitting and storing it on a miss.
+        Parameters:
+        name (str): Name of the nuisance model, e.g. 'propensity'.
+        arrays (tuple): Data the model is fitted on, used for the fingerprint.
+        config (object): Model config, used for the fingerprint.
+        fit (callable): Function without arguments returning the value to cache.
+        Returns:
+        object: The value returned by `fit` for these inputs.
+        """
+        key = f'{name}-{fingerprint(*arrays, config=config)}'
+
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+            self.hits += 1
+            self._store(key, value)
+            return value
+
+        self.misses += 1
+        value = fit()
+        self._store(key, value)
+        if self.cache_dir is not None:
+            # Write to a temporary file first so a crash never leaves a truncated entry
+            tmp_path = f'{self._path(key)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        return value
+
+    def clear(self):
+        """
+        Drop all in-memory entries. Entries on disk are kept.
+        """
+        self._entries.clear()
@@ -0,0 +1,295 @@
+"""
+This module provides lightweight stage-level profiling of the estimation pipeline.
+
+Pipeline functions are decorated with `profiled` and inner steps are wrapped in `stage`
+blocks: reading the data, fitting and applying the transformer, fitting and applying the
+propensity and outcome models, scoring individual effects, the neighbour search of
+matching, every estimator and the bootstrap replicates. Profiling is disabled by default,
+and a disabled stage costs one flag check.
+
+When enabled, every stage records its start, wall time, CPU time of the process and, as
+memory, the growth of the peak resident set size. With `trace_memory=True`, tracemalloc
+also records the bytes allocated and still held at the end of the stage and the peak
+allocation within it; tracing slows every allocation down, so it is off by default.
+Nested stages are recorded with their depth and parent, so time in a stage can be split
+into its children and the stage's own work.
+
+Stages are recorded per process. run_estimators collects the stages of its workers with
+`take_events` and `add_events`; in the other process pools (`bci(..., n_jobs>1)`,
+cross-fitting, the threshold sweep) the enclosing stage of the parent process covers the
+workers' time. Start times are on the `time.perf_counter` clock, which is shared by the
+processes of a machine on Linux, so merged stages line up in the trace.
+
+Functions:
+    enable(trace_memory=False), disable(), reset():
+        Turn profiling on or off, and discard the recorded stages.
+
+    stage(name, **args):
+        Context manager recording a stage, with optional arguments shown in the trace.
+
+    profiled(name=None):
+        Decorator recording every call of a function as a stage.
+
+    events():
+        Returns the recorded stages, in the order they ended.
+
+    take_events(), add_events(stages):
+        Return and discard the recorded stages, e.g. in a worker process, and add stages
+        recorded by another process.
+
+    summary():
+        Returns the count and total times of every stage name.
+
+    export_json(path), export_chrome_trace(path):
+        Write the stages and their summary as JSON, or as a Chrome trace viewable in
+        chrome://tracing or https://ui.perfetto.dev.
+
+Usage:
+    profiling.enable()
+    calculate_measures_doubly_robust(x, t, y)
+    profiling.export_chrome_trace('trace.json')
+    print(profiling.summary())
+"""
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Profiling state of this process
+_STATE = {'enabled': False, 'trace_memory': False, 'events': []}
+
+# Open stages of every thread, innermost last
+_STACKS = threading.local()
+
+# Returned by `stage` when profiling is disabled
+_DISABLED_STAGE = nullcontext()
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def enable(trace_memory=False):
+    """
+    Start recording stages.
+    Parameters:
+    trace_memory (bool): Also trace Python memory allocations with tracemalloc.
+    """
+    _STATE['trace_memory'] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _STATE['enabled'] = True
+
+
+def disable():
+    """
+    Stop recording stages, keeping those already recorded.
+    """
+    _STATE['enabled'] = False
+    if _STATE['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _STATE['trace_memory'] = False
+
+
+def is_enabled():
+    """
+    Whether stages are being recorded.
+    """
+    return _STATE['enabled']
+
+
+def reset():
+    """
+    Discard the recorded stages.
+    """
+    _STATE['events'] = []
+
+
+@contextmanager
+def _recorded_stage(name, args):
+    stack = getattr(_STACKS, 'stack', None)
+    if stack is None:
+        stack = _STACKS.stack = []
+
+    trace_memory = _STATE['trace_memory'] and tracemalloc.is_tracing()
+    frame = {'name': name, 'peak_traced': 0}
+    if trace_memory:
+        # The parent's peak so far is kept, so this stage can reset the peak for its own
+        traced, peak_traced = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak_traced'] = max(stack[-1]['peak_traced'], peak_traced)
+        tracemalloc.reset_peak()
+        frame['start_traced'] = traced
+    parent = stack[-1]['name'] if stack else None
+    stack.append(frame)
+
+    start_rss = _peak_rss_bytes()
+    start_cpu = time.process_time_ns()
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        wall_ns = time.perf_counter_ns() - start_ns
+        cpu_ns = time.process_time_ns() - start_cpu
+        stack.pop()
+
+        event = {
+            'name': name,
+            'parent': parent,
+            'depth': len(stack),
+            'start_seconds': start_ns / 1e9,
+            'wall_seconds': wall_ns / 1e9,
+            'cpu_seconds': cpu_ns / 1e9,
+            'peak_rss_growth_bytes': _peak_rss_bytes() - start_rss,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if trace_memory:
+            traced, peak_traced = tracemalloc.get_traced_memory()
+            peak_traced = max(frame['peak_traced'], peak_traced)
+            event['allocated_bytes'] = traced - frame['start_traced']
+            event['peak_allocated_bytes'] = peak_traced - frame['start_traced']
+            if stack:
+                stack[-1]['peak_traced'] = max(stack[-1]['peak_traced'], peak_traced)
+        if args:
+            event['args'] = args
+        _STATE['events'].append(event)
+
+
+def stage(name, **args):
+    """
+    Record a block of code as a stage, when profiling is enabled.
+    Parameters:
+    name (str): Name of the stage.
+    **args: Values describing this run of the stage, e.g. the number of rows.
+    Returns:
+    context manager: Records the stage on exit.
+    """
+    if not _STATE['enabled']:
+        return _DISABLED_STAGE
+    return _recorded_stage(name, args)
+
+
+def profiled(name=None):
+    """
+    Decorator recording every call of a function as a stage, when profiling is enabled.
+    Parameters:
+    name (str or None): Name of the stage, None for the function name.
+    Returns:
+    function: The decorator.
+    """
+    def decorator(function):
+        stage_name = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return function(*args, **kwargs)
+            with _recorded_stage(stage_name, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def events():
+    """
+    Recorded stages, in the order they ended.
+    Returns:
+    list of dict: Name, parent, depth, start, wall and CPU seconds, memory and process of
+        every stage.
+    """
+    return list(_STATE['events'])
+
+
+def take_events():
+    """
+    Return the recorded stages and discard them from this process.
+    Returns:
+    list of dict: The stages, as `events` returns them.
+    """
+    taken, _STATE['events'] = _STATE['events'], []
+    return taken
+
+
+def add_events(stages):
+    """
+    Add stages recorded by another process.
+    Parameters:
+    stages (list of dict): Stages returned by `take_events` in that process.
+    """
+    _STATE['events'].extend(stages)
+
+
+def summary():
+    """
+    Aggregate the recorded stages by name.
+    Returns:
+    dict: Maps every stage name to its count, total wall and CPU seconds, self seconds (wall
+        time not spent in child stages) and largest peak RSS growth, by decreasing wall time.
+    """
+    totals = {}
+    for event in _STATE['events']:
+        total = totals.setdefault(event['name'], {'count': 0, 'wall_seconds': 0.0,
+                                                  'cpu_seconds': 0.0, 'self_seconds': 0.0,
+                                                  'max_peak_rss_growth_bytes': 0})
+        total['count'] += 1
+        total['wall_seconds'] += event['wall_seconds']
+        total['cpu_seconds'] += event['cpu_seconds']
+        total['self_seconds'] += event['wall_seconds']
+        total['max_peak_rss_growth_bytes'] = max(total['max_peak_rss_growth_bytes'],
+                                                 event['peak_rss_growth_bytes'])
+        if 'peak_allocated_bytes' in event:
+            total['max_peak_allocated_bytes'] = max(total.get('max_peak_allocated_bytes', 0),
+                                                    event['peak_allocated_bytes'])
+
+    # Time in child stages is removed from the parent's own time, once the parent has ended
+    for event in _STATE['events']:
+        if event['parent'] in totals and event['parent'] != event['name']:
+            totals[event['parent']]['self_seconds'] -= event['wall_seconds']
+
+    return dict(sorted(totals.items(), key=lambda item: -item[1]['wall_seconds']))
+
+
+def export_json(path):
+    """
+    Write the recorded stages and their summary as JSON.
+    Parameters:
+    path (str): Destination file.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'events': events(), 'summary': summary()}, f, indent=2)
+
+
+def export_chrome_trace(path):
+    """
+    Write the recorded stages in the Chrome trace event format, as complete events with
+    microsecond timestamps from the first stage, and their summary as metadata.
+    Parameters:
+    path (str): Destination file.
+    """
+    origin = min((event['start_seconds'] for event in _STATE['events']), default=0.0)
+    trace_events = []
+    for event in _STATE['events']:
+        args = {key: value for key, value in event.items()
+                if key not in ('name', 'start_seconds', 'wall_seconds', 'pid', 'tid', 'args')}
+        args.update(event.get('args', {}))
+        trace_events.append({
+            'name': event['name'],
+            'cat': 'estimation',
+            'ph': 'X',
+            'ts': (event['start_seconds'] - origin) * 1e6,
+            'dur': event['wall_seconds'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args,
+        })
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms',
+                   'otherData': {'summary': summary()}}, f, default=str)
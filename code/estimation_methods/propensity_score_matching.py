@@ -4,9 +4,15 @@ Average Treatment Effect on the Treated (ATT),
 and Average Treatment Effect on the Control (ATC)
 
 Functions:
-    calculate_measures_matching(x, t, y, n_matches=11):
+    calculate_measures_matching(x, t, y, n_matches=11, index='tree', cache=None,
+                                propensity_learner=PROPENSITY_LEARNER):
         Calculate ATE, ATT, and ATC using propensity score matching.
 
+    sweep_n_matches(x, t, y, n_matches_values, index='tree', cache=None,
+                    propensity_learner=PROPENSITY_LEARNER):
+        Calculate ATE, ATT, and ATC for several numbers of matches,
+        reusing one propensity fit and one index per arm.
+
 Main Execution:
     Reads and transforms the data from a specified path,
     calculates point estimates for ATE, ATT, and ATC using
@@ -19,10 +25,117 @@ import numpy as np
 
 from sklearn.neighbors import NearestNeighbors
 
-from utils import read_and_transform_data, calculate_propensity_scores, bci
+from learners import PROPENSITY_LEARNER
+from profiling import profiled, stage
+from utils import read_and_transform_data, calculate_propensity_scores, measures_from_effects, bci
+
+
+class SortedScoreIndex:
+    """
+    Nearest-neighbour index over one-dimensional scores backed by a single sorted array.
+    The k nearest scores of every query lie in a window of 2k sorted positions around its
+    insertion point, so queries are answered with one `searchsorted` call and the sort is
+    reused for any number of neighbours.
+    """
+
+    def __init__(self, scores):
+        scores = np.asarray(scores, dtype=float).ravel()
+        self.order = np.argsort(scores, kind='stable')
+        self.sorted_scores = scores[self.order]
+
+    def kneighbors(self, queries, n_neighbors):
+        """
+        Find the nearest indexed scores for a batch of queries.
+        Parameters:
+        queries (np.ndarray): Query scores, shape (m,) or (m, 1).
+        n_neighbors (int): Number of neighbours to return per query.
+        Returns:
+        tuple: A tuple containing:
+            - distances (np.ndarray): Absolute distances, shape (m, n_neighbors), ascending.
+            - indices (np.ndarray): Positions of the neighbours in the original scores.
+        """
+        n = len(self.sorted_scores)
+        if n_neighbors > n:
+            raise ValueError(f'Expected n_neighbors <= n_samples_fit, but n_neighbors = '
+                             f'{n_neighbors}, n_samples_fit = {n}')
+
+        queries = np.asarray(queries, dtype=float).ravel()
+        insert_at = np.searchsorted(self.sorted_scores, queries)
+
+        # Candidate window of 2k sorted positions around each insertion point
+        window = insert_at[:, None] + np.arange(-n_neighbors, n_neighbors)
+        in_range = (window >= 0) & (window < n)
+        window = np.clip(window, 0, n - 1)
+        distances = np.abs(self.sorted_scores[window] - queries[:, None])
+        distances[~in_range] = np.inf
+
+        nearest = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+        distances = np.take_along_axis(distances, nearest, axis=1)
+        indices = self.order[np.take_along_axis(window, nearest, axis=1)]
+
+        return distances, indices
+
+
+@profiled()
+def build_matching_index(scores, index='tree', n_matches=11):
+    """
+    Build a nearest-neighbour index over propensity scores. The indexes return the same
+    distances but may pick different units among tied scores, which are common with
+    tree-based propensity models, so estimates are only comparable with the same index.
+    Parameters:
+    scores (np.ndarray): Propensity scores of the units to match against.
+    index (str): 'tree' for sklearn's NearestNeighbors, 'sorted' for SortedScoreIndex.
+    n_matches (int): Number of matches the index will be queried for.
+    Returns:
+    object: An index with a `kneighbors(queries, n_neighbors)` method.
+    """
+    if index == 'sorted':
+        return SortedScoreIndex(scores)
+    if index == 'tree':
+        return NearestNeighbors(n_neighbors=n_matches + 1).fit(np.reshape(scores, (-1, 1)))
+    raise ValueError(f"Unknown matching index '{index}', expected 'tree' or 'sorted'")
+
+
+def _matched_effects(propensity_scores, y, query_indices, pool_indices, pool_index, n_matches):
+    """
+    Match every query unit to its nearest units from the opposite arm in one batched query.
+    Parameters:
+    propensity_scores (np.ndarray): Propensity scores of all units.
+    y (np.ndarray): Outcomes of all units.
+    query_indices (np.ndarray): Units to find matches for.
+    pool_indices (np.ndarray): Units of the opposite arm, as indexed by `pool_index`.
+    pool_index (object): Index built over the scores of `pool_indices`.
+    n_matches (int): Number of matches per unit.
+    Returns:
+    np.ndarray: y of each matched query unit minus the weighted mean outcome of its matches.
+    """
+    epsilon = 1e-5  # Small value to prevent division by zero
+
+    with stage('neighbour_search', queries=len(query_indices), pool=len(pool_indices)):
+        distances, indices = pool_index.kneighbors(
+            propensity_scores[query_indices].reshape(-1, 1), n_neighbors=n_matches + 1)
+    matched_indices = pool_indices[indices]
+
+    # Exclude self-matches, keeping the remaining neighbours in distance order
+    mask = matched_indices != query_indices[:, None]
+    keep = np.argsort(~mask, axis=1, kind='stable')[:, :n_matches]
+    valid = mask.sum(axis=1) >= n_matches
+    matched_indices = np.take_along_axis(matched_indices, keep, axis=1)[valid]
+    distances = np.take_along_axis(distances, keep, axis=1)[valid]
+
+    # Calculate weights inversely proportional to distance, normalized to sum to 1
+    weights = 1 / (distances + epsilon)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    # Compute weighted average of neighbor outcomes
+    weighted_mean = np.einsum('ij,ij->i', weights, y[matched_indices])
 
+    return y[query_indices[valid]] - weighted_mean
 
-def calculate_measures_matching(x, t, y, n_matches=11):
+
+@profiled()
+def calculate_measures_matching(x, t, y, n_matches=11, index='tree', cache=None,
+                                propensity_learner=PROPENSITY_LEARNER):
     """
     Calculate Average Treatment Effect (ATE), Average Treatment Effect on the Treated (ATT),
     and Average Treatment Effect on the Control (ATC) using propensity score matching.
@@ -31,6 +144,10 @@ def calculate_measures_matching(x, t, y, n_matches=11):
     t (pd.Series): Treatment indicator (1 for treated, 0 for control).
     y (pd.Series): Outcome variable.
     n_matches (int, optional): Number of nearest neighbors to match. Default is 11.
+    index (str, optional): Matching index, 'tree' (default) or 'sorted'.
+    cache (NuisanceCache, optional): Cache of fitted propensity models.
+    propensity_learner (str or dict, optional): Learner spec of the propensity model
+        (see learners.py).
     Returns:
     tuple: A tuple containing:
         - ate (float): Average Treatment Effect.
@@ -38,89 +155,71 @@ def calculate_measures_matching(x, t, y, n_matches=11):
         - atc (float): Average Treatment Effect on the Control.
     """
 
-    propensity_scores = calculate_propensity_scores(x, t)
+    propensity_scores = calculate_propensity_scores(x, t, cache=cache, learner=propensity_learner)
 
     # Convert to numpy arrays for indexing
-    propensity_scores = propensity_scores.reshape(-1, 1)
-    y = y.values
-    t = t.values
+    y = np.asarray(y)
+    t = np.asarray(t)
 
     # Separate treated and control indices
     treated_indices = np.nonzero(t == 1)[0]
     control_indices = np.nonzero(t == 0)[0]
 
-    # Build separate NN models for control and treated units
-    nn_control = NearestNeighbors(n_neighbors=n_matches + 1)
-    nn_control.fit(propensity_scores[control_indices])
-
-    nn_treated = NearestNeighbors(n_neighbors=n_matches + 1)
-    nn_treated.fit(propensity_scores[treated_indices])
-
-    # Initialize lists to store effects
-    att_effects = []
-    atc_effects = []
-
-    epsilon = 1e-5  # Small value to prevent division by zero
+    # Build separate NN indexes for control and treated units
+    nn_control = build_matching_index(propensity_scores[control_indices], index, n_matches)
+    nn_treated = build_matching_index(propensity_scores[treated_indices], index, n_matches)
 
     # For treated units, find matched control units (ATT)
-    for i in treated_indices:
-        propensity_i = propensity_scores[i].reshape(1, -1)
-        distances, indices = nn_control.kneighbors(propensity_i)
-        matched_indices = control_indices[indices[0]]
-
-        # Exclude self-match if present
-        mask = matched_indices != i
-        matched_indices = matched_indices[mask]
-        distances = distances[0][mask]
-
-        if len(matched_indices) >= n_matches:
-            matched_indices = matched_indices[:n_matches]
-            distances = distances[:n_matches]
-
-            # Calculate weights inversely proportional to distance
-            weights = 1 / (distances + epsilon)
-            weights /= weights.sum()  # Normalize weights to sum to 1
-
-            # Compute weighted average of neighbor outcomes
-            weighted_mean = np.dot(weights, y[matched_indices])
-
-            effect = y[i] - weighted_mean
-            att_effects.append(effect)
+    att_effects = _matched_effects(propensity_scores, y, treated_indices,
+                                   control_indices, nn_control, n_matches)
 
     # For control units, find matched treated units (ATC)
-    for i in control_indices:
-        propensity_i = propensity_scores[i].reshape(1, -1)
-        distances, indices = nn_treated.kneighbors(propensity_i)
-        matched_indices = treated_indices[indices[0]]
-
-        # Exclude self-match if present
-        mask = matched_indices != i
-        matched_indices = matched_indices[mask]
-        distances = distances[0][mask]
+    atc_effects = -_matched_effects(propensity_scores, y, control_indices,
+                                    treated_indices, nn_treated, n_matches)
 
-        if len(matched_indices) >= n_matches:
-            matched_indices = matched_indices[:n_matches]
-            distances = distances[:n_matches]
+    return measures_from_effects(att_effects, atc_effects)
 
-            # Calculate weights inversely proportional to distance
-            weights = 1 / (distances + epsilon)
-            weights /= weights.sum()  # Normalize weights to sum to 1
 
-            # Compute weighted average of neighbor outcomes
-            weighted_mean = np.dot(weights, y[matched_indices])
-
-            effect = weighted_mean - y[i]
-            atc_effects.append(effect)
+def sweep_n_matches(x, t, y, n_matches_values, index='tree', cache=None,
+                    propensity_learner=PROPENSITY_LEARNER):
+    """
+    Calculate ATE, ATT and ATC for several numbers of matches, fitting the propensity
+    model once and indexing each arm's scores once. Each number of matches gives the same
+    estimates as `calculate_measures_matching` with the same index, ties included.
+    Parameters:
+    x (pd.DataFrame): Covariates/features used to estimate propensity scores.
+    t (pd.Series): Treatment indicator (1 for treated, 0 for control).
+    y (pd.Series): Outcome variable.
+    n_matches_values (iterable of int): Numbers of nearest neighbors to match.
+    index (str, optional): Matching index, 'tree' (default) or 'sorted'.
+    cache (NuisanceCache, optional): Cache of fitted propensity models.
+    propensity_learner (str or dict, optional): Learner spec of the propensity model.
+    Returns:
+    dict: Maps each number of matches to its (ate, att, atc) tuple.
+    """
 
-    # Combine effects for ATE calculation
-    individual_effects = att_effects + atc_effects
+    propensity_scores = calculate_propensity_scores(x, t, cache=cache, learner=propensity_learner)
+    y = np.asarray(y)
+    t = np.asarray(t)
 
-    # Calculate ATE, ATT, and ATC
-    ate = np.mean(individual_effects) if individual_effects else np.nan
-    att = np.mean(att_effects) if att_effects else np.nan
-    atc = np.mean(atc_effects) if atc_effects else np.nan
+    treated_indices = np.nonzero(t == 1)[0]
+    control_indices = np.nonzero(t == 0)[0]
 
-    return ate, att, atc
+    # The estimator's index, so that tied scores resolve to the same matches
+    n_matches_values = list(n_matches_values)
+    max_matches = max(n_matches_values, default=0)
+    nn_control = build_matching_index(propensity_scores[control_indices], index, max_matches)
+    nn_treated = build_matching_index(propensity_scores[treated_indices], index, max_matches)
+
+    results = {}
+    for n_matches in n_matches_values:
+        att_effects = _matched_effects(propensity_scores, y, treated_indices,
+                                       control_indices, nn_control, n_matches)
+        atc_effects = -_matched_effects(propensity_scores, y, control_indices,
+                                        treated_indices, nn_treated, n_matches)
+        results[n_matches] = measures_from_effects(att_effects, atc_effects)
+
+    return results
 
 # Main execution
 if __name__ == "__main__":
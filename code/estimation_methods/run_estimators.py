@@ -0,0 +1,226 @@
+"""
+This module runs several estimation methods on one dataset in a single process pool.
+
+The data is loaded and transformed once and shipped once to every worker. Each estimator
+contributes a point-estimate task and a set of bootstrap tasks, each covering a block of
+replicates; its confidence intervals are computed once all of its bootstrap tasks are
+done. All tasks are scheduled together on a fixed number of workers, and the results are
+written to one JSON file.
+
+Bootstrap replicates are seeded as in `utils.bci`, so the intervals equal those of
+`bci(..., seed=seed)` whatever the number of workers.
+
+When profiling is enabled (see profiling.py), the workers record their stages too and the
+stages are collected into the profile of this process.
+
+Functions:
+    run_estimators(x, t, y, estimators, num_bootstrap=1000, ci_level=95, workers=1, seed=0,
+                   replicates_per_task=None, cache_dir=None):
+        Calculates point estimates and bootstrap confidence intervals of the given estimators.
+
+Usage:
+    python run_estimators.py --data ../data/processed_data.csv --estimators t_learner ipw \
+        --num-bootstrap 1000 --workers 8 --output results.json
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import profiling
+from doubly_robust import calculate_measures_doubly_robust
+from inverse_probability_weighting import calculate_measures_ipw
+from nuisance_cache import NuisanceCache
+from propensity_score_matching import calculate_measures_matching
+from s_learner import calculate_measures_s_learner
+from t_learner import calculate_measures_t_learner
+from utils import (read_and_transform_data, run_bootstrap_replicates, bootstrap_intervals,
+                   as_design_matrix)
+
+ESTIMATORS = {
+    's_learner': calculate_measures_s_learner,
+    't_learner': calculate_measures_t_learner,
+    'ipw': calculate_measures_ipw,
+    'matching': calculate_measures_matching,
+    'doubly_robust': calculate_measures_doubly_robust,
+}
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+                         'processed_data.csv')
+
+# Per-process state of the runner workers, populated once by _init_worker
+_WORKER_STATE = {}
+
+
+def _init_worker(x, t, y, cache_dir, profile=False):
+    """
+    Store the data in the worker process. Workers share fitted nuisance models through
+    an on-disk cache when `cache_dir` is given, and record profiling stages when `profile`.
+    """
+    _WORKER_STATE.update(x=x, t=t, y=y)
+    _WORKER_STATE['cache'] = None if cache_dir is None else NuisanceCache(cache_dir=cache_dir)
+    if profile:
+        profiling.reset()
+        profiling.enable()
+
+
+def _point_task(name):
+    """
+    Calculate the point estimates of an estimator on the full data.
+    """
+    start = time.perf_counter()
+    state = _WORKER_STATE
+    cache = {} if state['cache'] is None else {'cache': state['cache']}
+    ate, att, atc = ESTIMATORS[name](state['x'], state['t'], state['y'], **cache)
+    return (float(ate), float(att), float(atc)), time.perf_counter() - start, profiling.take_events()
+
+
+def _bootstrap_task(name, seed_sequences):
+    """
+    Run a block of bootstrap replicates of an estimator.
+    """
+    start = time.perf_counter()
+    state = _WORKER_STATE
+    results = run_bootstrap_replicates(state['x'], state['t'], state['y'], ESTIMATORS[name],
+                                       seed_sequences)
+    return results, time.perf_counter() - start, profiling.take_events()
+
+
+def run_estimators(x, t, y, estimators, num_bootstrap=1000, ci_level=95, workers=1, seed=0,
+                   replicates_per_task=None, cache_dir=None):
+    """
+    Calculate ATE, ATT and ATC and their bootstrap confidence intervals for several estimators,
+    running all point estimates and bootstrap blocks concurrently.
+    Parameters:
+    x (pd.DataFrame or np.ndarray): Feature matrix.
+    t (pd.Series or np.ndarray): Treatment assignments.
+    y (pd.Series or np.ndarray): Outcome variable.
+    estimators (list of str): Names of estimators, keys of ESTIMATORS.
+    num_bootstrap (int): Number of bootstrap replicates per estimator, 0 to skip intervals.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI).
+    workers (int): Number of worker processes, -1 uses all cores.
+    seed (int): Seed of the bootstrap random streams.
+    replicates_per_task (int or None): Replicates per bootstrap task, None to spread every
+        estimator's replicates over about four tasks per worker.
+    cache_dir (str or None): Directory of fitted nuisance models shared by the point tasks.
+    Returns:
+    dict: Maps each estimator name to its estimates, intervals and task seconds.
+    """
+    unknown = set(estimators) - set(ESTIMATORS)
+    if unknown:
+        raise ValueError(f'Unknown estimators {sorted(unknown)}, expected some of {list(ESTIMATORS)}')
+
+    if workers == -1:
+        workers = os.cpu_count() or 1
+    if replicates_per_task is None:
+        replicates_per_task = max(1, num_bootstrap // (4 * workers))
+
+    # Contiguous arrays or a CSR matrix, as bci uses them
+    x = as_design_matrix(x)
+    t = np.ascontiguousarray(t)
+    y = np.ascontiguousarray(y)
+
+    results = {name: {'bootstrap_seconds': 0.0} for name in estimators}
+    replicates = {name: [None] * num_bootstrap for name in estimators}
+    remaining_blocks = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(x, t, y, cache_dir, profiling.is_enabled())) as executor:
+        # Task graph: one point task and the bootstrap blocks of every estimator
+        futures = {}
+        for name in estimators:
+            futures[executor.submit(_point_task, name)] = (name, None)
+
+        seed_sequences = np.random.SeedSequence(seed).spawn(num_bootstrap)
+        for name in estimators:
+            starts = range(0, num_bootstrap, replicates_per_task)
+            remaining_blocks[name] = len(starts)
+            for block_start in starts:
+                block = seed_sequences[block_start:block_start + replicates_per_task]
+                futures[executor.submit(_bootstrap_task, name, block)] = (name, block_start)
+
+        for future in as_completed(futures):
+            name, block_start = futures[future]
+            output, seconds, stages = future.result()
+            profiling.add_events(stages)
+
+            if block_start is None:
+                results[name].update(ate=output[0], att=output[1], atc=output[2],
+                                     point_seconds=seconds)
+                continue
+
+            replicates[name][block_start:block_start + len(output)] = output
+            results[name]['bootstrap_seconds'] += seconds
+            remaining_blocks[name] -= 1
+
+            # All blocks of this estimator are done
+            if remaining_blocks[name] == 0:
+                ate_ci, att_ci, atc_ci = bootstrap_intervals(replicates[name], ci_level)[:3]
+                results[name].update(ate_ci=ate_ci.tolist(), att_ci=att_ci.tolist(),
+                                     atc_ci=atc_ci.tolist())
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run estimation methods on one dataset.')
+    parser.add_argument('--data', default=DATA_PATH, help='path of the processed CSV file')
+    parser.add_argument('--estimators', nargs='+', default=list(ESTIMATORS),
+                        choices=list(ESTIMATORS), help='estimators to run')
+    parser.add_argument('--num-bootstrap', type=int, default=1000,
+                        help='bootstrap replicates per estimator, 0 to skip intervals')
+    parser.add_argument('--ci-level', type=float, default=95, help='confidence interval level')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, -1 for all cores')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap replicates')
+    parser.add_argument('--replicates-per-task', type=int, default=None,
+                        help='bootstrap replicates per scheduled task')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of cached transformed data and fitted nuisance models')
+    parser.add_argument('--sparse', action='store_true',
+                        help='use a sparse CSR design matrix instead of a dense one')
+    parser.add_argument('--output', default='results.json', help='path of the JSON results')
+    parser.add_argument('--profile', default=None,
+                        help='record the time and memory of every stage into this Chrome trace file')
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profiling.enable()
+    start_time = time.perf_counter()
+    design_cache_dir = None if args.cache_dir is None else os.path.join(args.cache_dir, 'design')
+    nuisance_cache_dir = None if args.cache_dir is None else os.path.join(args.cache_dir, 'nuisance')
+    x_data, t_data, y_data = read_and_transform_data(args.data, cache_dir=design_cache_dir,
+                                                     sparse=args.sparse)
+
+    estimates = run_estimators(x_data, t_data, y_data, args.estimators,
+                               num_bootstrap=args.num_bootstrap, ci_level=args.ci_level,
+                               workers=args.workers, seed=args.seed,
+                               replicates_per_task=args.replicates_per_task,
+                               cache_dir=nuisance_cache_dir)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'data': os.path.abspath(args.data),
+            'n_rows': len(y_data),
+            'num_bootstrap': args.num_bootstrap,
+            'ci_level': args.ci_level,
+            'seed': args.seed,
+            'workers': args.workers,
+            'seconds': time.perf_counter() - start_time,
+            'results': estimates,
+        }, f, indent=2)
+
+    for estimator_name, estimate in estimates.items():
+        print(f"{estimator_name}: ATE: {estimate['ate']:.4f}, ATT: {estimate['att']:.4f}, "
+              f"ATC: {estimate['atc']:.4f}")
+    print(f'Results saved to {args.output}')
+
+    if args.profile is not None:
+        profiling.export_chrome_trace(args.profile)
+        for stage_name, totals in profiling.summary().items():
+            print(f"{stage_name}: {totals['count']} calls, {totals['wall_seconds']:.2f}s wall, "
+                  f"{totals['self_seconds']:.2f}s self, {totals['cpu_seconds']:.2f}s CPU")
+        print(f'Profile saved to {args.profile}')
@@ -1,8 +1,14 @@
 """
 This module implements an S-Learner for causal inference using a Gradient Boosting Classifier.
 
+Classes:
+    SLearner(learner=OUTCOME_LEARNER, transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        Persistable fitted S-learner with a batch `predict_effect(x)` API
+        (see effect_scoring.EffectLearner).
+
 Functions:
-    calculate_measures_s_learner(x, t, y):
+    calculate_measures_s_learner(x, t, y, cache=None, sample_weight=None,
+                                 outcome_learner=OUTCOME_LEARNER):
         Calculates the Average Treatment Effect (ATE),
         Average Treatment effect on the Treated (ATT),
         and Average Treatment effect on the Control (ATC) using an S-Learner approach.
@@ -15,6 +21,9 @@ Args:
     x (pd.DataFrame): Features dataframe.
     t (pd.Series): Treatment indicator series.
     y (pd.Series): Outcome series.
+    cache (NuisanceCache or None): Cache of fitted models.
+    sample_weight (np.ndarray or None): Weights of the units, e.g. bootstrap frequencies.
+    outcome_learner (str or dict): Learner spec of the outcome model (see learners.py).
 
 Returns:
     tuple: A tuple containing ATE, ATT, and ATC.
@@ -25,46 +34,110 @@ Usage:
 
 import numpy as np
 import pandas as pd
-from sklearn.ensemble import GradientBoostingClassifier
+from scipy import sparse as sp
+from effect_scoring import EffectLearner, DEFAULT_CHUNK_SIZE
+from learners import make_learner, resolve_learner, OUTCOME_LEARNER
+from profiling import profiled, stage
 from utils import read_and_transform_data, bci
 
-def calculate_measures_s_learner(x, t, y):
+def _with_treatment_column(x, t):
+    """
+    Append the treatment as the last column of the design matrix, keeping sparse designs sparse.
+    """
+    t = np.asarray(t, dtype=float).reshape(-1, 1)
+    if sp.issparse(x):
+        return sp.hstack([x, t], format='csr')
+    return np.column_stack([np.asarray(x, dtype=float), t])
+
+
+class SLearner(EffectLearner):
+    """
+    Fitted S-learner predicting individual treatment effects from a single outcome model
+    whose last feature is the treatment indicator.
+    Parameters:
+    learner (str or dict): Learner spec of the outcome model (see learners.py).
+    transformer (FeatureTransformer or None): Transformer applied to raw scoring inputs.
+    chunk_size (int): Number of rows scored at a time.
+    """
+
+    def __init__(self, learner=OUTCOME_LEARNER, transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(transformer=transformer, chunk_size=chunk_size)
+        self.learner = learner
+
+    def fit(self, x, t, y, cache=None, sample_weight=None):
+        """
+        Fit the outcome model on the features and the treatment indicator.
+        Parameters:
+        x (pd.DataFrame or np.ndarray): Features dataframe.
+        t (pd.Series or np.ndarray): Treatment indicator series.
+        y (pd.Series or np.ndarray): Outcome series.
+        cache (NuisanceCache or None): Cache of fitted models, None to always refit.
+        sample_weight (np.ndarray or None): Weights of the units in the fit.
+        Returns:
+        SLearner: The fitted learner.
+        """
+
+        # Treatment is the last column of the design matrix
+        xt = _with_treatment_column(x, t)
+
+        def fit():
+            model = make_learner(self.learner)
+            with stage('outcome_fit', rows=xt.shape[0]):
+                model.fit(xt, y, sample_weight=sample_weight)
+            return model
+
+        if cache is None:
+            self.model = fit()
+        else:
+            arrays = (xt, y) if sample_weight is None else (xt, y, sample_weight)
+            self.model = cache.get_or_fit('s_learner', arrays, resolve_learner(self.learner), fit)
+        return self
+
+    def _predict_effect_chunk(self, x):
+        n = x.shape[0]
+
+        # Predict outcomes under treatment condition
+        y_pred_treated = self.model.predict_proba(_with_treatment_column(x, np.ones(n)))[:, 1]
+
+        # Predict outcomes under control condition
+        y_pred_control = self.model.predict_proba(_with_treatment_column(x, np.zeros(n)))[:, 1]
+
+        return y_pred_treated - y_pred_control
+
+
+@profiled()
+def calculate_measures_s_learner(x, t, y, cache=None, sample_weight=None,
+                                 outcome_learner=OUTCOME_LEARNER):
     """
     Calculate Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
     and Average Treatment effect on the Control (ATC) using the S-learner approach.
     Parameters:
-    x (pd.DataFrame): Features dataframe.
-    t (pd.Series): Treatment indicator series.
-    y (pd.Series): Outcome series.
+    x (pd.DataFrame or np.ndarray): Features dataframe.
+    t (pd.Series or np.ndarray): Treatment indicator series.
+    y (pd.Series or np.ndarray): Outcome series.
+    cache (NuisanceCache or None): Cache of fitted models, None to always refit.
+    sample_weight (np.ndarray or None): Weights of the units in the fit and the averages.
+    outcome_learner (str or dict): Learner spec of the outcome model (see learners.py).
     Returns:
     tuple: A tuple containing ATE, ATT, and ATC.
     """
 
-    model = GradientBoostingClassifier(random_state=42, learning_rate=0.1)
-    model.fit(pd.concat([x, t], axis=1), y)
-
-    # Predict outcomes for all individuals under treatment condition
-    xt = pd.concat([x, t], axis=1)
-    xt_treated = xt.copy()
-    xt_treated['Adult'] = 1
-    y_pred_treated = model.predict_proba(xt_treated)[:, 1]
-
-    # Predict outcomes for all individuals under control condition
-    xt_control = xt.copy()
-    xt_control['Adult'] = 0
-    y_pred_control = model.predict_proba(xt_control)[:, 1]
+    learner = SLearner(learner=outcome_learner).fit(x, t, y, cache=cache, sample_weight=sample_weight)
 
     # Calculate individual treatment effects
-    individual_effects = y_pred_treated - y_pred_control
+    individual_effects = learner.predict_effect(x)
+
+    t = np.asarray(t)
+    w = np.ones(len(t)) if sample_weight is None else sample_weight
 
     # Calculate ATE
-    ate = np.mean(individual_effects)
+    ate = np.average(individual_effects, weights=w)
 
     # Calculate ATT
-    att = np.mean(individual_effects[xt['Adult'] == 1])
+    att = np.average(individual_effects[t == 1], weights=w[t == 1])
 
     # Calculate ATC
-    atc = np.mean(individual_effects[xt['Adult'] == 0])
+    atc = np.average(individual_effects[t == 0], weights=w[t == 0])
 
     return ate, att, atc
 
@@ -0,0 +1,246 @@
+"""
+This module estimates ATE, ATT and ATC within subgroups, e.g. per course, gender,
+scholarship status and attendance, and their combinations, from a single fitted learner.
+
+The S- or T-learner is fitted once and the individual effect of every unit is predicted
+once. Every group-by key assigns each unit to one cell, and the weighted sums behind the
+measures of every cell of every key are reductions of the effects over the cells. All of
+them are computed together, as one product of the weights with a sparse matrix of the
+effects spread over the cells, for the point estimates and for every bootstrap replicate.
+
+Bootstrap replicates are shared by all cells: replicate b weighs the units by the same
+frequency weights, drawn as `bci` draws them, in every cell. By default the individual
+effects are held fixed, so the intervals cover the sampling of the units given the fitted
+learner at no extra fit. With `refit=True` the learner is refitted on every replicate,
+once for all cells, which also covers the uncertainty of the fit.
+
+Functions:
+    subgroup_keys(columns, max_order=None):
+        Returns every combination of the columns, as group-by keys.
+
+    subgroup_effects(x, t, y, groups, by, meta_learner='t_learner', num_bootstrap=1000,
+                     ci_level=95, seed=None, resampling='indices', refit=False, cache=None,
+                     outcome_learner=OUTCOME_LEARNER):
+        Returns a tidy table of the measures and their bootstrap intervals of every cell.
+
+Usage:
+    python subgroup_effects.py --by Course Gender --max-order 2 --num-bootstrap 1000
+"""
+
+import argparse
+import os
+import warnings
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+from inverse_probability_weighting import BOOTSTRAP_BLOCK_SIZE
+from learners import OUTCOME_LEARNER
+from s_learner import SLearner
+from t_learner import TLearner
+from utils import (read_processed_data, read_and_transform_data, bootstrap_weights,
+                   RESAMPLING_SCHEMES)
+
+META_LEARNERS = {
+    's_learner': SLearner,
+    't_learner': TLearner,
+}
+
+SUBGROUP_COLUMNS = ['Course', 'Gender', 'Scholarship holder', 'Daytime/evening attendance']
+
+# Per-unit terms summed in every cell: weight, effect, treated weight, treated effect
+_N_TERMS = 4
+
+
+def subgroup_keys(columns, max_order=None):
+    """
+    List every combination of the columns as a group-by key.
+    Parameters:
+    columns (list of str): Grouping columns.
+    max_order (int or None): Largest number of columns combined, None for all of them.
+    Returns:
+    list of tuple: Group-by keys, single columns first.
+    """
+    max_order = len(columns) if max_order is None else max_order
+    return [key for order in range(1, max_order + 1) for key in combinations(columns, order)]
+
+
+def _cell_codes(groups, by):
+    """
+    Assign every unit to its cell of every group-by key.
+    Returns:
+    tuple: List of (key, cell values DataFrame, first cell, codes) per key, and the total
+        number of cells.
+    """
+    keys = []
+    offset = 0
+    for key in by:
+        key = (key,) if isinstance(key, str) else tuple(key)
+        if key:
+            grouped = groups.groupby(list(key), sort=True, observed=True, dropna=False)
+            codes = grouped.ngroup().to_numpy()
+            cells = grouped.size().index.to_frame(index=False)
+        else:
+            # The empty key is the whole population
+            codes = np.zeros(len(groups), dtype=np.int64)
+            cells = pd.DataFrame(index=[0])
+        keys.append((key, cells, offset, codes + offset))
+        offset += len(cells)
+    return keys, offset
+
+
+def _cell_terms(effects, t, codes, n_cells):
+    """
+    Spread the per-unit terms over the cells, as an (n, n_cells * 4) CSR matrix whose product
+    with weights gives the weighted sums of every cell.
+    """
+    n = len(effects)
+    terms = np.column_stack([np.ones(n), effects, t, t * effects])
+    rows = np.repeat(np.arange(n), len(codes) * _N_TERMS)
+    columns = (np.stack(codes, axis=1)[:, :, None] * _N_TERMS + np.arange(_N_TERMS)).ravel()
+    values = np.broadcast_to(terms[:, None, :], (n, len(codes), _N_TERMS)).ravel()
+    return sp.csr_matrix((values, (rows, columns)), shape=(n, n_cells * _N_TERMS))
+
+
+def _measures_from_sums(sums):
+    """
+    ATE, ATT and ATC of every cell from its weighted sums; NaN where a cell has no treated
+    or no control units.
+    """
+    weight, effect, treated, treated_effect = np.moveaxis(sums, -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ate = effect / weight
+        att = treated_effect / treated
+        atc = (effect - treated_effect) / (weight - treated)
+    return np.stack([ate, att, atc], axis=-1)
+
+
+def _grouped_measures(terms, weights):
+    """
+    Measures of every cell under each row of frequency weights, as a (B, n_cells, 3) array.
+    """
+    sums = np.asarray((terms.T @ weights.T).T)
+    return _measures_from_sums(sums.reshape(len(weights), -1, _N_TERMS))
+
+
+def subgroup_effects(x, t, y, groups, by, meta_learner='t_learner', num_bootstrap=1000,
+                     ci_level=95, seed=None, resampling='indices', refit=False, cache=None,
+                     outcome_learner=OUTCOME_LEARNER):
+    """
+    Estimate ATE, ATT and ATC and their bootstrap confidence intervals in every subgroup.
+    Parameters:
+    x (pd.DataFrame, np.ndarray or sp.csr_matrix): Feature matrix.
+    t (pd.Series or np.ndarray): Treatment assignments.
+    y (pd.Series or np.ndarray): Outcome variable.
+    groups (pd.DataFrame): Grouping columns of the same units, in the same order.
+    by (list of str or tuple): Group-by keys, each a column of `groups` or a tuple of
+        columns; the empty tuple is the whole population.
+    meta_learner (str): 't_learner' or 's_learner'.
+    num_bootstrap (int): Number of bootstrap replicates, shared by all cells; 0 to skip intervals.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI).
+    seed (int or None): Seed of the bootstrap random streams.
+    resampling (str): Resampling scheme of the frequency weights, as in `bci`.
+    refit (bool): Refit the learner on every replicate, once for all cells, instead of
+        holding the individual effects fixed.
+    cache (NuisanceCache or None): Cache of the fitted outcome models of the point estimate.
+    outcome_learner (str or dict): Learner spec of the outcome models (see learners.py).
+    Returns:
+    pd.DataFrame: One row per cell, with the group-by key, the values of its columns, the
+        numbers of units, treated and controls, the ATE, ATT and ATC, and the lower and
+        upper bounds of their intervals.
+    """
+    if meta_learner not in META_LEARNERS:
+        raise ValueError(f"Unknown meta-learner '{meta_learner}', expected one of {list(META_LEARNERS)}")
+    if resampling not in RESAMPLING_SCHEMES:
+        raise ValueError(f"Unknown resampling '{resampling}', expected one of {RESAMPLING_SCHEMES}")
+    if len(groups) != len(t):
+        raise ValueError(f'groups has {len(groups)} rows, expected {len(t)}')
+
+    t = np.asarray(t)
+    y = np.asarray(y)
+    keys, n_cells = _cell_codes(groups.reset_index(drop=True), by)
+    codes = [key_codes for _, _, _, key_codes in keys]
+    learner_class = META_LEARNERS[meta_learner]
+
+    # One fit and one prediction for every cell of every key
+    effects = learner_class(learner=outcome_learner).fit(x, t, y, cache=cache).predict_effect(x)
+    terms = _cell_terms(effects, t.astype(float), codes, n_cells)
+    sums = np.asarray(terms.T @ np.ones(len(t))).reshape(n_cells, _N_TERMS)
+    estimates = _measures_from_sums(sums)
+
+    # Frequency weights are drawn in blocks, so at most a block of them is held at once
+    seed_sequences = np.random.SeedSequence(seed).spawn(num_bootstrap)
+    replicates = np.empty((num_bootstrap, n_cells, 3))
+    for start in range(0, num_bootstrap, BOOTSTRAP_BLOCK_SIZE):
+        weights = bootstrap_weights(seed_sequences[start:start + BOOTSTRAP_BLOCK_SIZE], len(t),
+                                    resampling)
+        if not refit:
+            replicates[start:start + len(weights)] = _grouped_measures(terms, weights)
+            continue
+        for b, sample_weight in enumerate(weights, start):
+            replicate_effects = learner_class(learner=outcome_learner).fit(
+                x, t, y, sample_weight=sample_weight).predict_effect(x)
+            replicate_terms = _cell_terms(replicate_effects, t.astype(float), codes, n_cells)
+            replicates[b] = _grouped_measures(replicate_terms, sample_weight[None, :])[0]
+
+    lower_percentile = (100 - ci_level) / 2
+    if num_bootstrap:
+        # Replicates of a cell are NaN when they draw no treated or no control unit in it
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            intervals = np.nanpercentile(replicates, [lower_percentile, 100 - lower_percentile],
+                                         axis=0)
+    else:
+        intervals = np.full((2, n_cells, 3), np.nan)
+
+    tables = []
+    for key, cells, first_cell, _ in keys:
+        rows = np.arange(first_cell, first_cell + len(cells))
+        table = cells.copy()
+        table.insert(0, 'group_by', ' x '.join(key) if key else 'all')
+        table['n'] = sums[rows, 0].astype(int)
+        table['n_treated'] = sums[rows, 2].astype(int)
+        table['n_control'] = table['n'] - table['n_treated']
+        for i, measure in enumerate(['ate', 'att', 'atc']):
+            table[measure] = estimates[rows, i]
+            table[f'{measure}_ci_lower'] = intervals[0, rows, i]
+            table[f'{measure}_ci_upper'] = intervals[1, rows, i]
+        tables.append(table)
+
+    # Columns not in a key are missing in its rows
+    table = pd.concat(tables, ignore_index=True)
+    group_columns = [column for column in groups.columns if column in table.columns]
+    return table[['group_by'] + group_columns +
+                 [column for column in table.columns if column not in group_columns + ['group_by']]]
+
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+                         'processed_data.csv')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the effects in subgroups.')
+    parser.add_argument('--data', default=DATA_PATH, help='path of the processed data')
+    parser.add_argument('--by', nargs='+', default=SUBGROUP_COLUMNS,
+                        help='grouping columns, combined into every key up to --max-order')
+    parser.add_argument('--max-order', type=int, default=2,
+                        help='largest number of grouping columns combined')
+    parser.add_argument('--meta-learner', default='t_learner', choices=list(META_LEARNERS))
+    parser.add_argument('--num-bootstrap', type=int, default=1000,
+                        help='bootstrap replicates shared by all cells, 0 to skip intervals')
+    parser.add_argument('--refit', action='store_true',
+                        help='refit the learner on every replicate')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap replicates')
+    parser.add_argument('--output', default='subgroup_effects.csv', help='path of the CSV table')
+    args = parser.parse_args()
+
+    x_data, t_data, y_data = read_and_transform_data(args.data)
+    group_data = read_processed_data(args.data, columns=args.by)[args.by]
+    subgroup_table = subgroup_effects(x_data, t_data, y_data, group_data,
+                                      [()] + subgroup_keys(args.by, args.max_order),
+                                      meta_learner=args.meta_learner,
+                                      num_bootstrap=args.num_bootstrap, seed=args.seed,
+                                      refit=args.refit)
+    subgroup_table.to_csv(args.output, index=False)
+    print(subgroup_table.to_string(index=False))
@@ -1,8 +1,14 @@
 """
 This module implements the T-learner approach for causal inference using Gradient Boosting Classifier.
 
+Classes:
+    TLearner(learner=OUTCOME_LEARNER, transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        Persistable fitted T-learner with a batch `predict_effect(x)` API
+        (see effect_scoring.EffectLearner).
+
 Functions:
-    calculate_measures_t_learner(x, t, y):
+    calculate_measures_t_learner(x, t, y, cache=None, sample_weight=None,
+                                 outcome_learner=OUTCOME_LEARNER):
         Calculates the Average Treatment Effect (ATE),
         Average Treatment effect on the Treated (ATT),
         and Average Treatment effect on the Control (ATC) using the T-learner approach.
@@ -11,6 +17,9 @@ Functions:
             x (numpy.ndarray): Feature matrix.
             t (numpy.ndarray): Treatment indicator vector.
             y (numpy.ndarray): Outcome vector.
+            cache (NuisanceCache or None): Cache of fitted outcome models.
+            sample_weight (numpy.ndarray or None): Weights of the units.
+            outcome_learner (str or dict): Learner spec of the outcome models.
 
         Returns:
             tuple: A tuple containing ATE, ATT, and ATC.
@@ -39,12 +48,53 @@ Functions:
                    and the bootstrap samples for ATE, ATT, and ATC.
 """
 
-from sklearn.ensemble import GradientBoostingClassifier
 import numpy as np
 
-from utils import read_and_transform_data, bci
+from effect_scoring import EffectLearner, DEFAULT_CHUNK_SIZE
+from learners import OUTCOME_LEARNER
+from profiling import profiled
+from utils import read_and_transform_data, fit_outcome_models, as_design_matrix, bci
+
+class TLearner(EffectLearner):
+    """
+    Fitted T-learner predicting individual treatment effects as the difference between the
+    outcome probabilities of separate models for treated and control units.
+    Parameters:
+    learner (str or dict): Learner spec of the outcome models (see learners.py).
+    transformer (FeatureTransformer or None): Transformer applied to raw scoring inputs.
+    chunk_size (int): Number of rows scored at a time.
+    """
+
+    def __init__(self, learner=OUTCOME_LEARNER, transformer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(transformer=transformer, chunk_size=chunk_size)
+        self.learner = learner
 
-def calculate_measures_t_learner(x, t, y):
+    def fit(self, x, t, y, cache=None, sample_weight=None):
+        """
+        Fit the outcome models of the treated and control groups.
+        Parameters:
+        x (numpy.ndarray or pandas.DataFrame): Feature matrix.
+        t (numpy.ndarray or pandas.Series): Treatment indicator (1 for treated, 0 for control).
+        y (numpy.ndarray or pandas.Series): Outcome variable.
+        cache (NuisanceCache or None): Cache of fitted outcome models, None to always refit.
+        sample_weight (numpy.ndarray or None): Weights of the units in the fits.
+        Returns:
+        TLearner: The fitted learner.
+        """
+        self.model_1, self.model_0 = fit_outcome_models(x, t, y, cache=cache,
+                                                        sample_weight=sample_weight,
+                                                        learner=self.learner)
+        return self
+
+    def _predict_effect_chunk(self, x):
+        # Predict outcomes under both conditions
+        x = as_design_matrix(x)
+        return self.model_1.predict_proba(x)[:, 1] - self.model_0.predict_proba(x)[:, 1]
+
+
+@profiled()
+def calculate_measures_t_learner(x, t, y, cache=None, sample_weight=None,
+                                 outcome_learner=OUTCOME_LEARNER):
     """
     Calculate the Average Treatment Effect (ATE), Average Treatment effect on the Treated (ATT),
     and Average Treatment effect on the Controls (ATC) using the T-learner approach.
@@ -52,40 +102,32 @@ def calculate_measures_t_learner(x, t, y):
     x (numpy.ndarray or pandas.DataFrame): Feature matrix.
     t (numpy.ndarray or pandas.Series): Treatment indicator (1 for treated, 0 for control).
     y (numpy.ndarray or pandas.Series): Outcome variable.
+    cache (NuisanceCache or None): Cache of fitted outcome models, None to always refit.
+    sample_weight (numpy.ndarray or None): Weights of the units in the fits and the averages.
+    outcome_learner (str or dict): Learner spec of the outcome models (see learners.py).
     Returns:
     tuple: A tuple containing:
         - ate (float): Average Treatment Effect.
         - att (float): Average Treatment effect on the Treated.
         - atc (float): Average Treatment effect on the Controls.
     """
-    # Split data into treatment and control groups
-    x_1 = x[t == 1]
-    x_0 = x[t == 0]
-    y_1 = y[t == 1]
-    y_0 = y[t == 0]
-
-    # Fit models for each group
-    model_1 = GradientBoostingClassifier(random_state=42, learning_rate=0.1)
-    model_0 = GradientBoostingClassifier(random_state=42, learning_rate=0.1)
-
-    model_1.fit(x_1, y_1)
-    model_0.fit(x_0, y_0)
-
-    # Predict outcomes for all individuals under both conditions
-    y_pred_all_1 = model_1.predict_proba(x)[:, 1]
-    y_pred_all_0 = model_0.predict_proba(x)[:, 1]
+    # Fit models for the treatment and control groups
+    learner = TLearner(learner=outcome_learner).fit(x, t, y, cache=cache, sample_weight=sample_weight)
 
     # Calculate individual treatment effects
-    individual_effects = y_pred_all_1 - y_pred_all_0
+    individual_effects = learner.predict_effect(x)
+
+    t = np.asarray(t)
+    w = np.ones(len(t)) if sample_weight is None else sample_weight
 
     # Calculate ATE
-    ate = np.mean(individual_effects)
+    ate = np.average(individual_effects, weights=w)
 
     # Calculate ATT
-    att = np.mean(individual_effects[t == 1])
+    att = np.average(individual_effects[t == 1], weights=w[t == 1])
 
     # Calculate ATC
-    atc = np.mean(individual_effects[t == 0])
+    atc = np.average(individual_effects[t == 0], weights=w[t == 0])
 
     return ate, att, atc
 
@@ -0,0 +1,215 @@
+"""
+This module checks how sensitive the estimates are to the age threshold defining an adult
+(treated) student, by sweeping the threshold over a range of ages in one process pool.
+
+The processed data must keep the age at enrollment (`preprocessing.py --keep-age`).
+Records are filtered on qualifications only, so the units and their encoded covariates do
+not depend on the threshold: the data is read and transformed once and shipped once to
+every worker, and only the treatment is redefined per threshold, inside the workers. Each
+estimator and threshold contributes a point-estimate task and bootstrap tasks, scheduled
+together as in `run_estimators`, and fitted nuisance models are shared by the estimators of
+a threshold through the on-disk cache when a cache directory is given.
+
+Every threshold uses the same bootstrap random streams, seeded as in `utils.bci`, so the
+intervals of a threshold equal those of `bci(..., seed=seed)` on its treatment and the
+differences between thresholds are not blurred by different resamples.
+
+Functions:
+    sweep_thresholds(x, y, ages, thresholds, estimators, num_bootstrap=1000, ci_level=95,
+                     workers=1, seed=0, replicates_per_task=None, cache_dir=None):
+        Returns a tidy table of the estimates and intervals of every estimator and threshold.
+
+Usage:
+    python ../preprocessing.py --keep-age --out data/processed_data_age.csv
+    python threshold_sweep.py --data ../data/processed_data_age.csv --thresholds 18 19 20 21 \
+        --estimators ipw doubly_robust --num-bootstrap 1000 --workers 8 --output sweep.csv
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from nuisance_cache import NuisanceCache
+from run_estimators import ESTIMATORS
+from utils import (read_processed_data, read_and_transform_data, run_bootstrap_replicates,
+                   bootstrap_intervals, as_design_matrix, AGE_COLUMN)
+
+DEFAULT_THRESHOLDS = tuple(range(18, 31))
+
+# Per-process state of the sweep workers, populated once by _init_worker
+_WORKER_STATE = {}
+
+
+def treatment_at(ages, threshold):
+    """
+    Treatment indicator of students at least `threshold` years old at enrollment.
+    """
+    return (np.asarray(ages) >= threshold).astype(np.int64)
+
+
+def _init_worker(x, y, ages, cache_dir):
+    """
+    Store the shared data in the worker process; treatments are derived from the ages.
+    """
+    _WORKER_STATE.update(x=x, y=y, ages=ages, treatments={})
+    _WORKER_STATE['cache'] = None if cache_dir is None else NuisanceCache(cache_dir=cache_dir)
+
+
+def _treatment(threshold):
+    treatments = _WORKER_STATE['treatments']
+    if threshold not in treatments:
+        treatments[threshold] = treatment_at(_WORKER_STATE['ages'], threshold)
+    return treatments[threshold]
+
+
+def _point_task(name, threshold):
+    """
+    Calculate the point estimates of an estimator with the treatment at a threshold.
+    """
+    start = time.perf_counter()
+    state = _WORKER_STATE
+    cache = {} if state['cache'] is None else {'cache': state['cache']}
+    ate, att, atc = ESTIMATORS[name](state['x'], _treatment(threshold), state['y'], **cache)
+    return (float(ate), float(att), float(atc)), time.perf_counter() - start
+
+
+def _bootstrap_task(name, threshold, seed_sequences):
+    """
+    Run a block of bootstrap replicates of an estimator with the treatment at a threshold.
+    """
+    start = time.perf_counter()
+    state = _WORKER_STATE
+    results = run_bootstrap_replicates(state['x'], _treatment(threshold), state['y'],
+                                       ESTIMATORS[name], seed_sequences)
+    return results, time.perf_counter() - start
+
+
+def sweep_thresholds(x, y, ages, thresholds, estimators, num_bootstrap=1000, ci_level=95,
+                     workers=1, seed=0, replicates_per_task=None, cache_dir=None):
+    """
+    Calculate ATE, ATT and ATC and their bootstrap confidence intervals of several estimators,
+    with the treatment defined by each of several age thresholds.
+    Parameters:
+    x (pd.DataFrame, np.ndarray or sp.csr_matrix): Feature matrix, without the age.
+    y (pd.Series or np.ndarray): Outcome variable.
+    ages (pd.Series or np.ndarray): Age at enrollment of every unit.
+    thresholds (list of int): Minimal ages of a treated student.
+    estimators (list of str): Names of estimators, keys of run_estimators.ESTIMATORS.
+    num_bootstrap (int): Number of bootstrap replicates per estimator and threshold, 0 to
+        skip intervals.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI).
+    workers (int): Number of worker processes, -1 uses all cores.
+    seed (int): Seed of the bootstrap random streams, shared by all thresholds.
+    replicates_per_task (int or None): Replicates per bootstrap task, None to spread every
+        estimator's replicates over about four tasks per worker.
+    cache_dir (str or None): Directory of fitted nuisance models shared by the point tasks.
+    Returns:
+    pd.DataFrame: One row per threshold and estimator, with the numbers of treated and
+        control units, the ATE, ATT and ATC, the bounds of their intervals and task seconds.
+    """
+    unknown = set(estimators) - set(ESTIMATORS)
+    if unknown:
+        raise ValueError(f'Unknown estimators {sorted(unknown)}, expected some of {list(ESTIMATORS)}')
+
+    ages = np.ascontiguousarray(ages)
+    n_treated = {threshold: int(treatment_at(ages, threshold).sum()) for threshold in thresholds}
+    degenerate = [threshold for threshold, count in n_treated.items() if count in (0, len(ages))]
+    if degenerate:
+        raise ValueError(f'Thresholds {degenerate} leave no treated or no control units')
+
+    if workers == -1:
+        workers = os.cpu_count() or 1
+    if replicates_per_task is None:
+        replicates_per_task = max(1, num_bootstrap // (4 * workers))
+
+    # Encoded once for every threshold
+    x = as_design_matrix(x)
+    y = np.ascontiguousarray(y)
+
+    cells = [(threshold, name) for threshold in thresholds for name in estimators]
+    results = {cell: {'bootstrap_seconds': 0.0} for cell in cells}
+    replicates = {cell: [None] * num_bootstrap for cell in cells}
+    remaining_blocks = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(x, y, ages, cache_dir)) as executor:
+        futures = {}
+        for threshold, name in cells:
+            futures[executor.submit(_point_task, name, threshold)] = ((threshold, name), None)
+
+        seed_sequences = np.random.SeedSequence(seed).spawn(num_bootstrap)
+        starts = range(0, num_bootstrap, replicates_per_task)
+        for threshold, name in cells:
+            remaining_blocks[threshold, name] = len(starts)
+            for block_start in starts:
+                block = seed_sequences[block_start:block_start + replicates_per_task]
+                future = executor.submit(_bootstrap_task, name, threshold, block)
+                futures[future] = ((threshold, name), block_start)
+
+        for future in as_completed(futures):
+            cell, block_start = futures[future]
+            output, seconds = future.result()
+
+            if block_start is None:
+                results[cell].update(ate=output[0], att=output[1], atc=output[2],
+                                     point_seconds=seconds)
+                continue
+
+            replicates[cell][block_start:block_start + len(output)] = output
+            results[cell]['bootstrap_seconds'] += seconds
+            remaining_blocks[cell] -= 1
+
+            # All blocks of this estimator and threshold are done
+            if remaining_blocks[cell] == 0:
+                intervals = bootstrap_intervals(replicates[cell], ci_level)[:3]
+                for measure, interval in zip(['ate', 'att', 'atc'], intervals):
+                    results[cell][f'{measure}_ci_lower'] = interval[0]
+                    results[cell][f'{measure}_ci_upper'] = interval[1]
+
+    rows = [{'threshold': threshold, 'estimator': name, 'n_treated': n_treated[threshold],
+             'n_control': len(ages) - n_treated[threshold], **results[threshold, name]}
+            for threshold, name in cells]
+    columns = ['threshold', 'estimator', 'n_treated', 'n_control']
+    for measure in ['ate', 'att', 'atc']:
+        columns += [measure, f'{measure}_ci_lower', f'{measure}_ci_upper']
+    columns += ['point_seconds', 'bootstrap_seconds']
+    return pd.DataFrame(rows).reindex(columns=columns)
+
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+                         'processed_data_age.csv')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep the age threshold of the treatment.')
+    parser.add_argument('--data', default=DATA_PATH,
+                        help='path of processed data written with preprocessing.py --keep-age')
+    parser.add_argument('--thresholds', type=int, nargs='+', default=list(DEFAULT_THRESHOLDS),
+                        help='minimal ages of a treated student')
+    parser.add_argument('--estimators', nargs='+', default=list(ESTIMATORS),
+                        choices=list(ESTIMATORS), help='estimators to run')
+    parser.add_argument('--num-bootstrap', type=int, default=1000,
+                        help='bootstrap replicates per estimator and threshold, 0 to skip intervals')
+    parser.add_argument('--ci-level', type=float, default=95, help='confidence interval level')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, -1 for all cores')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap replicates')
+    parser.add_argument('--cache-dir', default=None, help='directory of fitted nuisance models')
+    parser.add_argument('--sparse', action='store_true',
+                        help='use a sparse CSR design matrix instead of a dense one')
+    parser.add_argument('--output', default='threshold_sweep.csv', help='path of the CSV table')
+    args = parser.parse_args()
+
+    age_data = read_processed_data(args.data)
+    if AGE_COLUMN not in age_data.columns:
+        raise ValueError(f"{args.data} has no '{AGE_COLUMN}' column, run preprocessing.py --keep-age")
+    x_data, _, y_data = read_and_transform_data(args.data, sparse=args.sparse)
+
+    sweep = sweep_thresholds(x_data, y_data, age_data[AGE_COLUMN], args.thresholds,
+                             args.estimators, num_bootstrap=args.num_bootstrap,
+                             ci_level=args.ci_level, workers=args.workers, seed=args.seed,
+                             cache_dir=args.cache_dir)
+    sweep.to_csv(args.output, index=False)
+    print(sweep.to_string(index=False))
@@ -2,22 +2,120 @@
 Utility functions for estimating treatment effects.
 """
 
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler
+from scipy import sparse as sp
+from scipy.stats import norm
+
+from feature_transformer import FeatureTransformer, NUMERICAL_COLUMNS
+from learners import make_learner, resolve_learner, PROPENSITY_LEARNER, OUTCOME_LEARNER
+from nuisance_cache import fingerprint
+from profiling import profiled, stage
+
+
+# Bump when the transformation changes, to invalidate cached design matrices
+DESIGN_CACHE_VERSION = 2
+
+# Defines the treatment, so it is never a covariate; kept in processed data for threshold sweeps
+AGE_COLUMN = 'Age at enrollment'
+
+
+# Comparison operators of row filters, as in pandas.read_parquet
+_FILTER_OPERATORS = {
+    '==': lambda column, value: column == value,
+    '=': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    'in': lambda column, value: column.isin(value),
+    'not in': lambda column, value: ~column.isin(value),
+}
 
 
-def read_and_transform_data(data_path):
+@profiled()
+def read_processed_data(data_path, columns=None, filters=None):
     """
-    Reads a CSV file,
+    Read processed data from a CSV, Parquet or Feather file, chosen by the file extension.
+    Parameters:
+        data_path (str): Path of a .csv, .parquet or .feather file.
+        columns (list of str or None): Feature columns to read, None for all. The 'Adult' and
+            'Target' columns are always read.
+        filters (list of tuple or None): Row filters (column, operator, value), all of which a
+            row must satisfy, e.g. [('Course', '==', 9500)]. Operators are ==, !=, <, <=, >,
+            >=, 'in' and 'not in'.
+    Returns:
+        pd.DataFrame: The selected rows and columns, columns in the order given.
+    Notes:
+        - Parquet files are read with the projection and the filters pushed down, so only
+        the needed columns and row groups are decoded.
+        - Feather and CSV files are read with the projection, and filtered once loaded.
+    """
+    filters = list(filters or [])
+    if columns is None:
+        selected = None
+        read_columns = None
+    else:
+        selected = list(dict.fromkeys(list(columns) + ['Adult', 'Target']))
+        read_columns = list(dict.fromkeys(selected + [column for column, _, _ in filters]))
+
+    for _, operator, _ in filters:
+        if operator not in _FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator '{operator}', expected one of "
+                             f"{list(_FILTER_OPERATORS)}")
+
+    extension = os.path.splitext(data_path)[1].lower()
+    if extension == '.parquet':
+        return pd.read_parquet(data_path, columns=selected, filters=filters or None)
+
+    if extension == '.feather':
+        data = pd.read_feather(data_path, columns=read_columns)
+    else:
+        data = pd.read_csv(data_path, usecols=read_columns)
+
+    if filters:
+        keep = np.ones(len(data), dtype=bool)
+        for column, operator, value in filters:
+            keep &= np.asarray(_FILTER_OPERATORS[operator](data[column], value))
+        data = data[keep].reset_index(drop=True)
+
+    return data if selected is None else data[selected]
+
+
+@profiled()
+def read_and_transform_data(data_path, cache_dir=None, transformer=None, sparse=False,
+                            columns=None, filters=None):
+    """
+    Reads a CSV, Parquet or Feather file,
     processes the data by scaling numerical columns and one-hot encoding categorical columns,
     and returns the transformed features, treatment indicator, and target variable.
     Args:
         data_path (str): The file path to the CSV data file.
+        cache_dir (str or None): Directory of cached transformed data. When given, the
+            transformed data is stored there as .npy files on the first call, and later calls
+            on the same, unmodified file memory-map them read-only instead of re-parsing.
+        transformer (FeatureTransformer or None): Transformer to apply. A fitted transformer
+            is applied as is, so new files get its column layout; an unfitted one is fitted
+            on this file and can then be saved. None fits a new transformer.
+        sparse (bool): Return the features as a SciPy CSR matrix instead of a DataFrame,
+            storing only the numerical values and the set indicators. Column positions are
+            given by `transformer.column_index_`.
+        columns (list of str or None): Feature columns to read, None for all; see
+            read_processed_data. Numerical columns left out are not scaled.
+        filters (list of tuple or None): Row filters, pushed down into Parquet files; see
+            read_processed_data.
     Returns:
         tuple: A tuple containing:
-            - X (pd.DataFrame): The transformed feature matrix.
+            - X (pd.DataFrame or sp.csr_matrix): The transformed feature matrix.
             - t (pd.Series): The treatment indicator (column 'Adult').
             - y (pd.Series): The target variable (column 'Target').
     Notes:
@@ -25,43 +123,205 @@ def read_and_transform_data(data_path):
         - Categorical columns are one-hot encoded,
         with the first category dropped to avoid multicollinearity.
         - The column 'Application mode_39' is removed from the transformed feature matrix.
+        - The age at enrollment, kept by `preprocessing.preprocess(keep_age=True)`, is not a feature.
+        - Features are float64 columns, numerical columns first.
     """
 
-    data = pd.read_csv(data_path)
+    if transformer is None:
+        if columns is None:
+            transformer = FeatureTransformer()
+        else:
+            transformer = FeatureTransformer(
+                numerical_columns=[col for col in NUMERICAL_COLUMNS if col in columns])
+
+    if cache_dir is not None:
+        entry = _design_cache_path(data_path, cache_dir, transformer, sparse, columns, filters)
+        cached = _load_cached_design(data_path, entry, transformer)
+        if cached is not None:
+            return cached
+
+    data = read_processed_data(data_path, columns=columns, filters=filters)
 
     t = data['Adult']
     y = data['Target']
-    x = data.drop(columns=['Adult', 'Target'])
+    x = data.drop(columns=['Adult', 'Target']).drop(columns=[AGE_COLUMN], errors='ignore')
+
+    if not transformer.is_fitted():
+        with stage('transformer_fit', rows=len(x)):
+            transformer.fit(x)
+    with stage('transformer_transform', rows=len(x), sparse=sparse):
+        x = transformer.transform(x, sparse=sparse)
+
+    if cache_dir is not None:
+        _save_cached_design(data_path, entry, transformer, x, t, y)
+        return _load_cached_design(data_path, entry, transformer)
+
+    return x, t, y
 
-    numerical_columns = ['Previous qualification (grade)', 'Admission grade',
-                         'Unemployment rate', 'Inflation rate', 'GDP']
-    categorical_columns = list(set(x.columns) - set(numerical_columns))
+def file_hash(path):
+    """
+    Calculate the hash of a file's contents, reading it in blocks.
+    Parameters:
+    path (str): Path of the file.
+    Returns:
+    str: Hex digest of the contents, which identifies the file's version.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-    # Scaling numerical columns
-    scaler = StandardScaler()
-    x[numerical_columns] = scaler.fit_transform(x[numerical_columns])
+def _design_cache_path(data_path, cache_dir, transformer, sparse=False, columns=None, filters=None):
+    """
+    Directory holding the cached design of a data file. A transformer fitted beforehand gets
+    its own entry, while an unfitted one uses the entry of the transformer fitted on the file.
+    Sparse designs and every projection and filter have entries of their own.
+    """
+    key = os.path.abspath(data_path)
+    if transformer.is_fitted():
+        key += transformer.fingerprint()
+    if sparse:
+        key += ':sparse'
+    if columns is not None or filters:
+        key += repr((list(columns or []), [tuple(f) for f in filters or []]))
+    path_hash = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    stem = os.path.splitext(os.path.basename(data_path))[0]
+    return os.path.join(cache_dir, f'{stem}-{path_hash}')
 
-    # One-hot encoding for categorical columns
-    x = pd.get_dummies(x, columns=categorical_columns, drop_first=True)
+def _load_cached_design(data_path, entry, transformer):
+    """
+    Memory-map the cached design of a data file, or return None if it is missing or stale.
+    A cache entry is fresh when the file's modification time and size are unchanged, or
+    when its contents hash to the cached value. An unfitted transformer receives the
+    cached fitted state.
+    """
+    manifest_path = os.path.join(entry, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest['version'] != DESIGN_CACHE_VERSION:
+        return None
+
+    stat = os.stat(data_path)
+    if (manifest['mtime_ns'], manifest['size']) != (stat.st_mtime_ns, stat.st_size):
+        if manifest['hash'] != file_hash(data_path):
+            return None
+        # Same contents under a new modification time
+        manifest.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        write_json_atomic(manifest_path, manifest)
 
-    # remove from data the column Application mode_39
-    x = x.drop(columns=['Application mode_39'])
+    if not transformer.is_fitted():
+        transformer.set_state(manifest['transformer'])
+
+    names = ('x_data', 'x_indices', 'x_indptr') if manifest.get('sparse') else ('x',)
+    arrays = {name: np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='r')
+              for name in names + ('t', 'y')}
+    if manifest.get('sparse'):
+        x = sp.csr_matrix((arrays['x_data'], arrays['x_indices'], arrays['x_indptr']),
+                          shape=(len(arrays['y']), len(manifest['columns'])), copy=False)
+    else:
+        x = pd.DataFrame(arrays['x'], columns=manifest['columns'], copy=False)
+    t = pd.Series(arrays['t'], name='Adult', copy=False)
+    y = pd.Series(arrays['y'], name='Target', copy=False)
 
     return x, t, y
 
-def calculate_propensity_scores(x, t):
+def _save_cached_design(data_path, entry, transformer, x, t, y):
+    """
+    Store a transformed design as .npy files with a manifest of its columns, transformer
+    and source file. A CSR design is stored as its data, indices and indptr arrays.
     """
-    Calculate propensity scores using a Gradient Boosting Classifier.
+    cache_dir = os.path.dirname(entry)
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(data_path)
+
+    # Build the entry in a temporary directory and move it in place once complete
+    tmp_entry = tempfile.mkdtemp(dir=cache_dir)
+    if sp.issparse(x):
+        for name in ('data', 'indices', 'indptr'):
+            np.save(os.path.join(tmp_entry, f'x_{name}.npy'), getattr(x, name))
+    else:
+        np.save(os.path.join(tmp_entry, 'x.npy'), np.ascontiguousarray(x, dtype=float))
+    np.save(os.path.join(tmp_entry, 't.npy'), np.ascontiguousarray(t))
+    np.save(os.path.join(tmp_entry, 'y.npy'), np.ascontiguousarray(y))
+    write_json_atomic(os.path.join(tmp_entry, 'manifest.json'), {
+        'version': DESIGN_CACHE_VERSION,
+        'source': os.path.abspath(data_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'hash': file_hash(data_path),
+        'columns': list(transformer.feature_names_),
+        'sparse': sp.issparse(x),
+        'transformer': transformer.get_state(),
+    })
+
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.replace(tmp_entry, entry)
+
+def write_json_atomic(path, content):
+    """
+    Write JSON to a temporary file and rename it over `path`, so readers never see a
+    partially written file.
+    Parameters:
+    path (str): Destination file.
+    content (dict or list): JSON-serializable content.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def as_design_matrix(x):
+    """
+    Convert a feature matrix once for repeated row access: sparse matrices become CSR,
+    anything else a contiguous float64 array.
+    """
+    if sp.issparse(x):
+        return sp.csr_matrix(x, dtype=float)
+    return np.ascontiguousarray(x, dtype=float)
+
+def take_rows(x, indices, out=None):
+    """
+    Gather rows of a design matrix, into `out` when given and x is dense.
+    """
+    if sp.issparse(x):
+        return x[indices]
+    return np.take(x, indices, axis=0, out=out)
+
+@profiled('propensity_fit')
+def fit_propensity_model(x, t, sample_weight=None, learner=PROPENSITY_LEARNER):
+    """
+    Fit the classifier used to estimate propensity scores.
     Parameters:
     X (pd.DataFrame or np.ndarray): The feature matrix.
     t (pd.Series or np.ndarray): The treatment assignment vector.
+    sample_weight (np.ndarray or None): Weights of the units when fitting the model.
+    learner (str or dict): Learner spec of the propensity model (see learners.py),
+        a random forest by default.
     Returns:
-    np.ndarray: The propensity scores, clipped to avoid extreme values.
+    sklearn classifier: The fitted propensity model.
     """
+    propensity_model = make_learner(learner)
+    # Fitted on the bare matrix, so cached models serve DataFrame and ndarray callers alike
+    propensity_model.fit(as_design_matrix(x), t, sample_weight=sample_weight)
+    return propensity_model
 
-    propensity_model = RandomForestClassifier(random_state=42)
-    propensity_model.fit(x, t)
-    e = propensity_model.predict_proba(x)[:, 1]
+@profiled('propensity_predict')
+def predict_propensity_scores(propensity_model, x):
+    """
+    Predict propensity scores with a fitted propensity model.
+    Parameters:
+    propensity_model (sklearn classifier): Model returned by fit_propensity_model.
+    X (pd.DataFrame or np.ndarray): The feature matrix.
+    Returns:
+    np.ndarray: The propensity scores, clipped to avoid extreme values.
+    """
+    e = propensity_model.predict_proba(as_design_matrix(x))[:, 1]
 
     # Clip propensity scores to avoid extreme values
     epsilon = 1e-5
@@ -69,17 +329,348 @@ def calculate_propensity_scores(x, t):
 
     return e
 
-def bci(x, t, y, calculate_measures, num_bootstrap=1000, ci_level=95, **kwargs):
+@profiled()
+def calculate_propensity_scores(x, t, cache=None, sample_weight=None, learner=PROPENSITY_LEARNER):
+    """
+    Calculate propensity scores using a Random Forest Classifier or another learner.
+    Parameters:
+    X (pd.DataFrame or np.ndarray): The feature matrix.
+    t (pd.Series or np.ndarray): The treatment assignment vector.
+    cache (NuisanceCache or None): Cache of fitted models, None to always refit.
+    sample_weight (np.ndarray or None): Weights of the units when fitting the model.
+    learner (str or dict): Learner spec of the propensity model (see learners.py).
+    Returns:
+    np.ndarray: The propensity scores, clipped to avoid extreme values.
+    """
+
+    def fit():
+        propensity_model = fit_propensity_model(x, t, sample_weight=sample_weight, learner=learner)
+        return propensity_model, predict_propensity_scores(propensity_model, x)
+
+    if cache is None:
+        return fit()[1]
+    arrays = (x, t) if sample_weight is None else (x, t, sample_weight)
+    return cache.get_or_fit('propensity', arrays, resolve_learner(learner), fit)[1]
+
+@profiled()
+def fit_outcome_models(x, t, y, cache=None, sample_weight=None, learner=OUTCOME_LEARNER):
+    """
+    Fits outcome models for treated and control groups using Gradient Boosting Classifier
+    or another learner.
+    Parameters:
+    x (numpy.ndarray or pandas.DataFrame): Feature matrix.
+    t (numpy.ndarray or pandas.Series): Treatment indicator (1 for treated, 0 for control).
+    y (numpy.ndarray or pandas.Series): Outcome variable.
+    cache (NuisanceCache or None): Cache of fitted models, None to always refit.
+    sample_weight (np.ndarray or None): Weights of the units when fitting the models.
+    learner (str or dict): Learner spec of both outcome models (see learners.py).
+    Returns:
+    tuple: A tuple containing two fitted classifiers:
+        - model_1: Fitted model for the treated group.
+        - model_0: Fitted model for the control group.
+    """
+
+    def fit():
+        # Fitted on the bare matrix, so cached models serve DataFrame and ndarray callers alike
+        treated = np.asarray(t) == 1
+        x_design = as_design_matrix(x)
+        x_1 = x_design[treated]
+        x_0 = x_design[~treated]
+        y_1 = y[treated]
+        y_0 = y[~treated]
+        w_1 = None if sample_weight is None else sample_weight[treated]
+        w_0 = None if sample_weight is None else sample_weight[~treated]
+
+        model_1 = make_learner(learner)
+        with stage('outcome_fit', arm='treated', rows=x_1.shape[0]):
+            model_1.fit(x_1, y_1, sample_weight=w_1)
+
+        model_0 = make_learner(learner)
+        with stage('outcome_fit', arm='control', rows=x_0.shape[0]):
+            model_0.fit(x_0, y_0, sample_weight=w_0)
+
+        return model_1, model_0
+
+    if cache is None:
+        return fit()
+    arrays = (x, t, y) if sample_weight is None else (x, t, y, sample_weight)
+    return cache.get_or_fit('outcome', arrays, resolve_learner(learner), fit)
+
+def measures_from_effects(att_effects, atc_effects):
+    """
+    Aggregate the effects of matched units into ATE, ATT and ATC.
+    Parameters:
+    att_effects (np.ndarray): Effects of the matched treated units.
+    atc_effects (np.ndarray): Effects of the matched control units.
+    Returns:
+    tuple: ate, att and atc, NaN where no unit was matched.
+    """
+    individual_effects = np.concatenate([att_effects, atc_effects])
+
+    ate = np.mean(individual_effects) if len(individual_effects) else np.nan
+    att = np.mean(att_effects) if len(att_effects) else np.nan
+    atc = np.mean(atc_effects) if len(atc_effects) else np.nan
+
+    return ate, att, atc
+
+# Per-process state for bootstrap workers, populated once by _init_bootstrap_worker
+_BOOTSTRAP_STATE = {}
+
+RESAMPLING_SCHEMES = ('indices', 'multinomial', 'poisson')
+
+
+def _init_bootstrap_worker(x, t, y, calculate_measures, resampling, kwargs):
+    """
+    Store the data and the estimator in the worker process, so the data is pickled
+    once per worker rather than once per replicate. Resampled rows are gathered into
+    buffers allocated here and reused by every replicate.
+    """
+    _BOOTSTRAP_STATE.update(x=x, t=t, y=y, calculate_measures=calculate_measures,
+                            resampling=resampling, kwargs=kwargs)
+    if resampling == 'indices':
+        # Sparse rows are gathered into new matrices, their size varying between replicates
+        _BOOTSTRAP_STATE.update(x_buffer=None if sp.issparse(x) else np.empty_like(x),
+                                t_buffer=np.empty_like(t), y_buffer=np.empty_like(y))
+
+
+@profiled('bootstrap_replicate')
+def _run_bootstrap_replicate(seed_sequence):
+    """
+    Run a single bootstrap replicate using its own random stream.
+    Parameters:
+    seed_sequence (np.random.SeedSequence): Seed of this replicate.
+    Returns:
+    tuple: ATE, ATT and ATC of the bootstrap sample.
+    """
+    state = _BOOTSTRAP_STATE
+    x, t, y = state['x'], state['t'], state['y']
+    calculate_measures = state['calculate_measures']
+    n = len(y)
+
+    rng = np.random.default_rng(seed_sequence)
+
+    if state['resampling'] == 'indices':
+        # Gather the resampled rows (with replacement) into the reused buffers
+        with stage('bootstrap_resample'):
+            indices = rng.integers(0, n, size=n)
+            x_bootstrap = take_rows(x, indices, out=state['x_buffer'])
+            t_bootstrap = np.take(t, indices, out=state['t_buffer'])
+            y_bootstrap = np.take(y, indices, out=state['y_buffer'])
+        return calculate_measures(x_bootstrap, t_bootstrap, y_bootstrap, **state['kwargs'])
+
+    # Frequency weights of the resample, without materialising it
+    with stage('bootstrap_resample'):
+        sample_weight = _draw_frequency_weights(rng, n, state['resampling'])
+    return calculate_measures(x, t, y, sample_weight=sample_weight, **state['kwargs'])
+
+
+def _draw_frequency_weights(rng, n, resampling):
+    """
+    Draw how many times each of the n units appears in a resample.
+    """
+    if resampling == 'indices':
+        # Same draws as the 'indices' replicates, counted per unit
+        return np.bincount(rng.integers(0, n, size=n), minlength=n).astype(float)
+    if resampling == 'multinomial':
+        return rng.multinomial(n, np.full(n, 1 / n)).astype(float)
+    return rng.poisson(1.0, size=n).astype(float)
+
+
+@profiled()
+def bootstrap_weights(seed_sequences, n, resampling='indices'):
+    """
+    Draw the frequency weights of bootstrap replicates as a matrix.
+    Parameters:
+    seed_sequences (list of np.random.SeedSequence): Seed of every replicate, as `bci` spawns them
+    n (int): Number of units
+    resampling (str): Resampling scheme, as in `bci`; the weights of a replicate match the
+        sample `bci` draws from the same seed
+    Returns:
+    np.ndarray: (len(seed_sequences), n) matrix of frequency weights.
+    """
+    if resampling not in RESAMPLING_SCHEMES:
+        raise ValueError(f"Unknown resampling '{resampling}', expected one of {RESAMPLING_SCHEMES}")
+
+    weights = np.empty((len(seed_sequences), n), dtype=float)
+    for row, seed_sequence in enumerate(seed_sequences):
+        weights[row] = _draw_frequency_weights(np.random.default_rng(seed_sequence), n, resampling)
+    return weights
+
+
+def run_bootstrap_replicates(x, t, y, calculate_measures, seed_sequences, resampling='indices',
+                             **kwargs):
+    """
+    Run bootstrap replicates in this process.
+    Parameters:
+    x (np.ndarray): Contiguous feature matrix
+    t (np.ndarray): Treatment assignments
+    y (np.ndarray): Outcome variable
+    calculate_measures (function): Function to calculate ATE, ATT, and ATC for a given sample
+    seed_sequences (list of np.random.SeedSequence): Seed of every replicate to run
+    resampling (str): Resampling scheme, as in `bci`
+    **kwargs: Additional keyword arguments to pass to calculate_measures function
+    Returns:
+    list of tuple: (ATE, ATT, ATC) of every replicate.
+    """
+    _init_bootstrap_worker(x, t, y, calculate_measures, resampling, kwargs)
+    try:
+        return [_run_bootstrap_replicate(s) for s in seed_sequences]
+    finally:
+        _BOOTSTRAP_STATE.clear()
+
+
+class _BootstrapCheckpoint:
+    """
+    Append-only file of the completed replicates of a bootstrap run.
+
+    The first line is a JSON header identifying the run: the entropy of its root seed and a
+    fingerprint of the data, the estimator, its arguments and the resampling scheme. Every
+    following line holds the index and the (ATE, ATT, ATC) of one replicate, flushed and
+    synced to disk as soon as the replicate completes. A line cut short by a crash is
+    discarded when the file is opened again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, seed, run_key):
+        self.path = path
+        self.completed = {}
+
+        if os.path.exists(path):
+            entropy = self._load(seed, run_key)
+        else:
+            entropy = np.random.SeedSequence(seed).entropy
+            header = {'version': self.VERSION, 'entropy': entropy, 'run': run_key}
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+        # Entropy drawn by a seedless run is reused, so resumed replicates use the same streams
+        self.seed_sequence = np.random.SeedSequence(entropy)
+        self._file = open(path, 'ab')  # pylint: disable=consider-using-with
+
+    def _load(self, seed, run_key):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+
+        # Everything after the last newline is a partial line
+        *lines, partial = content.split(b'\n')
+        if partial:
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(content) - len(partial))
+
+        header = json.loads(lines[0])
+        if header.get('version') != self.VERSION or header.get('run') != run_key:
+            raise ValueError(f'Checkpoint {self.path} belongs to a different bootstrap run')
+        if seed is not None and np.random.SeedSequence(seed).entropy != header['entropy']:
+            raise ValueError(f'Checkpoint {self.path} was written with a different seed')
+
+        for line in lines[1:]:
+            record = json.loads(line)
+            self.completed[record['replicate']] = tuple(record['result'])
+        return header['entropy']
+
+    def record(self, index, result):
+        """
+        Append a completed replicate and sync it to disk.
+        Returns:
+        tuple: The replicate's (ATE, ATT, ATC) as floats, as they are read back on resume.
+        """
+        result = tuple(float(value) for value in result)
+        self._file.write((json.dumps({'replicate': index, 'result': result}) + '\n').encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.completed[index] = result
+        return result
+
+    def close(self):
+        self._file.close()
+
+
+def _open_checkpoint(path, x, t, y, calculate_measures, resampling, seed, kwargs):
+    """
+    Open the checkpoint of a bootstrap run, identified by its data, estimator, arguments
+    and resampling scheme.
+    """
+    # The cache holds fitted models, not settings, so it does not identify the run
+    settings = sorted((key, value) for key, value in kwargs.items() if key != 'cache')
+    run_key = fingerprint(x, t, y, config=(calculate_measures.__module__,
+                                           calculate_measures.__qualname__, resampling, settings))
+    return _BootstrapCheckpoint(path, seed, run_key)
+
+
+@contextmanager
+def _replicate_runner(x, t, y, calculate_measures, resampling, kwargs, n_jobs):
+    """
+    Provide a function running the replicates of a list of seed sequences and yielding their
+    results in order, in this process or in a pool of n_jobs workers kept for every call.
+    """
+    if n_jobs == 1:
+        _init_bootstrap_worker(x, t, y, calculate_measures, resampling, kwargs)
+        try:
+            yield lambda seed_sequences: map(_run_bootstrap_replicate, seed_sequences)
+        finally:
+            _BOOTSTRAP_STATE.clear()
+        return
+
+    initargs = (x, t, y, calculate_measures, resampling, kwargs)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_bootstrap_worker,
+                             initargs=initargs) as executor:
+        yield lambda seed_sequences: executor.map(
+            _run_bootstrap_replicate, seed_sequences,
+            chunksize=max(1, len(seed_sequences) // (4 * n_jobs)))
+
+
+def _collect_replicates(run, seed_sequences, indices, store=None):
+    """
+    Results of the replicates at `indices`, running only those missing from the checkpoint
+    and recording each as it arrives.
+    """
+    if store is None:
+        return list(run([seed_sequences[index] for index in indices]))
+
+    pending = [index for index in indices if index not in store.completed]
+    for index, result in zip(pending, run([seed_sequences[index] for index in pending])):
+        store.record(index, result)
+    return [store.completed[index] for index in indices]
+
+
+@profiled()
+def bci(x, t, y, calculate_measures, num_bootstrap=1000, ci_level=95,
+        n_jobs=1, seed=None, resampling='indices', checkpoint=None, **kwargs):
     """
     Perform bootstrap resampling to calculate confidence intervals for ATE, ATT, and ATC.
 
+    Every replicate draws its sample from its own random stream, spawned from `seed`,
+    so the results are identical regardless of the number of workers. The data is
+    converted once to contiguous NumPy arrays, and the estimator receives NumPy arrays;
+    a sparse feature matrix stays a CSR matrix.
+
+    With `checkpoint`, every completed replicate is appended to that file and synced to
+    disk. Run again with the same arguments after an interruption, bci reads the
+    completed replicates back and runs only the missing ones, from their own streams, so
+    the intervals are exactly those of an uninterrupted run. A checkpoint written with
+    `seed=None` records the entropy it drew and is resumed with it. A larger
+    `num_bootstrap` extends a finished run.
+
     Parameters:
-    X (pd.DataFrame): Feature matrix
+    X (pd.DataFrame or sp.spmatrix): Feature matrix
     t (pd.Series): Treatment assignments
     y (pd.Series): Outcome variable
     calculate_measures (function): Function to calculate ATE, ATT, and ATC for a given sample
     num_bootstrap (int): Number of bootstrap iterations
     ci_level (float): Confidence interval level (e.g., 95 for 95% CI)
+    n_jobs (int): Number of worker processes, -1 uses all cores, 1 runs in this process
+    seed (int or None): Seed of the bootstrap random streams
+    resampling (str): 'indices' gathers the resampled rows; 'multinomial' and 'poisson'
+        pass bootstrap frequency weights as `sample_weight` to calculate_measures instead,
+        which must then accept that argument
+    checkpoint (str or None): Path of the checkpoint file of completed replicates, created
+        if missing; a checkpoint of another run (data, estimator, arguments, resampling or
+        seed) raises ValueError
     **kwargs: Additional keyword arguments to pass to calculate_measures function
 
     Returns:
@@ -91,30 +682,161 @@ def bci(x, t, y, calculate_measures, num_bootstrap=1000, ci_level=95, **kwargs):
         - bootstrap_att (list): List of ATT values from bootstrap samples
         - bootstrap_atc (list): List of ATC values from bootstrap samples
     """
-    bootstrap_ate = []
-    bootstrap_att = []
-    bootstrap_atc = []
+    if resampling not in RESAMPLING_SCHEMES:
+        raise ValueError(f"Unknown resampling '{resampling}', expected one of {RESAMPLING_SCHEMES}")
 
-    # Combine X, t, and y into a single dataframe for easier resampling
-    data = pd.concat([x, t, y], axis=1)
+    # Contiguous arrays, converted once for all replicates
+    x = as_design_matrix(x)
+    t = np.ascontiguousarray(t)
+    y = np.ascontiguousarray(y)
 
-    # Perform bootstrap sampling
-    for _ in range(num_bootstrap):
-        # Create a bootstrap sample (resample with replacement)
-        bootstrap_sample = data.sample(n=len(data), replace=True)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
 
-        # Split the bootstrap sample back into X, t, and y
-        x_bootstrap = bootstrap_sample.iloc[:, :-2]
-        t_bootstrap = bootstrap_sample.iloc[:, -2]
-        y_bootstrap = bootstrap_sample.iloc[:, -1]
+    store = None
+    if checkpoint is not None:
+        store = _open_checkpoint(checkpoint, x, t, y, calculate_measures, resampling, seed, kwargs)
+    try:
+        # One independent random stream per replicate
+        root = np.random.SeedSequence(seed) if store is None else store.seed_sequence
+        seed_sequences = root.spawn(num_bootstrap)
+        with _replicate_runner(x, t, y, calculate_measures, resampling, kwargs, n_jobs) as run:
+            results = _collect_replicates(run, seed_sequences, range(num_bootstrap), store)
+    finally:
+        if store is not None:
+            store.close()
 
-        # Calculate measures for this bootstrap sample
-        ate, att, atc = calculate_measures(x_bootstrap, t_bootstrap, y_bootstrap, **kwargs)
+    return bootstrap_intervals(results, ci_level)
 
-        # Store the results
-        bootstrap_ate.append(ate)
-        bootstrap_att.append(att)
-        bootstrap_atc.append(atc)
+def endpoint_monte_carlo_se(values, percentile):
+    """
+    Estimate the Monte-Carlo standard error of a bootstrap percentile from its replicates.
+
+    The order statistics around the percentile give a distribution-free confidence interval
+    of the percentile over repeated bootstrap runs, from the binomial distribution of the
+    number of replicates below it; its half-width, divided by the normal quantile of its
+    level, is the standard error.
+    Parameters:
+    values (array-like): Replicates of one measure.
+    percentile (float): Percentile of the endpoint, between 0 and 100.
+    Returns:
+    float: Standard error of the endpoint, NaN with fewer than two replicates.
+    """
+    values = np.sort(np.asarray(values, dtype=float))
+    n = len(values)
+    if n < 2:
+        return np.nan
+
+    z = norm.ppf(0.975)
+    p = percentile / 100
+    spread = z * np.sqrt(n * p * (1 - p))
+    lower = int(np.clip(np.floor(n * p - spread), 0, n - 1))
+    upper = int(np.clip(np.ceil(n * p + spread), 0, n - 1))
+    return (values[upper] - values[lower]) / (2 * z)
+
+@profiled()
+def adaptive_bci(x, t, y, calculate_measures, tolerance=0.002, ci_level=95, batch_size=100,
+                 min_bootstrap=200, max_bootstrap=5000, n_jobs=1, seed=None,
+                 resampling='indices', checkpoint=None, **kwargs):
+    """
+    Perform bootstrap resampling in batches until the confidence interval endpoints of ATE,
+    ATT and ATC are settled, or the replicate budget runs out.
+
+    After each batch, the Monte-Carlo standard error of the six endpoints is estimated from
+    the replicates so far (see endpoint_monte_carlo_se), and the run stops once every one
+    is at most `tolerance`. Replicates are seeded as in `bci`, so a run stopping after B
+    replicates returns exactly what `bci(..., num_bootstrap=B)` returns. Workers are kept
+    across batches, and `checkpoint` resumes an interrupted run as in `bci`.
+
+    Parameters:
+    x (pd.DataFrame or sp.spmatrix): Feature matrix
+    t (pd.Series): Treatment assignments
+    y (pd.Series): Outcome variable
+    calculate_measures (function): Function to calculate ATE, ATT, and ATC for a given sample
+    tolerance (float): Largest Monte-Carlo standard error of an endpoint, in effect units
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI)
+    batch_size (int): Replicates run between convergence checks
+    min_bootstrap (int): Replicates run before the first convergence check
+    max_bootstrap (int): Replicate budget
+    n_jobs (int): Number of worker processes, -1 uses all cores, 1 runs in this process
+    seed (int or None): Seed of the bootstrap random streams
+    resampling (str): Resampling scheme, as in `bci`
+    checkpoint (str or None): Path of the checkpoint file of completed replicates, as in `bci`
+    **kwargs: Additional keyword arguments to pass to calculate_measures function
+
+    Returns:
+    tuple: ate_ci, att_ci, atc_ci, bootstrap_ate, bootstrap_att, bootstrap_atc, as `bci`
+        returns them, and a dict with the number of replicates used ('num_bootstrap'),
+        whether the tolerance was met ('converged'), the Monte-Carlo standard errors of the
+        endpoints ('monte_carlo_se', [lower, upper] per measure) and the largest of them
+        after every check ('history', a list of (replicates, largest error)).
+    """
+    if resampling not in RESAMPLING_SCHEMES:
+        raise ValueError(f"Unknown resampling '{resampling}', expected one of {RESAMPLING_SCHEMES}")
+    if batch_size < 1 or not 0 < min_bootstrap <= max_bootstrap:
+        raise ValueError('Expected 0 < batch_size and 0 < min_bootstrap <= max_bootstrap')
+
+    # Contiguous arrays, converted once for all replicates
+    x = as_design_matrix(x)
+    t = np.ascontiguousarray(t)
+    y = np.ascontiguousarray(y)
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
+    lower_percentile = (100 - ci_level) / 2
+    percentiles = (lower_percentile, 100 - lower_percentile)
+
+    store = None
+    if checkpoint is not None:
+        store = _open_checkpoint(checkpoint, x, t, y, calculate_measures, resampling, seed, kwargs)
+    try:
+        root = np.random.SeedSequence(seed) if store is None else store.seed_sequence
+        seed_sequences = []
+        results = []
+        history = []
+        with _replicate_runner(x, t, y, calculate_measures, resampling, kwargs, n_jobs) as run:
+            while True:
+                # Spawning in batches continues the streams `bci` spawns all at once
+                size = min_bootstrap if not results else min(batch_size, max_bootstrap - len(results))
+                indices = range(len(results), len(results) + size)
+                seed_sequences.extend(root.spawn(size))
+                results.extend(_collect_replicates(run, seed_sequences, indices, store))
+
+                replicates = np.asarray(results, dtype=float)
+                errors = np.array([[endpoint_monte_carlo_se(replicates[:, measure], percentile)
+                                    for percentile in percentiles] for measure in range(3)])
+                largest_error = float(np.max(errors))
+                history.append((len(results), largest_error))
+
+                # NaN errors never converge
+                converged = largest_error <= tolerance
+                if converged or len(results) >= max_bootstrap:
+                    break
+    finally:
+        if store is not None:
+            store.close()
+
+    info = {
+        'num_bootstrap': len(results),
+        'converged': bool(converged),
+        'monte_carlo_se': {measure: errors[i].tolist() for i, measure in enumerate(['ate', 'att', 'atc'])},
+        'history': history,
+    }
+    return bootstrap_intervals(results, ci_level) + (info,)
+
+def bootstrap_intervals(results, ci_level=95):
+    """
+    Calculate percentile confidence intervals from bootstrap replicates.
+    Parameters:
+    results (list of tuple): (ATE, ATT, ATC) of every replicate, in replicate order.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI)
+    Returns:
+    tuple: ate_ci, att_ci, atc_ci, bootstrap_ate, bootstrap_att, bootstrap_atc, as `bci` returns.
+    """
+    bootstrap_ate = [result[0] for result in results]
+    bootstrap_att = [result[1] for result in results]
+    bootstrap_atc = [result[2] for result in results]
 
     # Calculate percentiles for confidence intervals
     lower_percentile = (100 - ci_level) / 2
@@ -125,3 +847,46 @@ def bci(x, t, y, calculate_measures, num_bootstrap=1000, ci_level=95, **kwargs):
     atc_ci = np.percentile(bootstrap_atc, [lower_percentile, upper_percentile])
 
     return ate_ci, att_ci, atc_ci, bootstrap_ate, bootstrap_att, bootstrap_atc
+
+def ratio_influence_scores(numerator, denominator, sample_weight=None):
+    """
+    Calculate a ratio of weighted sums and the influence score of every unit on it.
+    Parameters:
+    numerator (np.ndarray): Per-unit terms of the numerator sum.
+    denominator (np.ndarray): Per-unit terms of the denominator sum.
+    sample_weight (np.ndarray or None): Weights of the units in both sums.
+    Returns:
+    tuple: The estimate sum(w * numerator) / sum(w * denominator) and the per-unit
+        influence scores (numerator - estimate * denominator) / mean(w * denominator).
+    """
+    w = np.ones(len(numerator)) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+    denominator_sum = np.dot(w, denominator)
+    estimate = np.dot(w, numerator) / denominator_sum
+    scores = (numerator - estimate * denominator) * (np.sum(w) / denominator_sum)
+    return estimate, scores
+
+def influence_intervals(scores, estimates, ci_level=95, sample_weight=None):
+    """
+    Calculate standard errors and normal confidence intervals from influence scores.
+    Parameters:
+    scores (tuple of np.ndarray): Influence scores of the ATE, ATT and ATC of every unit.
+    estimates (tuple of float): ATE, ATT and ATC.
+    ci_level (float): Confidence interval level (e.g., 95 for 95% CI)
+    sample_weight (np.ndarray or None): Weights of the units, counted as frequencies.
+    Returns:
+    tuple: (ate_se, att_se, atc_se) and (ate_ci, att_ci, atc_ci), each CI an array
+        [lower, upper] as `bci` returns.
+    """
+    z = norm.ppf(0.5 + ci_level / 200)
+
+    standard_errors = []
+    intervals = []
+    for score, estimate in zip(scores, estimates):
+        if sample_weight is None:
+            se = np.sqrt(np.dot(score, score)) / len(score)
+        else:
+            se = np.sqrt(np.dot(sample_weight, score * score)) / np.sum(sample_weight)
+        standard_errors.append(se)
+        intervals.append(np.array([estimate - z * se, estimate + z * se]))
+
+    return tuple(standard_errors), tuple(intervals)
@@ -0,0 +1,294 @@
+"""
+This module maintains the study incrementally as new intakes arrive, instead of rerunning
+preprocessing, transformation and every estimator from scratch each year.
+
+Each intake is added once as an append-only partition of a store directory. The store
+keeps per-partition artifacts:
+
+    - the recoded raw rows and their joint qualification counts, from which the top-k
+      qualification filters of `preprocessing.preprocess` are derived for all partitions;
+    - the filtered rows and their scaler statistics and categories, for each set of
+      filters, from which the feature transformation of all partitions is assembled;
+    - fitted nuisance models and their predictions, in an on-disk NuisanceCache;
+    - the estimates of every state of the store.
+
+Adding a partition recodes and counts only the new raw file. Existing partitions are
+filtered again only if the top-k filters change, and estimates are recomputed only for
+the new state; asking again for the estimates of an unchanged store reads them back.
+The processed data of the partitions equals `preprocess` applied to their concatenated
+raw files, so the estimates match a cold rerun.
+
+Classes:
+    IncrementalStudy(store_dir, adult_age=21):
+        Store of partitions with cached per-partition artifacts and estimates.
+
+Usage:
+    python incremental.py --store data/study add 2023 data/raw_2023.csv
+    python incremental.py --store data/study estimate --estimators ipw doubly_robust --analytic
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import preprocessing
+
+ESTIMATION_METHODS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'estimation_methods')
+sys.path.append(ESTIMATION_METHODS_DIR)
+
+# pylint: disable=wrong-import-position
+from feature_transformer import FeatureTransformer
+from nuisance_cache import NuisanceCache
+from run_estimators import ESTIMATORS, run_estimators
+from utils import as_design_matrix, file_hash, write_json_atomic
+
+# Estimators that also report influence-function standard errors and intervals
+ANALYTIC_ESTIMATORS = ('ipw', 'doubly_robust')
+
+
+class IncrementalStudy:
+    """
+    Store of append-only data partitions with cached per-partition artifacts.
+
+    Parameters:
+    store_dir (str): Directory of the store, created if missing.
+    adult_age (int): Minimal age at enrollment of an adult (treated) student. A store keeps
+        the age it was created with.
+
+    Attributes:
+    work_log_ (list of str): Steps computed, rather than read from the store, since the
+        study was opened.
+    """
+
+    def __init__(self, store_dir, adult_age=21):
+        self.store_dir = store_dir
+        self.work_log_ = []
+        os.makedirs(os.path.join(store_dir, 'partitions'), exist_ok=True)
+
+        self._manifest_path = os.path.join(store_dir, 'manifest.json')
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+            if self.manifest['adult_age'] != adult_age:
+                raise ValueError(f"The store was created with adult_age={self.manifest['adult_age']}")
+        else:
+            self.manifest = {'adult_age': adult_age, 'partitions': []}
+            write_json_atomic(self._manifest_path, self.manifest)
+
+    @property
+    def partitions(self):
+        """
+        Names of the partitions, in the order they were added.
+        """
+        return [partition['name'] for partition in self.manifest['partitions']]
+
+    def _partition_dir(self, name):
+        return os.path.join(self.store_dir, 'partitions', name)
+
+    def add_partition(self, name, raw_path):
+        """
+        Add a raw intake file as a new partition, recoding it and counting its qualifications.
+        Parameters:
+        name (str): Name of the partition, e.g. the intake year.
+        raw_path (str): Raw CSV file with the columns of 'data/raw_data.csv'.
+        Returns:
+        int: Number of raw rows of the partition.
+        """
+        if name in self.partitions:
+            raise ValueError(f"Partition '{name}' already exists; partitions are append-only")
+
+        raw = pd.read_csv(raw_path)
+        recoded = preprocessing.recode_columns(raw, self.manifest['adult_age'])
+        counts = preprocessing.qualification_counts(recoded)
+
+        # Build the partition in a temporary directory and move it in place once complete
+        tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.store_dir, 'partitions'))
+        recoded.to_pickle(os.path.join(tmp_dir, 'recoded.pkl'))
+        counts.to_pickle(os.path.join(tmp_dir, 'counts.pkl'))
+        if os.path.exists(self._partition_dir(name)):
+            shutil.rmtree(self._partition_dir(name))
+        os.replace(tmp_dir, self._partition_dir(name))
+
+        self.manifest['partitions'].append({'name': name, 'source': os.path.abspath(raw_path),
+                                            'hash': file_hash(raw_path), 'rows': len(raw)})
+        write_json_atomic(self._manifest_path, self.manifest)
+        self.work_log_.append(f'recoded and counted partition {name}')
+        return len(raw)
+
+    def filters(self):
+        """
+        Top qualifications of all partitions, from their cached counts.
+        Returns:
+        tuple: Top 5 father's, top 5 mother's and top 4 previous qualifications.
+        """
+        joint_counts = None
+        for name in self.partitions:
+            counts = pd.read_pickle(os.path.join(self._partition_dir(name), 'counts.pkl'))
+            joint_counts = counts if joint_counts is None else joint_counts.add(counts, fill_value=0)
+        if joint_counts is None:
+            raise ValueError('The store has no partitions')
+        return preprocessing.top_qualifications(joint_counts)
+
+    @staticmethod
+    def _filter_key(filters):
+        content = json.dumps([list(categories) for categories in filters])
+        return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
+    def _processed_partition(self, name, filters):
+        """
+        Filtered rows of a partition and their transformer statistics, computed once per
+        set of filters.
+        """
+        key = self._filter_key(filters)
+        data_path = os.path.join(self._partition_dir(name), f'processed-{key}.pkl')
+        statistics_path = os.path.join(self._partition_dir(name), f'statistics-{key}.json')
+
+        if os.path.exists(data_path) and os.path.exists(statistics_path):
+            with open(statistics_path, encoding='utf-8') as f:
+                return pd.read_pickle(data_path), json.load(f)
+
+        top_father_qual, top_mother_qual, top_prev_qual = filters
+        recoded = pd.read_pickle(os.path.join(self._partition_dir(name), 'recoded.pkl'))
+        processed = preprocessing.filter_parent_qualifications(recoded, top_father_qual,
+                                                               top_mother_qual)
+        processed = preprocessing.filter_previous_qualifications(processed, top_prev_qual)
+        statistics = FeatureTransformer().partition_statistics(
+            processed.drop(columns=['Adult', 'Target']))
+
+        processed.to_pickle(data_path)
+        write_json_atomic(statistics_path, statistics)
+        self.work_log_.append(f'filtered partition {name}')
+        return processed, statistics
+
+    def processed_data(self):
+        """
+        Processed data of all partitions, as `preprocessing.preprocess` would produce from
+        their concatenated raw files.
+        Returns:
+        tuple: The processed data and the FeatureTransformer fitted on it.
+        """
+        filters = self.filters()
+        parts, statistics = zip(*(self._processed_partition(name, filters) for name in self.partitions))
+        transformer = FeatureTransformer().fit_from_statistics(list(statistics))
+        return pd.concat(parts, ignore_index=True), transformer
+
+    def design(self, sparse=False):
+        """
+        Transformed features, treatment and outcome of all partitions.
+        Parameters:
+        sparse (bool): Return the features as a SciPy CSR matrix.
+        Returns:
+        tuple: x, t and y, as `utils.read_and_transform_data` returns them.
+        """
+        data, transformer = self.processed_data()
+        x = transformer.transform(data.drop(columns=['Adult', 'Target']), sparse=sparse)
+        return x, data['Adult'].reset_index(drop=True), data['Target'].reset_index(drop=True)
+
+    def state_key(self):
+        """
+        Hash identifying the current partitions and their contents.
+        """
+        content = json.dumps([self.manifest['adult_age']] +
+                             [[partition['name'], partition['hash']]
+                              for partition in self.manifest['partitions']])
+        return hashlib.blake2b(content.encode(), digest_size=12).hexdigest()
+
+    def estimate(self, estimators=None, num_bootstrap=0, ci_level=95, workers=1, seed=0,
+                 analytic=False, sparse=False):
+        """
+        Estimates of the current state of the store, read back when already computed.
+
+        Nuisance models are cached on disk, so estimators sharing a model fit it once per
+        state, and a state seen before reuses its fits.
+        Parameters:
+        estimators (list of str or None): Names of estimators, keys of run_estimators.ESTIMATORS,
+            None for all.
+        num_bootstrap (int): Number of bootstrap replicates per estimator, 0 to skip intervals.
+        ci_level (float): Confidence interval level (e.g., 95 for 95% CI).
+        workers (int): Number of worker processes, -1 uses all cores.
+        seed (int): Seed of the bootstrap random streams.
+        analytic (bool): Add influence-function standard errors and intervals of the
+            estimators supporting them, at the cost of one fit.
+        sparse (bool): Use a sparse CSR design matrix.
+        Returns:
+        dict: Maps each estimator name to its estimates, as run_estimators returns them.
+        """
+        estimators = list(ESTIMATORS) if estimators is None else list(estimators)
+        settings = {'estimators': estimators, 'num_bootstrap': num_bootstrap, 'ci_level': ci_level,
+                    'seed': seed, 'analytic': analytic, 'sparse': sparse}
+        settings_key = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(),
+                                       digest_size=8).hexdigest()
+
+        estimates_dir = os.path.join(self.store_dir, 'estimates')
+        os.makedirs(estimates_dir, exist_ok=True)
+        estimates_path = os.path.join(estimates_dir, f'{self.state_key()}-{settings_key}.json')
+        if os.path.exists(estimates_path):
+            with open(estimates_path, encoding='utf-8') as f:
+                return json.load(f)['results']
+
+        x, t, y = self.design(sparse=sparse)
+        nuisance_dir = os.path.join(self.store_dir, 'nuisance')
+        results = run_estimators(x, t, y, estimators, num_bootstrap=num_bootstrap,
+                                 ci_level=ci_level, workers=workers, seed=seed,
+                                 cache_dir=nuisance_dir)
+
+        if analytic:
+            cache = NuisanceCache(cache_dir=nuisance_dir)
+            x = as_design_matrix(x)
+            for name in set(estimators) & set(ANALYTIC_ESTIMATORS):
+                _, standard_errors, intervals = ESTIMATORS[name](x, np.asarray(t), np.asarray(y),
+                                                                 cache=cache, analytic=True,
+                                                                 ci_level=ci_level)
+                results[name].update(
+                    ate_se=float(standard_errors[0]), att_se=float(standard_errors[1]),
+                    atc_se=float(standard_errors[2]), ate_analytic_ci=intervals[0].tolist(),
+                    att_analytic_ci=intervals[1].tolist(), atc_analytic_ci=intervals[2].tolist())
+
+        write_json_atomic(estimates_path, {'partitions': self.partitions, 'n_rows': len(y),
+                                            'settings': settings, 'results': results})
+        self.work_log_.append(f'estimated {", ".join(estimators)} on {len(y)} rows')
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the study incrementally.')
+    parser.add_argument('--store', required=True, help='directory of the partition store')
+    parser.add_argument('--adult-age', type=int, default=21,
+                        help='minimal age at enrollment of an adult student')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help='add a raw intake file as a new partition')
+    add_parser.add_argument('name', help='name of the partition, e.g. the intake year')
+    add_parser.add_argument('raw', help='path of the raw CSV file')
+
+    estimate_parser = commands.add_parser('estimate', help='estimate the effects on all partitions')
+    estimate_parser.add_argument('--estimators', nargs='+', default=list(ESTIMATORS),
+                                 choices=list(ESTIMATORS), help='estimators to run')
+    estimate_parser.add_argument('--num-bootstrap', type=int, default=0,
+                                 help='bootstrap replicates per estimator')
+    estimate_parser.add_argument('--workers', type=int, default=1,
+                                 help='worker processes, -1 for all cores')
+    estimate_parser.add_argument('--analytic', action='store_true',
+                                 help='add influence-function intervals of IPW and doubly robust')
+    args = parser.parse_args()
+
+    study = IncrementalStudy(args.store, adult_age=args.adult_age)
+    if args.command == 'add':
+        n_rows = study.add_partition(args.name, args.raw)
+        print(f'Added partition {args.name} with {n_rows} raw rows')
+    else:
+        estimates = study.estimate(args.estimators, num_bootstrap=args.num_bootstrap,
+                                   workers=args.workers, analytic=args.analytic)
+        for estimator_name, estimate in estimates.items():
+            print(f"{estimator_name}: ATE: {estimate['ate']:.4f}, ATT: {estimate['att']:.4f}, "
+                  f"ATC: {estimate['atc']:.4f}")
+    for step in study.work_log_:
+        print(f'computed: {step}')
@@ -12,16 +12,124 @@ The main functionalities of the module include:
 4. Loading data, processing it by applying the above categorizations, 
    filtering based on specific criteria, and saving the cleaned data.
 
+The code-to-category mappings are lookup tables (`CategoryLookup`), applied to whole
+columns at once and producing pandas 'category' columns.
+
+`preprocess_streaming` produces the same output in two chunked passes over the raw file,
+for exports that do not fit in memory.
+
+Both can also write the processed data as a columnar Parquet or Feather file, with text
+columns stored as dictionary-encoded categoricals and integer columns in compact dtypes.
+`utils.read_and_transform_data` reads such files directly.
+
+With `keep_age`, the age at enrollment is kept next to the 'Adult' treatment, so
+`threshold_sweep.py` can redefine the treatment with other age thresholds. Records are
+filtered on qualifications only, so the processed rows do not depend on the threshold.
+
 Usage:
-    To use this module, simply import it and call the relevant functions 
-    as needed. The processed data will be saved as 'data/processed_data.csv'.
+    Import the module and call `preprocess(raw_path, out_path)`, or run it as a script
+    to process 'data/raw_data.csv' into 'data/processed_data.csv'
+    (pass --chunksize to stream the raw file, --columnar to also write a Parquet or Feather file,
+    --keep-age to keep the age at enrollment).
 
 Dependencies:
     - pandas: For data manipulation and analysis.
+    - numpy: For the code lookup tables.
+    - pyarrow (optional): For the Parquet and Feather output.
 """
 
+import argparse
+import os
+
+import numpy as np
 import pandas as pd
 
+OCCUPATION_CATEGORIES = {
+    'Management': [1, 2, 17, 18],
+    'Professionals': [3, 19, 20, 21, 22],
+    'Technicians': [4, 23, 24, 25, 26],
+    'Administrative': [5, 27, 28, 29],
+    'Service and Sales': [6, 30, 31, 32, 33],
+    'Agriculture and Fishery': [7, 34, 35],
+    'Craft and Related Trades': [8, 36, 37, 38, 39],
+    'Plant and Machine Operators': [9, 40, 41, 42],
+    'Elementary Occupations': [10, 43, 44, 45, 46],
+    'Armed Forces': [11, 14, 15, 16],
+    'Other': [],
+}
+
+QUALIFICATION_CATEGORIES = {
+    'Complete Secondary Education': [1, 10, 11, 12, 13, 14, 15, 16],
+    'Incomplete Secondary Education': [7, 8, 17, 19, 20],
+    'Higher Education - Undergraduate': [2, 3, 4, 5, 6, 30, 31, 32],
+    'Higher Education - Postgraduate': [33, 34],
+    'Basic Education (1st and 2nd Cycle)': [27, 28],
+    'Basic Education (3rd Cycle)': [9, 18, 21],
+    'Technological Specialization': [29],
+    'No Formal Education': [25, 26],
+    'Unknown': [24],
+    'Other Specific Qualifications': [],
+}
+
+PREVIOUS_QUALIFICATION_CATEGORIES = {
+    'Complete Secondary Education': [1],
+    'Incomplete Secondary Education': [7, 8, 9, 10, 11],
+    'Higher Education - Bachelor/Degree': [2, 3, 15],
+    'Higher Education - Master': [4, 17],
+    'Higher Education - Doctorate': [5],
+    'Frequency of Higher Education': [6],
+    'Basic Education (3rd Cycle)': [12],
+    'Basic Education (2nd Cycle)': [13],
+    'Technological Specialization': [14],
+    'Professional Higher Technical': [16],
+    'Other': [],
+}
+
+
+class CategoryLookup:
+    """
+    Lookup table mapping integer codes to descriptive categories.
+    The last category of `categories` is the default for codes not listed.
+
+    Parameters:
+    categories (dict): Maps each category name to the list of codes it covers.
+    """
+
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.default = self.categories[-1]
+        self.code_to_category = {code: category
+                                 for category, codes in categories.items() for code in codes}
+
+        # Array indexed by code holding the position of its category
+        self.table = np.full(max(self.code_to_category) + 1, len(self.categories) - 1,
+                             dtype=np.int8)
+        for code, category in self.code_to_category.items():
+            self.table[code] = self.categories.index(category)
+
+    def __call__(self, code):
+        return self.code_to_category.get(code, self.default)
+
+    def recode(self, codes):
+        """
+        Map a column of codes to a categorical column in one vectorized lookup.
+        Parameters:
+        codes (pd.Series): Integer codes.
+        Returns:
+        pd.Series: Categorical series with the categories of this lookup.
+        """
+        values = codes.to_numpy()
+        in_table = (values >= 0) & (values < len(self.table))
+        category_codes = np.full(len(values), len(self.categories) - 1, dtype=np.int8)
+        category_codes[in_table] = self.table[values[in_table]]
+        return pd.Series(pd.Categorical.from_codes(category_codes, self.categories),
+                         index=codes.index, name=codes.name)
+
+
+OCCUPATION_LOOKUP = CategoryLookup(OCCUPATION_CATEGORIES)
+QUALIFICATION_LOOKUP = CategoryLookup(QUALIFICATION_CATEGORIES)
+PREVIOUS_QUALIFICATION_LOOKUP = CategoryLookup(PREVIOUS_QUALIFICATION_CATEGORIES)
+
 # Function to categorize occupations
 def categorize_occupation(occupation):
     """
@@ -44,28 +152,7 @@ def categorize_occupation(occupation):
         - 'Armed Forces'
         - 'Other' (for any occupation code not listed above)
     """
-    if occupation in [1, 2, 17, 18]:
-        return 'Management'
-    elif occupation in [3, 19, 20, 21, 22]:
-        return 'Professionals'
-    elif occupation in [4, 23, 24, 25, 26]:
-        return 'Technicians'
-    elif occupation in [5, 27, 28, 29]:
-        return 'Administrative'
-    elif occupation in [6, 30, 31, 32, 33]:
-        return 'Service and Sales'
-    elif occupation in [7, 34, 35]:
-        return 'Agriculture and Fishery'
-    elif occupation in [8, 36, 37, 38, 39]:
-        return 'Craft and Related Trades'
-    elif occupation in [9, 40, 41, 42]:
-        return 'Plant and Machine Operators'
-    elif occupation in [10, 43, 44, 45, 46]:
-        return 'Elementary Occupations'
-    elif occupation in [11, 14, 15, 16]:
-        return 'Armed Forces'
-    else:
-        return 'Other'
+    return OCCUPATION_LOOKUP(occupation)
 
 # Function to categorize parent qualifications
 def categorize_qualification(qualification):
@@ -88,26 +175,7 @@ def categorize_qualification(qualification):
         - 'Unknown'
         - 'Other Specific Qualifications'
     """
-    if qualification in [1, 10, 11, 12, 13, 14, 15, 16]:
-        return 'Complete Secondary Education'
-    elif qualification in [7, 8, 17, 19, 20]:
-        return 'Incomplete Secondary Education'
-    elif qualification in [2, 3, 4, 5, 6, 30, 31, 32]:
-        return 'Higher Education - Undergraduate'
-    elif qualification in [33, 34]:
-        return 'Higher Education - Postgraduate'
-    elif qualification in [27, 28]:
-        return 'Basic Education (1st and 2nd Cycle)'
-    elif qualification in [9, 18, 21]:
-        return 'Basic Education (3rd Cycle)'
-    elif qualification == 29:
-        return 'Technological Specialization'
-    elif qualification in [25, 26]:
-        return 'No Formal Education'
-    elif qualification == 24:
-        return 'Unknown'
-    else:
-        return 'Other Specific Qualifications'
+    return QUALIFICATION_LOOKUP(qualification)
 
 # Function to categorize previous qualification
 def categorize_previous_qualification(qualification):
@@ -132,80 +200,325 @@ def categorize_previous_qualification(qualification):
             - 'Professional Higher Technical'
             - 'Other'
     """
-    if qualification == 1:
-        return 'Complete Secondary Education'
-    elif qualification in [7, 8, 9, 10, 11]:
-        return 'Incomplete Secondary Education'
-    elif qualification in [2, 3, 15]:
-        return 'Higher Education - Bachelor/Degree'
-    elif qualification in [4, 17]:
-        return 'Higher Education - Master'
-    elif qualification == 5:
-        return 'Higher Education - Doctorate'
-    elif qualification == 6:
-        return 'Frequency of Higher Education'
-    elif qualification == 12:
-        return 'Basic Education (3rd Cycle)'
-    elif qualification == 13:
-        return 'Basic Education (2nd Cycle)'
-    elif qualification == 14:
-        return 'Technological Specialization'
-    elif qualification == 16:
-        return 'Professional Higher Technical'
-    else:
-        return 'Other'
+    return PREVIOUS_QUALIFICATION_LOOKUP(qualification)
 
 FATHER_OCCUPATION_STRING = 'Father\'s occupation'
 MOTHER_OCCUPATION_STRING = 'Mother\'s occupation'
 FATHER_QUALIFICATION_STRING = 'Father\'s qualification'
 MOTHER_QUALIFICATION_STRING = 'Mother\'s qualification'
 PREVIOUS_QUALIFICATION_STRING = 'Previous qualification'
+AGE_STRING = 'Age at enrollment'
 RAW_DATA_FILE = 'data/raw_data.csv'
 PROCESSED_DATA_FILE = 'data/processed_data.csv'
+COLUMNAR_FORMATS = ('.parquet', '.feather')
+QUALIFICATION_COUNT_COLUMNS = [FATHER_QUALIFICATION_STRING, MOTHER_QUALIFICATION_STRING,
+                               PREVIOUS_QUALIFICATION_STRING]
 
 
-# Load the data
-df = pd.read_csv(RAW_DATA_FILE)
 
-# Create a binary column indicating if the individual is an adult (age >= 21)
-df['Adult'] = (df['Age at enrollment'] >= 21).astype(int)
-df = df.drop(columns=['Age at enrollment'])
+def recode_columns(df, adult_age=21, keep_age=False):
+    """
+    Add the treatment column and replace occupation and qualification codes by categories.
 
-# 1. Replace occupation and qualification categories
-df[FATHER_OCCUPATION_STRING] = df[FATHER_OCCUPATION_STRING].apply(categorize_occupation)
-df[MOTHER_OCCUPATION_STRING] = df[MOTHER_OCCUPATION_STRING].apply(categorize_occupation)
-df[FATHER_QUALIFICATION_STRING] = df[FATHER_QUALIFICATION_STRING].apply(categorize_qualification)
-df[MOTHER_QUALIFICATION_STRING] = df[MOTHER_QUALIFICATION_STRING].apply(categorize_qualification)
-df[PREVIOUS_QUALIFICATION_STRING] = df[PREVIOUS_QUALIFICATION_STRING].apply(categorize_previous_qualification)
+    Parameters:
+    df (pd.DataFrame): Raw data, or a chunk of it.
+    adult_age (int): Minimal age at enrollment of an adult (treated) student.
+    keep_age (bool): Keep the age at enrollment, so the treatment can be redefined with
+        other thresholds; it is never used as a covariate.
 
-# 2. Omit records not in top 5 common qualifications for parents
-top_5_father_qual = df[FATHER_QUALIFICATION_STRING].value_counts().nlargest(5).index
-top_5_mother_qual = df[MOTHER_QUALIFICATION_STRING].value_counts().nlargest(5).index
+    Returns:
+    pd.DataFrame: The recoded data.
+    """
+    # Create a binary column indicating if the individual is an adult (age >= adult_age)
+    df['Adult'] = (df[AGE_STRING] >= adult_age).astype(int)
+    if not keep_age:
+        df = df.drop(columns=[AGE_STRING])
 
-df = df[df[FATHER_QUALIFICATION_STRING].isin(top_5_father_qual) &
-         df[MOTHER_QUALIFICATION_STRING].isin(top_5_mother_qual)]
+    # 1. Replace occupation and qualification categories
+    df[FATHER_OCCUPATION_STRING] = OCCUPATION_LOOKUP.recode(df[FATHER_OCCUPATION_STRING])
+    df[MOTHER_OCCUPATION_STRING] = OCCUPATION_LOOKUP.recode(df[MOTHER_OCCUPATION_STRING])
+    df[FATHER_QUALIFICATION_STRING] = QUALIFICATION_LOOKUP.recode(df[FATHER_QUALIFICATION_STRING])
+    df[MOTHER_QUALIFICATION_STRING] = QUALIFICATION_LOOKUP.recode(df[MOTHER_QUALIFICATION_STRING])
+    df[PREVIOUS_QUALIFICATION_STRING] = PREVIOUS_QUALIFICATION_LOOKUP.recode(
+        df[PREVIOUS_QUALIFICATION_STRING])
 
-# Filter for records with nationality as Portuguese, then drop nationality and international columns
-df = df[df['Nacionality'] == 1]
-df = df.drop(columns=['Nacionality', 'International'])
+    return df
 
-# List and remove all columns starting with 'Curricular'
-curricular_cols = [col for col in df.columns if col.startswith('Curricular')]
-df = df.drop(columns=curricular_cols)
 
-# Remove the columns 'Debtor' and 'Tuition fees up to date'
-df = df.drop(columns=['Debtor', 'Tuition fees up to date'])
+def filter_parent_qualifications(df, top_father_qual, top_mother_qual):
+    """
+    Keep Portuguese records whose parents' qualifications are among the given top categories,
+    and drop the columns that are not used in the analysis.
+    """
+    # 2. Omit records not in top 5 common qualifications for parents
+    df = df[df[FATHER_QUALIFICATION_STRING].isin(top_father_qual) &
+            df[MOTHER_QUALIFICATION_STRING].isin(top_mother_qual)]
+
+    # Filter for records with nationality as Portuguese, then drop nationality and international columns
+    df = df[df['Nacionality'] == 1]
+    df = df.drop(columns=['Nacionality', 'International'])
+
+    # List and remove all columns starting with 'Curricular'
+    curricular_cols = [col for col in df.columns if col.startswith('Curricular')]
+    df = df.drop(columns=curricular_cols)
+
+    # Remove the columns 'Debtor' and 'Tuition fees up to date'
+    df = df.drop(columns=['Debtor', 'Tuition fees up to date'])
+
+    return df
+
+
+def filter_previous_qualifications(df, top_prev_qual):
+    """
+    Keep records whose previous qualification is among the given top categories,
+    and encode the target as 1 for 'Graduate' and 0 otherwise.
+    """
+    # 3. Omit records not in top 4 common previous qualifications
+    df = df[df[PREVIOUS_QUALIFICATION_STRING].isin(top_prev_qual)]
+
+    # in the target variable, change every 'dropout' or 'enrolled' to 0 and 'Graduate' to 1
+    df['Target'] = df['Target'].map({'Dropout': 0, 'Enrolled': 0, 'Graduate': 1})
+
+    return df
+
+
+def compact_dtypes(df, integer_dtype=None):
+    """
+    Convert text columns to categoricals and shrink integer columns, for columnar storage.
+
+    Parameters:
+    df (pd.DataFrame): Processed data.
+    integer_dtype (str or None): Dtype of all integer columns, None to downcast each column
+        to the smallest integer dtype holding its values.
+
+    Returns:
+    pd.DataFrame: The data with compact dtypes.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(df[col]):
+            if integer_dtype is None:
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            else:
+                df[col] = df[col].astype(integer_dtype)
+        elif not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype('category')
+    return df
 
-# 3. Omit records not in top 4 common previous qualifications
-top_4_prev_qual = df[PREVIOUS_QUALIFICATION_STRING].value_counts().nlargest(4).index
-df = df[df[PREVIOUS_QUALIFICATION_STRING].isin(top_4_prev_qual)]
 
-# in the target variable, change every 'dropout' or 'enrolled' to 0 and 'Graduate' to 1
-df['Target'] = df['Target'].replace({'Dropout': 0, 'Enrolled': 0, 'Graduate': 1})
+def _columnar_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown columnar format '{extension}', expected one of {COLUMNAR_FORMATS}")
+    return extension
 
-# Save the processed data to a new CSV file
-df.to_csv('data/processed_data.csv', index=False)
 
-print("Preprocessing complete. Data saved to " + PROCESSED_DATA_FILE)
-print(f"Original data shape: {pd.read_csv(RAW_DATA_FILE).shape}")
-print(f"Preprocessed data shape: {df.shape}")
+def write_columnar(df, path):
+    """
+    Save the processed data as a Parquet or Feather file, chosen by the file extension.
+    Categorical columns are dictionary-encoded and integer columns downcast.
+
+    Parameters:
+    df (pd.DataFrame): Processed data.
+    path (str): Path ending in '.parquet' or '.feather'.
+    """
+    df = compact_dtypes(df).reset_index(drop=True)
+    if _columnar_format(path) == '.parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+
+
+def preprocess(raw_path=RAW_DATA_FILE, out_path=PROCESSED_DATA_FILE, adult_age=21,
+               columnar_path=None, keep_age=False):
+    """
+    Load the raw data, recode and filter it, and save the processed data.
+
+    Parameters:
+    raw_path (str): Path of the raw CSV file.
+    out_path (str or None): Path of the processed CSV file, None to skip saving.
+    adult_age (int): Minimal age at enrollment of an adult (treated) student.
+    columnar_path (str or None): Path of an additional Parquet or Feather copy of the
+        processed data, None to skip it.
+    keep_age (bool): Keep the age at enrollment column, for threshold sweeps.
+
+    Returns:
+    tuple: A tuple containing:
+        - df (pd.DataFrame): The processed data, with categorical columns of dtype 'category'.
+        - raw_shape (tuple): Shape of the raw data.
+    """
+    # Load the data
+    df = pd.read_csv(raw_path)
+    raw_shape = df.shape
+
+    df = recode_columns(df, adult_age, keep_age)
+
+    top_5_father_qual = df[FATHER_QUALIFICATION_STRING].value_counts().nlargest(5).index
+    top_5_mother_qual = df[MOTHER_QUALIFICATION_STRING].value_counts().nlargest(5).index
+    df = filter_parent_qualifications(df, top_5_father_qual, top_5_mother_qual)
+
+    top_4_prev_qual = df[PREVIOUS_QUALIFICATION_STRING].value_counts().nlargest(4).index
+    df = filter_previous_qualifications(df, top_4_prev_qual)
+
+    # Save the processed data to a new CSV file
+    if out_path is not None:
+        df.to_csv(out_path, index=False)
+    if columnar_path is not None:
+        write_columnar(df, columnar_path)
+
+    return df, raw_shape
+
+
+def qualification_counts(df):
+    """
+    Count the joint frequencies of the recoded parent and previous qualifications of
+    Portuguese and other records. Counts of parts of the data add up to the counts of
+    the whole, from which `top_qualifications` derives the filters of `preprocess`.
+
+    Parameters:
+    df (pd.DataFrame): Recoded data, or a part of it, with the 'Nacionality' column.
+
+    Returns:
+    pd.Series: Counts indexed by the three qualifications and a 'Portuguese' flag.
+    """
+    counts = df[QUALIFICATION_COUNT_COLUMNS].copy()
+    counts['Portuguese'] = df['Nacionality'] == 1
+    return counts.groupby(QUALIFICATION_COUNT_COLUMNS + ['Portuguese'], observed=True).size()
+
+
+def top_qualifications(joint_counts):
+    """
+    Derive the top parent and previous qualifications from joint counts, exactly as
+    `preprocess` selects them from the full data.
+
+    Parameters:
+    joint_counts (pd.Series): Counts returned by `qualification_counts`, possibly summed.
+
+    Returns:
+    tuple: Top 5 father's, top 5 mother's and top 4 previous qualifications.
+    """
+    joint_counts = joint_counts.reset_index(name='count')
+
+    def top_categories(counts, column, lookup, k):
+        # Counts in category order, as value_counts of a categorical column would give
+        counts = counts.groupby(column, observed=False)['count'].sum()
+        return counts.reindex(lookup.categories, fill_value=0).sort_values(
+            ascending=False).nlargest(k).index
+
+    top_5_father_qual = top_categories(joint_counts, FATHER_QUALIFICATION_STRING,
+                                       QUALIFICATION_LOOKUP, 5)
+    top_5_mother_qual = top_categories(joint_counts, MOTHER_QUALIFICATION_STRING,
+                                       QUALIFICATION_LOOKUP, 5)
+
+    kept_counts = joint_counts[joint_counts[FATHER_QUALIFICATION_STRING].isin(top_5_father_qual) &
+                               joint_counts[MOTHER_QUALIFICATION_STRING].isin(top_5_mother_qual) &
+                               joint_counts['Portuguese']]
+    top_4_prev_qual = top_categories(kept_counts, PREVIOUS_QUALIFICATION_STRING,
+                                     PREVIOUS_QUALIFICATION_LOOKUP, 4)
+
+    return top_5_father_qual, top_5_mother_qual, top_4_prev_qual
+
+
+def preprocess_streaming(raw_path=RAW_DATA_FILE, out_path=PROCESSED_DATA_FILE, adult_age=21,
+                         chunksize=100_000, columnar_path=None, keep_age=False):
+    """
+    Preprocess a raw file in two chunked passes, so memory is bounded by the chunk size.
+
+    The first pass reads only the qualification and nationality columns and counts their
+    joint frequencies, from which the top parent and previous qualifications are derived
+    exactly as in `preprocess`. The second pass recodes and filters every chunk and appends
+    it to the processed file, and to a Parquet file as one row group per chunk. Integer
+    columns are stored as int32 there, so every chunk has the same schema.
+
+    Parameters:
+    raw_path (str): Path of the raw CSV file.
+    out_path (str): Path of the processed CSV file.
+    adult_age (int): Minimal age at enrollment of an adult (treated) student.
+    chunksize (int): Number of rows read at a time.
+    columnar_path (str or None): Path of an additional Parquet copy of the processed data,
+        None to skip it. Feather files cannot be appended to, so they are not streamed.
+    keep_age (bool): Keep the age at enrollment column, for threshold sweeps.
+
+    Returns:
+    tuple: A tuple containing:
+        - processed_shape (tuple): Shape of the processed data.
+        - raw_shape (tuple): Shape of the raw data.
+    """
+    n_raw_columns = len(pd.read_csv(raw_path, nrows=0).columns)
+
+    # First pass: joint counts of the recoded qualifications of Portuguese and other records
+    joint_counts = None
+    n_raw_rows = 0
+    for chunk in pd.read_csv(raw_path, usecols=QUALIFICATION_COUNT_COLUMNS + ['Nacionality'],
+                             chunksize=chunksize):
+        n_raw_rows += len(chunk)
+        chunk[FATHER_QUALIFICATION_STRING] = QUALIFICATION_LOOKUP.recode(chunk[FATHER_QUALIFICATION_STRING])
+        chunk[MOTHER_QUALIFICATION_STRING] = QUALIFICATION_LOOKUP.recode(chunk[MOTHER_QUALIFICATION_STRING])
+        chunk[PREVIOUS_QUALIFICATION_STRING] = PREVIOUS_QUALIFICATION_LOOKUP.recode(
+            chunk[PREVIOUS_QUALIFICATION_STRING])
+        counts = qualification_counts(chunk)
+        joint_counts = counts if joint_counts is None else joint_counts.add(counts, fill_value=0)
+
+    top_5_father_qual, top_5_mother_qual, top_4_prev_qual = top_qualifications(joint_counts)
+
+    parquet_writer = None
+    if columnar_path is not None:
+        if _columnar_format(columnar_path) != '.parquet':
+            raise ValueError('Only Parquet output can be streamed, use preprocess for Feather files')
+        # pylint: disable=import-outside-toplevel
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+    # Second pass: recode, filter and append every chunk to the processed file
+    n_processed_rows = 0
+    n_processed_columns = None
+    try:
+        for i, chunk in enumerate(pd.read_csv(raw_path, chunksize=chunksize)):
+            chunk = recode_columns(chunk, adult_age, keep_age)
+            chunk = filter_parent_qualifications(chunk, top_5_father_qual, top_5_mother_qual)
+            chunk = filter_previous_qualifications(chunk, top_4_prev_qual)
+            chunk.to_csv(out_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            n_processed_rows += len(chunk)
+            n_processed_columns = chunk.shape[1]
+
+            if columnar_path is not None:
+                # Categories are the full lookup tables, so every chunk has the same schema
+                table = pa.Table.from_pandas(compact_dtypes(chunk, integer_dtype='int32'),
+                                             preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(columnar_path, table.schema)
+                parquet_writer.write_table(table)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    return (n_processed_rows, n_processed_columns), (n_raw_rows, n_raw_columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess the raw student data.')
+    parser.add_argument('--raw', default=RAW_DATA_FILE, help='path of the raw CSV file')
+    parser.add_argument('--out', default=PROCESSED_DATA_FILE, help='path of the processed CSV file')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the raw file in chunks of this many rows')
+    parser.add_argument('--columnar', default=None,
+                        help='also save the processed data to this .parquet or .feather file')
+    parser.add_argument('--keep-age', action='store_true',
+                        help='keep the age at enrollment, for treatment threshold sweeps')
+    args = parser.parse_args()
+
+    if args.chunksize is None:
+        processed_df, raw_data_shape = preprocess(args.raw, args.out, columnar_path=args.columnar,
+                                                  keep_age=args.keep_age)
+        processed_data_shape = processed_df.shape
+    else:
+        processed_data_shape, raw_data_shape = preprocess_streaming(args.raw, args.out,
+                                                                    chunksize=args.chunksize,
+                                                                    columnar_path=args.columnar,
+                                                                    keep_age=args.keep_age)
+
+    print("Preprocessing complete. Data saved to " + args.out)
+    print(f"Original data shape: {raw_data_shape}")
+    print(f"Preprocessed data shape: {processed_data_shape}")
@@ -0,0 +1,325 @@
+"""
+This module generates synthetic cohorts with the schema of the processed data and a known
+treatment effect, for load tests and for checking estimators against a ground truth.
+
+The generator learns the levels and frequencies of every column of 'data/processed_data.csv'
+and samples covariates with the same levels and ranges. The macroeconomic columns
+(unemployment rate, inflation rate, GDP) are sampled jointly, as they take one value per
+year. A confounder index built from a few covariates drives both the treatment and the
+outcome:
+
+    e(X)  = P(Adult = 1 | X) = sigmoid(a + confounding_strength * c(X))
+    p0(X) = P(Target = 1 | X, Adult = 0) = 0.5 + 0.3 * tanh(b - outcome_strength * c(X))
+    p1(X) = p0(X) + tau(X),   tau(X) = alpha + beta * e(X)
+
+The intercepts a and b are set so the treated share and the graduation rate match the
+processed data, and alpha and beta are solved from the requested ATT and ATC using the
+moments of e(X) on a large calibration sample. The population ATE is then
+E[e] * ATT + (1 - E[e]) * ATC.
+
+Requested effects are feasible when p1(X) stays a probability for every possible X. As
+e(X) and p0(X) both move with c(X), an effect that is most negative where e is small meets
+p0 where it is large: at the default strengths and effects around -0.1, the ATC can be
+0.15 below the ATT, while the ATT can only be about 0.02 below the ATC.
+
+Classes:
+    SyntheticCohortGenerator(source_path=PROCESSED_DATA_FILE, confounding_strength=1.0,
+                             outcome_strength=1.0, ate=None, att=None, atc=None, seed=0):
+        Samples synthetic cohorts, in memory or streamed to CSV in chunks.
+
+Usage:
+    python synthetic_data.py --rows 4000000 --out data/synthetic_data.csv --att -0.1 --atc -0.15
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+PROCESSED_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                                   'processed_data.csv')
+
+MACRO_COLUMNS = ['Unemployment rate', 'Inflation rate', 'GDP']
+GRADE_COLUMNS = ['Previous qualification (grade)', 'Admission grade']
+TREATMENT_COLUMN = 'Adult'
+OUTCOME_COLUMN = 'Target'
+
+# Bound of |p0 - 0.5|, which leaves room for effects of at least 0.2 everywhere
+OUTCOME_AMPLITUDE = 0.3
+
+# Confounder index values at which p1 is checked to be a probability
+_FEASIBILITY_GRID_POINTS = 10_001
+
+CALIBRATION_ROWS = 200_000
+DEFAULT_EFFECT = -0.1
+
+
+def _sigmoid(z):
+    return 1 / (1 + np.exp(-z))
+
+
+def _solve_intercept(scores, target_mean, link):
+    """
+    Find the intercept for which the mean of link(intercept + scores) equals target_mean,
+    by bisection; link must be increasing.
+    """
+    low, high = -20.0, 20.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if np.mean(link(middle + scores)) < target_mean:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class SyntheticCohortGenerator:
+    """
+    Sample synthetic cohorts with the schema of the processed data and known effects.
+
+    Parameters:
+    source_path (str): Processed data file whose levels and frequencies are reproduced.
+    confounding_strength (float): Effect of the confounder index on the treatment logit,
+        0 for a randomized treatment.
+    outcome_strength (float): Effect of the confounder index on the outcome.
+    ate (float or None): Population ATE. Alone, it sets a homogeneous effect; together
+        with att and atc it must equal their weighted average.
+    att (float or None): Population ATT, given together with atc.
+    atc (float or None): Population ATC, given together with att.
+        Without any effect, the effect is a homogeneous DEFAULT_EFFECT.
+    seed (int): Seed of the calibration sample and of the generated rows.
+
+    Attributes:
+    true_effects (dict): Population 'ate', 'att' and 'atc' of the generator.
+    """
+
+    def __init__(self, source_path=PROCESSED_DATA_FILE, confounding_strength=1.0,
+                 outcome_strength=1.0, ate=None, att=None, atc=None, seed=0):
+        self.confounding_strength = confounding_strength
+        self.outcome_strength = outcome_strength
+        self.seed = seed
+
+        source = pd.read_csv(source_path)
+        self.columns = list(source.columns)
+        self._learn_marginals(source)
+
+        # Calibrate the intercepts and the effect on a sample from a dedicated stream
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(0,)))
+        covariates = self._sample_covariates(rng, CALIBRATION_ROWS)
+        raw_index = self._raw_confounder_index(covariates)
+        self._index_mean = raw_index.mean()
+        self._index_std = raw_index.std()
+        index = (raw_index - self._index_mean) / self._index_std
+
+        self._treatment_intercept = _solve_intercept(
+            confounding_strength * index, source[TREATMENT_COLUMN].mean(), _sigmoid)
+        self._outcome_intercept = _solve_intercept(
+            -outcome_strength * index, source[OUTCOME_COLUMN].mean(),
+            lambda z: 0.5 + OUTCOME_AMPLITUDE * np.tanh(z))
+
+        e = self._propensity(index)
+        self._solve_effect(e, ate, att, atc)
+
+    def _learn_marginals(self, source):
+        covariates = source.drop(columns=[TREATMENT_COLUMN, OUTCOME_COLUMN])
+
+        self._categorical = {}
+        for col in covariates.columns:
+            if col in MACRO_COLUMNS or col in GRADE_COLUMNS:
+                continue
+            frequencies = covariates[col].value_counts(normalize=True).sort_index()
+            self._categorical[col] = (frequencies.index.to_numpy(), frequencies.to_numpy())
+
+        macro = covariates[MACRO_COLUMNS].value_counts(normalize=True).sort_index()
+        self._macro_levels = np.array(macro.index.tolist())
+        self._macro_frequencies = macro.to_numpy()
+
+        self._grades = {col: (covariates[col].mean(), covariates[col].std(),
+                              covariates[col].min(), covariates[col].max())
+                        for col in GRADE_COLUMNS}
+
+    def _sample_covariates(self, rng, n_rows):
+        """
+        Sample independent covariates with the learned levels and frequencies.
+        """
+        data = {}
+        for col, (levels, frequencies) in self._categorical.items():
+            data[col] = levels[rng.choice(len(levels), size=n_rows, p=frequencies)]
+
+        macro = self._macro_levels[rng.choice(len(self._macro_levels), size=n_rows,
+                                              p=self._macro_frequencies)]
+        for i, col in enumerate(MACRO_COLUMNS):
+            data[col] = macro[:, i]
+
+        # Grades from a normal with the source mean and deviation, clipped to its range
+        for col, (mean, std, low, high) in self._grades.items():
+            data[col] = np.round(np.clip(rng.normal(mean, std, size=n_rows), low, high), 1)
+
+        return pd.DataFrame(data)
+
+    def _raw_confounder_index(self, covariates):
+        """
+        Confounder index before standardization: students who are older in practice tend to
+        be married, attend evening classes, hold fewer scholarships and have lower grades.
+        """
+        admission_mean, admission_std = self._grades['Admission grade'][:2]
+        previous_mean, previous_std = self._grades['Previous qualification (grade)'][:2]
+        return (1.0 * (covariates['Marital status'] != 1)
+                + 1.0 * (covariates['Daytime/evening attendance'] == 0)
+                - 0.5 * (covariates['Scholarship holder'] == 1)
+                - 0.3 * (covariates['Displaced'] == 1)
+                - 0.5 * (covariates['Admission grade'] - admission_mean) / admission_std
+                - 0.3 * (covariates['Previous qualification (grade)'] - previous_mean)
+                / previous_std).to_numpy()
+
+    def _raw_index_bounds(self):
+        """
+        Smallest and largest possible confounder index, reached at the extreme grades with
+        the indicators set to lower or raise it.
+        """
+        admission_mean, admission_std, admission_low, admission_high = self._grades['Admission grade']
+        previous_mean, previous_std, previous_low, previous_high = \
+            self._grades['Previous qualification (grade)']
+        lowest = (-0.5 - 0.3 - 0.5 * (admission_high - admission_mean) / admission_std
+                  - 0.3 * (previous_high - previous_mean) / previous_std)
+        highest = (1.0 + 1.0 - 0.5 * (admission_low - admission_mean) / admission_std
+                   - 0.3 * (previous_low - previous_mean) / previous_std)
+        return np.array([lowest, highest])
+
+    def _propensity(self, index):
+        return _sigmoid(self._treatment_intercept + self.confounding_strength * index)
+
+    def _control_outcome_probability(self, index):
+        return 0.5 + OUTCOME_AMPLITUDE * np.tanh(self._outcome_intercept
+                                                 - self.outcome_strength * index)
+
+    def _solve_effect(self, e, ate, att, atc):
+        """
+        Solve alpha and beta of tau(X) = alpha + beta * e(X) for the requested effects.
+        """
+        treated_share = e.mean()
+        if (att is None) != (atc is None):
+            raise ValueError('att and atc must be given together')
+        if att is None:
+            # Homogeneous effect
+            att = atc = DEFAULT_EFFECT if ate is None else ate
+        elif ate is not None and not np.isclose(ate, treated_share * att + (1 - treated_share) * atc):
+            raise ValueError(f'ate must equal {treated_share:.4f} * att + {1 - treated_share:.4f} * atc '
+                             f'for this confounding strength')
+
+        # ATT = alpha + beta * E[e^2] / E[e],  ATC = alpha + beta * E[e(1 - e)] / E[1 - e]
+        treated_moment = np.mean(e ** 2) / treated_share
+        control_moment = np.mean(e * (1 - e)) / (1 - treated_share)
+        if np.isclose(treated_moment, control_moment):
+            if not np.isclose(att, atc):
+                raise ValueError('att and atc must be equal when the treatment is randomized')
+            self._alpha, self._beta = att, 0.0
+        else:
+            self._beta = (att - atc) / (treated_moment - control_moment)
+            self._alpha = att - self._beta * treated_moment
+
+        # p1 depends on X through the index only, so checking every possible index suffices
+        low, high = (self._raw_index_bounds() - self._index_mean) / self._index_std
+        index = np.linspace(low, high, _FEASIBILITY_GRID_POINTS)
+        p1 = (self._control_outcome_probability(index)
+              + self._alpha + self._beta * self._propensity(index))
+        if p1.min() < 0 or p1.max() > 1:
+            raise ValueError(f'The requested effects make the treated graduation probability range '
+                             f'over [{p1.min():.3f}, {p1.max():.3f}]; use effects closer to each '
+                             f'other or to 0')
+
+        self.true_effects = {'ate': treated_share * att + (1 - treated_share) * atc,
+                             'att': att, 'atc': atc}
+
+    def _sample_block(self, rng, n_rows):
+        """
+        Sample a block of rows with the processed data columns, and their individual effects.
+        """
+        df = self._sample_covariates(rng, n_rows)
+        index = (self._raw_confounder_index(df) - self._index_mean) / self._index_std
+
+        e = self._propensity(index)
+        treated = rng.random(n_rows) < e
+
+        p0 = self._control_outcome_probability(index)
+        tau = self._alpha + self._beta * e
+        p = np.where(treated, p0 + tau, p0)
+
+        df[OUTCOME_COLUMN] = (rng.random(n_rows) < p).astype(int)
+        df[TREATMENT_COLUMN] = treated.astype(int)
+        return df[self.columns], tau
+
+    def iter_chunks(self, n_rows, chunksize=100_000):
+        """
+        Generate a cohort chunk by chunk. Chunk i is drawn from its own stream spawned from
+        the seed, so a cohort is determined by the seed, n_rows and chunksize.
+        Parameters:
+        n_rows (int): Number of rows.
+        chunksize (int): Rows per chunk.
+        Yields:
+        tuple: The chunk (pd.DataFrame) and the individual effects of its rows (np.ndarray).
+        """
+        for i, start in enumerate(range(0, n_rows, chunksize)):
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(1, i)))
+            yield self._sample_block(rng, min(chunksize, n_rows - start))
+
+    def generate(self, n_rows, chunksize=100_000):
+        """
+        Generate a cohort in memory.
+        Parameters:
+        n_rows (int): Number of rows.
+        chunksize (int): Rows per generated chunk, as in `iter_chunks`.
+        Returns:
+        tuple: The cohort (pd.DataFrame) and its sample effects (dict with 'ate', 'att', 'atc').
+        """
+        chunks, effects = zip(*self.iter_chunks(n_rows, chunksize))
+        df = pd.concat(chunks, ignore_index=True)
+        return df, self._sample_effects(np.concatenate(effects), df[TREATMENT_COLUMN].to_numpy())
+
+    def write_csv(self, path, n_rows, chunksize=100_000):
+        """
+        Stream a cohort to a CSV file, holding one chunk in memory at a time.
+        Parameters:
+        path (str): Destination file.
+        n_rows (int): Number of rows.
+        chunksize (int): Rows per chunk.
+        Returns:
+        dict: Sample 'ate', 'att' and 'atc' of the written cohort.
+        """
+        totals = np.zeros(4)  # sum of effects of treated, controls; counts of treated, controls
+        for i, (chunk, tau) in enumerate(self.iter_chunks(n_rows, chunksize)):
+            chunk.to_csv(path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            treated = chunk[TREATMENT_COLUMN].to_numpy() == 1
+            totals += [tau[treated].sum(), tau[~treated].sum(), treated.sum(), (~treated).sum()]
+
+        return {'ate': (totals[0] + totals[1]) / (totals[2] + totals[3]),
+                'att': totals[0] / totals[2], 'atc': totals[1] / totals[3]}
+
+    @staticmethod
+    def _sample_effects(tau, treated):
+        return {'ate': tau.mean(), 'att': tau[treated == 1].mean(),
+                'atc': tau[treated == 0].mean()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic cohort with known effects.')
+    parser.add_argument('--rows', type=int, required=True, help='number of rows')
+    parser.add_argument('--out', required=True, help='path of the generated CSV file')
+    parser.add_argument('--source', default=PROCESSED_DATA_FILE,
+                        help='processed data file whose schema is reproduced')
+    parser.add_argument('--confounding', type=float, default=1.0, help='confounding strength')
+    parser.add_argument('--ate', type=float, default=None, help='population ATE')
+    parser.add_argument('--att', type=float, default=None, help='population ATT, with --atc')
+    parser.add_argument('--atc', type=float, default=None, help='population ATC, with --att')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the cohort')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows per written chunk')
+    args = parser.parse_args()
+
+    generator = SyntheticCohortGenerator(args.source, confounding_strength=args.confounding,
+                                         ate=args.ate, att=args.att, atc=args.atc, seed=args.seed)
+    sample_effects = generator.write_csv(args.out, args.rows, chunksize=args.chunksize)
+
+    print(f"Synthetic data saved to {args.out}")
+    print(f"Population effects: {generator.true_effects}")
+    print(f"Sample effects: {sample_effects}")